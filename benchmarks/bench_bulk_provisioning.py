@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Compare provisioning a VLAN one address/route at a time against
+# the bulk operation, on a stub datapath.
+#
+# Usage: python benchmarks/bench_bulk_provisioning.py [addresses] [routes_per_address]
+
+import sys
+
+from stubdp import *
+
+VLAN_ID = 100
+
+
+def make_batch(address_count, routes_per_address):
+    addresses = []
+    routes = []
+    for i in range(address_count):
+        addresses.append('10.%d.%d.1/24' % (i >> 8, i & 0xff))
+        gateway = '10.%d.%d.254' % (i >> 8, i & 0xff)
+        for j in range(routes_per_address):
+            n = i * routes_per_address + j
+            destination = '172.%d.%d.0/24' % (16 + (n >> 8), n & 0xff)
+            routes.append({'destination': destination, 'gateway': gateway})
+    return addresses, routes
+
+
+def one_at_a_time(router, addresses, routes):
+    for address in addresses:
+        router.set_data(VLAN_ID, {'address': address}, router.waiters)
+    for route in routes:
+        router.set_data(VLAN_ID, route, router.waiters)
+
+
+def bulk(router, addresses, routes):
+    result = router.set_bulk_data(VLAN_ID, {'address': addresses, 'route': routes},
+                                  router.waiters)
+    assert result['command_result'][0]['result'] == 'success'
+
+
+def main():
+    address_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    routes_per_address = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    addresses, routes = make_batch(address_count, routes_per_address)
+    print('%d addresses, %d routes' % (len(addresses), len(routes)))
+
+    for name, func in (('one at a time', one_at_a_time), ('bulk', bulk)):
+        router, dp = make_router()
+        dp.reset()
+        elapsed, dummy = timed(func, router, addresses, routes)
+        print('%-14s %8.3fs  %s' % (name, elapsed,
+                                    ', '.join('%s=%d' % item
+                                              for item in sorted(dp.sent.items()))))
+        router.delete()
+
+
+if __name__ == '__main__':
+    main()
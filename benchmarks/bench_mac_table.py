@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Measure the MAC learning table: memory held for many learned MACs, and
+# the cost of learning on every packet-in, for the shared per-switch table
+# against the former per-VLAN dicts of MACAddressEntry objects.
+#
+# Usage: python benchmarks/bench_mac_table.py [macs] [vlans] [passes]
+
+import os
+import resource
+import sys
+import time
+import traceback
+
+from stubdp import *
+
+from plexus.tables import MACAddressTable
+
+
+class PerVlanEntry(object):
+    # The former entry: made anew on each packet-in.
+    def __init__(self, port):
+        super(PerVlanEntry, self).__init__()
+        self.port = port
+        self.expire_time = (time.time() + MAC_ADDRESS_TTL)
+
+
+def make_macs(mac_count, vlan_count):
+    return [(1 + n % vlan_count, '02:00:%02x:%02x:%02x:%02x' % ((n >> 24) & 0xff, (n >> 16) & 0xff,
+                                                                (n >> 8) & 0xff, n & 0xff))
+            for n in range(mac_count)]
+
+
+def learn_per_vlan(macs, passes):
+    tables = {}
+    for i in range(passes):
+        for vlan_id, mac in macs:
+            tables.setdefault(vlan_id, {})[mac] = PerVlanEntry(1)
+    return tables
+
+
+def learn_shared(macs, passes):
+    table = MACAddressTable()
+    for i in range(passes):
+        for vlan_id, mac in macs:
+            table.learn(vlan_id, mac, 1)
+    table.shutdown()
+    return table
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def measure_memory(learn, macs):
+    # Each table is built in a child process, so that neither reuses
+    # memory freed by the other.
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            before = rss()
+            table = learn(macs, 1)
+            os.write(w, str(rss() - before).encode())
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(0)
+    # Else the read below would never see end of file, were the child to fail.
+    os.close(w)
+    result = os.read(r, 64)
+    os.close(r)
+    os.waitpid(pid, 0)
+    if not result:
+        raise RuntimeError('Measurement failed, in the child process.')
+    return int(result)
+
+
+def main():
+    mac_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    vlan_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    passes = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    macs = make_macs(mac_count, vlan_count)
+    print('%d MACs on %d VLANs, %d packet-ins each' % (mac_count, vlan_count, passes))
+
+    for name, learn in (('per-VLAN', learn_per_vlan),
+                        ('shared', learn_shared)):
+        memory = measure_memory(learn, macs)
+        elapsed, dummy = timed(learn, macs, passes)
+        print('%-10s %8.1f MB %6.0f bytes/MAC  %8.3fs %10.0f packet-ins/s' % (
+            name, memory / 1e6, float(memory) / mac_count,
+            elapsed, mac_count * passes / elapsed))
+
+    # Sweep of the whole table, once every entry has expired.
+    table = learn_shared(macs, 1)
+    elapsed, dummy = timed(table.expire, table.now + MAC_ADDRESS_TTL + MAC_ADDRESS_GC_INTERVAL)
+    assert not table
+    print('%-10s %8.3fs' % ('expiry', elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Replay packet-ins through a router on a stub datapath, for OpenFlow 1.0
+# and 1.3: ARP storms, host churn, DHCP, traffic to unknown destinations
+# and, if given, the frames of a pcap file. Reports packet-ins handled per
+# second, the flow mods and packet outs sent per packet-in, and latency
+# percentiles, overall and for each VlanRouter handler.
+#
+# Usage: python benchmarks/bench_packet_in.py [packet_ins] [pcap_file]
+
+import sys
+import time
+
+from stubdp import *
+
+from ryu.lib import pcaplib
+from ryu.lib.packet import arp
+from ryu.lib.packet import dhcp
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import ipv4
+from ryu.lib.packet import packet
+from ryu.lib.packet import tcp
+from ryu.lib.packet import udp
+from ryu.lib.packet import vlan
+
+VLAN_ID = 100
+PORT_COUNT = 48
+GATEWAY_IP = '10.0.0.1'
+ROUTER_MAC = '02:00:00:00:00:01'
+HANDLERS = ('_check_penalty_box_arp', '_check_penalty_box_ipv4', '_packetin_arp',
+            '_packetin_icmp_req', '_packetin_tcp_udp', '_packetin_to_node')
+PERCENTILES = (50, 90, 99)
+
+# Handler name -> latencies (seconds), for the current run.
+handler_latencies = {}
+
+
+def host_mac(n):
+    return '02:10:%02x:%02x:%02x:%02x' % ((n >> 24) & 0xff, (n >> 16) & 0xff,
+                                           (n >> 8) & 0xff, n & 0xff)
+
+
+def host_ip(n):
+    # Hosts within 10.0.0.0/16, clear of the gateway.
+    n = n % 65000 + 2
+    return '10.0.%d.%d' % (n >> 8, n & 0xff)
+
+
+def make_frame(src_mac, dst_mac, ethertype, *protocols):
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst_mac, src_mac, ether.ETH_TYPE_8021Q))
+    pkt.add_protocol(vlan.vlan(vid=VLAN_ID, ethertype=ethertype))
+    for protocol in protocols:
+        pkt.add_protocol(protocol)
+    pkt.serialize()
+    return pkt.data
+
+
+def arp_request(n, dst_ip):
+    return make_frame(host_mac(n), mac_lib.BROADCAST_STR, ether.ETH_TYPE_ARP,
+                      arp.arp(opcode=arp.ARP_REQUEST, src_mac=host_mac(n), src_ip=host_ip(n),
+                              dst_mac=mac_lib.DONTCARE_STR, dst_ip=dst_ip))
+
+
+def tcp_syn(n, dst_ip):
+    return make_frame(host_mac(n), ROUTER_MAC, ether.ETH_TYPE_IP,
+                      ipv4.ipv4(src=host_ip(n), dst=dst_ip, proto=inet.IPPROTO_TCP),
+                      tcp.tcp(src_port=49152 + n % 16384, dst_port=80, bits=tcp.TCP_SYN))
+
+
+def arp_storm(count):
+    # One misbehaving port, asking for the gateway over and over.
+    return [(1, arp_request(n % 64, GATEWAY_IP)) for n in range(count)]
+
+
+def host_churn(count):
+    # New hosts across all ports, each resolving the gateway and then
+    # opening a connection to a neighbour.
+    frames = []
+    for n in range(count // 2):
+        in_port = 1 + n % PORT_COUNT
+        frames.append((in_port, arp_request(n, GATEWAY_IP)))
+        frames.append((in_port, tcp_syn(n, host_ip(n + 1))))
+    return frames
+
+
+def dhcp_discovers(count):
+    frames = []
+    for n in range(count):
+        options = dhcp.options(option_list=[dhcp.option(tag=dhcp.DHCP_MESSAGE_TYPE_OPT,
+                                                        value=chr(dhcp.DHCP_DISCOVER))])
+        frames.append((1 + n % PORT_COUNT,
+                       make_frame(host_mac(n), mac_lib.BROADCAST_STR, ether.ETH_TYPE_IP,
+                                  ipv4.ipv4(src=INADDR_ANY_BASE, dst=INADDR_BROADCAST_BASE,
+                                            proto=inet.IPPROTO_UDP),
+                                  udp.udp(src_port=DHCP_CLIENT_PORT, dst_port=DHCP_SERVER_PORT),
+                                  dhcp.dhcp(op=dhcp.DHCP_BOOT_REQUEST, chaddr=host_mac(n),
+                                            options=options))))
+    return frames
+
+
+def unknown_destinations(count):
+    # Scans of unrouted space, from a few hundred hosts.
+    return [(1 + n % PORT_COUNT,
+             tcp_syn(n % 256, '192.168.%d.%d' % ((n >> 8) & 0xff, n & 0xff)))
+            for n in range(count)]
+
+
+def read_pcap(path, count):
+    frames = []
+    with open(path, 'rb') as f:
+        for ts, data in pcaplib.Reader(f):
+            frames.append((1, data))
+            if len(frames) == count:
+                break
+    return frames
+
+
+def instrument():
+    # Time each handler, wherever it is called from.
+    from plexus.router import VlanRouter
+
+    def timed_handler(name, handler):
+        def _timed_handler(*args, **kwargs):
+            start = time.time()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                handler_latencies.setdefault(name, []).append(time.time() - start)
+        return _timed_handler
+
+    for name in HANDLERS:
+        setattr(VlanRouter, name, timed_handler(name, getattr(VlanRouter, name)))
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return [latencies[int(p / 100.0 * (len(latencies) - 1))] * 1e6 for p in PERCENTILES]
+
+
+def format_latencies(latencies):
+    return '  '.join('p%d %7.1fus' % item
+                     for item in zip(PERCENTILES, percentiles(latencies)))
+
+
+def replay(ofproto, frames):
+    router, dp = make_router(PORT_COUNT, ofproto=ofproto)
+    result = router.set_bulk_data(VLAN_ID, {REST_ADDRESS: ['%s/16' % GATEWAY_IP],
+                                            REST_ROUTE: [{REST_DESTINATION: '172.16.0.0/12',
+                                                          REST_GATEWAY: '10.0.255.254'}],
+                                            REST_DHCP: ['10.0.255.250']},
+                                  router.waiters)
+    assert result['command_result'][0]['result'] == 'success'
+    dp.reset()
+    handler_latencies.clear()
+
+    latencies = []
+    start = time.time()
+    for in_port, data in frames:
+        msg = StubPacketIn(dp, in_port, data)
+        begin = time.time()
+        router.packet_in_handler(msg)
+        latencies.append(time.time() - begin)
+    elapsed = time.time() - start
+    router.delete()
+    return elapsed, latencies, dp
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    scenarios = [('arp storm', arp_storm(count)),
+                 ('host churn', host_churn(count)),
+                 ('dhcp', dhcp_discovers(count)),
+                 ('unknown dst', unknown_destinations(count))]
+    if len(sys.argv) > 2:
+        scenarios.append(('pcap', read_pcap(sys.argv[2], count)))
+    instrument()
+
+    for version, ofproto in (('OF1.0', ofproto_v1_0), ('OF1.3', ofproto_v1_3)):
+        for name, frames in scenarios:
+            elapsed, latencies, dp = replay(ofproto, frames)
+            total = float(len(frames))
+            print('%s %-12s %6d packet-ins %9.0f/s  flow mods %5.2f  packet outs %5.2f  %s%s' % (
+                version, name, len(frames), total / elapsed,
+                dp.sent.get('OFPFlowMod', 0) / total,
+                dp.sent.get('OFPPacketOut', 0) / total,
+                format_latencies(latencies),
+                '  (closed)' if dp.closed else ''))
+            for handler in HANDLERS:
+                if handler in handler_latencies:
+                    print('    %-24s %6d calls  %s' % (handler, len(handler_latencies[handler]),
+                                                      format_latencies(handler_latencies[handler])))
+
+
+if __name__ == '__main__':
+    main()
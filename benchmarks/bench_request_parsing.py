@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Measure request body parsing throughput: the old eval() of the body,
+# against JSON decoding plus schema validation.
+#
+# Usage: python benchmarks/bench_request_parsing.py [routes] [repeat]
+
+import json
+import sys
+
+from stubdp import *
+
+from plexus.schema import validate_request
+
+
+def make_body(route_count):
+    addresses = ['10.%d.%d.1/24' % (i >> 8, i & 0xff)
+                 for i in range(max(1, route_count // 10))]
+    routes = [{'destination': '172.%d.%d.0/24' % (16 + (n >> 8), n & 0xff),
+               'gateway': '10.0.0.%d' % (2 + n % 250)}
+              for n in range(route_count)]
+    return json.dumps({'address': addresses, 'route': routes})
+
+
+def main():
+    route_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    body = make_body(route_count)
+    print('%d routes, %d byte body, %d runs' % (route_count, len(body), repeat))
+
+    for name, parse in (('eval', eval),
+                        ('decode only', json.loads),
+                        ('decode+validate', lambda body: validate_request('set_bulk_data', body))):
+        elapsed, dummy = timed(lambda: [parse(body) for i in range(repeat)])
+        print('%-16s %8.3fs  %10.0f routes/s' % (name, elapsed,
+                                                 route_count * repeat / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Measure the routing and address tables as they grow, from 10 entries
+# up. Routes are drawn from a prefix length mix like that of a full
+# routing table, with more specifics of earlier prefixes and a default
+# route; a share of them go to source policy tables. Operations whose
+# cost grows with the table are timed over fewer calls at larger sizes.
+#
+# Results are also written as JSON, for comparison between releases.
+#
+# Usage: python benchmarks/bench_routing_tables.py [max_entries] [results.json]
+
+import json
+import platform
+import random
+import sys
+import time
+
+from stubdp import *
+
+from plexus.tables import *
+from plexus.util import *
+
+# Prefix lengths, with weights, roughly as seen in a full routing table.
+PREFIX_LENGTHS = ((8, 1), (12, 2), (16, 30), (18, 20), (19, 40), (20, 60), (21, 70),
+                  (22, 120), (23, 110), (24, 520), (28, 7), (32, 20))
+# Share of routes that are more specifics of an earlier prefix.
+OVERLAP_SHARE = 0.1
+# Share of routes in a source policy table, and how many such tables.
+POLICY_SHARE = 0.2
+SOURCE_COUNT = 16
+# Entry visits allowed per operation timed, for those linear in table size.
+LINEAR_BUDGET = 200000
+SEED = 4242
+
+
+def make_prefixes(count, rng):
+    lengths = [length for length, weight in PREFIX_LENGTHS for i in range(weight)]
+    prefixes = [(0, 0)]
+    seen = set(prefixes)
+    while len(prefixes) < count:
+        netmask = rng.choice(lengths)
+        base_int, base_netmask = rng.choice(prefixes)
+        if rng.random() < OVERLAP_SHARE and base_netmask < netmask:
+            ip_int = base_int | (rng.getrandbits(32) & mask_ntob(netmask) & ~mask_ntob(base_netmask))
+        else:
+            ip_int = rng.getrandbits(32) & mask_ntob(netmask)
+        if (ip_int, netmask) not in seen:
+            seen.add((ip_int, netmask))
+            prefixes.append((ip_int, netmask))
+    return prefixes
+
+
+def make_sources():
+    return [Address(i + 1, '10.%d.0.0' % i, 16, '10.%d.0.1' % i) for i in range(SOURCE_COUNT)]
+
+
+def make_routes(prefixes, sources, rng):
+    routes = []
+    for n, (ip_int, netmask) in enumerate(prefixes):
+        if netmask == 0:
+            routes.append((INADDR_ANY, '10.0.0.254', None))
+            continue
+        source = rng.choice(sources) if rng.random() < POLICY_SHARE else None
+        routes.append(('%s/%d' % (ipv4_int_to_text(ip_int), netmask),
+                       '10.%d.0.254' % (n % SOURCE_COUNT), source))
+    return routes
+
+
+def make_addresses(count):
+    # Non-overlapping /30s, within 10.0.0.0/8.
+    return [ipv4_int_to_text(0x0a000000 + (n << 2)) for n in range(count)]
+
+
+def sample_count(size):
+    return max(3, min(1000, LINEAR_BUDGET // size))
+
+
+def time_calls(func, args_list):
+    start = time.time()
+    for args in args_list:
+        func(*args)
+    return (time.time() - start) / len(args_list), len(args_list)
+
+
+def bench_policy_table(size, rng):
+    results = {}
+    sources = make_sources()
+    routes = make_routes(make_prefixes(size, rng), sources, rng)
+
+    table = PolicyRoutingTable()
+    results['policy.add'] = time_calls(table.add, [(dst, None, gateway, source)
+                                                   for dst, gateway, source in routes])
+
+    samples = sample_count(size)
+    lookups = []
+    for i in range(samples):
+        dst_ip = ipv4_int_to_text(rng.getrandbits(32))
+        if i % 2:
+            src_ip = '10.%d.1.2' % rng.randrange(SOURCE_COUNT)
+        else:
+            src_ip = '192.0.2.1'
+        lookups.append((None, dst_ip, src_ip))
+    results['policy.get_data'] = time_calls(table.get_data, lookups)
+    results['policy.get_all_gateway_info'] = time_calls(table.get_all_gateway_info,
+                                                        [()] * samples)
+
+    # Route IDs are 16 bits, so wrap around in the largest tables.
+    route_ids = rng.sample(range(1, min(size, UINT16_MAX) + 1), min(samples, size))
+    results['policy.delete'] = time_calls(table.delete, [(route_id,) for route_id in route_ids])
+    results['policy.gc_subnet_tables'] = time_calls(table.gc_subnet_tables, [()] * samples)
+    return results
+
+
+def bench_address_data(size, rng):
+    results = {}
+    samples = sample_count(size)
+    nw_addrs = make_addresses(size + samples)
+
+    # The table is filled without checking for overlaps, which would take
+    # quadratic time. Each timed add is checked against exactly size
+    # addresses, as it is deleted again, untimed, before the next.
+    table = AddressData()
+    for n, nw_addr in enumerate(nw_addrs[:size]):
+        default_gw = ipv4_int_to_text(ipv4_text_to_int(nw_addr) + 1)
+        table[prefix_key(nw_addr, 30)] = Address(n + 1, nw_addr, 30, default_gw)
+    elapsed = 0
+    for nw_addr in nw_addrs[size:]:
+        start = time.time()
+        address = table.add('%s/30' % ipv4_int_to_text(ipv4_text_to_int(nw_addr) + 1))
+        elapsed += time.time() - start
+        del table[prefix_key(address.nw_addr, address.netmask)]
+    results['address.add'] = (elapsed / samples, samples)
+
+    hosts = [ipv4_int_to_text(ipv4_text_to_int(rng.choice(nw_addrs[:size])) + 2)
+             for i in range(samples)]
+    results['address.get_data'] = time_calls(table.get_data, [(None, ip) for ip in hosts])
+    return results
+
+
+def main():
+    max_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    output = sys.argv[2] if len(sys.argv) > 2 else None
+    sizes = []
+    size = 10
+    while size <= max_entries:
+        sizes.append(size)
+        size *= 10
+
+    results = []
+    for size in sizes:
+        rng = random.Random(SEED)
+        for bench in (bench_policy_table, bench_address_data):
+            for operation, (seconds, calls) in sorted(bench(size, rng).items()):
+                print('%-28s %8d entries %6d calls %12.2fus/call' % (operation, size, calls,
+                                                                     seconds * 1e6))
+                results.append({'operation': operation, 'entries': size,
+                                'calls': calls, 'seconds_per_call': seconds})
+        sys.stdout.flush()
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'seed': SEED,
+                       'results': results}, f, indent=2, sort_keys=True)
+        print('Results written to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Measure startup: the time to import each Plexus module (in a fresh
+# interpreter, noting which optional subsystems it drags in), and the
+# time from a switch connecting to all of its flows being installed,
+# with saved state restored and gateways answering ARP, on a stub datapath.
+#
+# Usage: python benchmarks/bench_startup.py [routes] [routes_per_address]
+
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from stubdp import *
+
+from ryu.lib.packet import arp
+
+from plexus.state import FileStateBackend, StateStore
+from bench_state_restore import make_batch, VLAN_ID
+
+MODULES = ('plexus', 'plexus.tables', 'plexus.schema', 'plexus.state',
+           'plexus.router', 'plexus.app')
+OPTIONAL = ('requests', 'urllib3', 'eventlet.backdoor', 'ryu.lib.packet.packet')
+
+IMPORT_TIMER = '''
+import sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+print('%%.3f %%s' %% (elapsed, ','.join(m for m in %r if m in sys.modules) or '-'))
+'''
+
+
+def time_import(module):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    output = subprocess.check_output([sys.executable, '-c',
+                                      IMPORT_TIMER % (module, OPTIONAL)], cwd=root)
+    elapsed, loaded = output.split()
+    return float(elapsed), loaded
+
+
+def resolve_gateways(router, dp, routes):
+    # Answer the ARP request for each gateway, as the gateways would.
+    vlan_router = router[VLAN_ID]
+    msg = StubPacketIn(dp, 1)
+    for n, gateway_ip in enumerate(sorted(set(route['gateway'] for route in routes))):
+        mac = '02:01:00:00:%02x:%02x' % (n >> 8, n & 0xff)
+        header_list = {ARP: arp.arp(opcode=arp.ARP_REPLY, src_mac=mac, src_ip=gateway_ip)}
+        vlan_router._update_routing_tbls(msg, header_list)
+
+
+def main():
+    route_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    routes_per_address = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    for module in MODULES:
+        try:
+            elapsed, loaded = time_import(module)
+        except subprocess.CalledProcessError:
+            print('import %-14s failed' % module)
+            continue
+        print('import %-14s %8.3fs  loads: %s' % (module, elapsed, loaded))
+
+    addresses, routes = make_batch(route_count, routes_per_address)
+    print('%d addresses, %d routes' % (len(addresses), len(routes)))
+
+    logger = logging.getLogger('plexus.benchmark')
+    directory = tempfile.mkdtemp(prefix='plexus-state-')
+    try:
+        store = StateStore(FileStateBackend(directory, logger), logger)
+        router, dp = make_router()
+        router.journal.listeners.append(store.journal_listener)
+        router.set_bulk_data(VLAN_ID, {'address': addresses, 'route': routes},
+                             router.waiters)
+        router.delete()
+
+        # The switch re-connects.
+        join_time, (router, dp) = timed(make_router)
+        restore_time, dummy = timed(store.restore_router, router)
+        resolve_time, dummy = timed(resolve_gateways, router, dp, routes)
+        unresolved = [route for table in router[VLAN_ID].policy_routing_tbl.values()
+                      for route in table.values() if route.gateway_mac is None]
+        assert not unresolved
+        print('%-16s %8.3fs' % ('join', join_time))
+        print('%-16s %8.3fs' % ('restore', restore_time))
+        print('%-16s %8.3fs' % ('gateways', resolve_time))
+        print('%-16s %8.3fs  %s, installed=%d' % ('ready', join_time + restore_time + resolve_time,
+                                                  ', '.join('%s=%d' % item
+                                                            for item in sorted(dp.sent.items())),
+                                                  len(dp.flow_occupancy)))
+        router.delete()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Measure warm restart from locally saved state: saving a snapshot,
+# loading it (or an uncompacted journal) from disk, and restoring it
+# into a router on a stub datapath. Routes are spread across VLANs of
+# at most ROUTES_PER_VLAN routes each.
+#
+# Usage: python benchmarks/bench_state_restore.py [routes] [routes_per_address]
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from stubdp import *
+
+import plexus.state
+from plexus.state import FileStateBackend, StateStore
+
+# VLANs are numbered from VLAN_ID up.
+VLAN_ID = 100
+# Route IDs are 16 bits, and saved routes are keyed by them, so no one
+# VLAN can hold more than UINT16_MAX routes.
+ROUTES_PER_VLAN = 25000
+
+
+def make_batch(route_count, routes_per_address):
+    addresses = []
+    routes = []
+    for i in range(max(1, route_count // routes_per_address)):
+        addresses.append('10.%d.%d.1/24' % (i >> 8, i & 0xff))
+    for n in range(route_count):
+        i = n // routes_per_address
+        destination = '%d.%d.%d.0/24' % (100 + (n >> 16), (n >> 8) & 0xff, n & 0xff)
+        routes.append({'destination': destination,
+                       'gateway': '10.%d.%d.254' % (i >> 8, i & 0xff)})
+    return addresses, routes
+
+
+def main():
+    route_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    routes_per_address = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    vlans = {}
+    for first in range(0, route_count, ROUTES_PER_VLAN):
+        vlan_id = VLAN_ID + len(vlans)
+        vlans[vlan_id] = make_batch(min(ROUTES_PER_VLAN, route_count - first),
+                                    routes_per_address)
+    print('%d VLANs, %d addresses, %d routes' % (
+        len(vlans), sum(len(addresses) for addresses, routes in vlans.values()),
+        route_count))
+
+    logger = logging.getLogger('plexus.benchmark')
+    directory = tempfile.mkdtemp(prefix='plexus-state-')
+    # Past the threshold, a flush folds the journal into a snapshot; keep
+    # the whole journal, so that it is the journal that is measured.
+    snapshot_threshold = plexus.state.STATE_SNAPSHOT_THRESHOLD
+    plexus.state.STATE_SNAPSHOT_THRESHOLD = sys.maxsize
+    try:
+        # Provision a router, saving its state as it changes.
+        store = StateStore(FileStateBackend(directory, logger), logger)
+        # Flushed below, where it is timed, rather than in the background.
+        hub.kill(store.thread)
+        router, dp = make_router()
+        router.journal.listeners.append(store.journal_listener)
+        for vlan_id, (addresses, routes) in sorted(vlans.items()):
+            result = router.set_bulk_data(vlan_id, {'address': addresses, 'route': routes},
+                                          router.waiters)
+            assert result['command_result'][0]['result'] == 'success'
+        router.delete()
+
+        elapsed, dummy = timed(store.flush)
+        print('%-16s %8.3fs  %d bytes' % ('journal write', elapsed,
+                                          os.path.getsize(store.backend.journal_path)))
+        elapsed, dummy = timed(StateStore, FileStateBackend(directory, logger), logger)
+        print('%-16s %8.3fs' % ('journal load', elapsed))
+
+        elapsed, dummy = timed(store.backend.snapshot, store.switches)
+        print('%-16s %8.3fs  %d bytes' % ('snapshot write', elapsed,
+                                          os.path.getsize(store.backend.snapshot_path)))
+        elapsed, store = timed(StateStore, FileStateBackend(directory, logger), logger)
+        print('%-16s %8.3fs' % ('snapshot load', elapsed))
+
+        # Restore into a fresh router, as when its switch re-joins.
+        router, dp = make_router()
+        dp.reset()
+        elapsed, dummy = timed(store.restore_router, router)
+        route_total = sum(len(table) for vlan_id in vlans
+                          for table in router[vlan_id].policy_routing_tbl.values())
+        assert route_total == route_count
+        print('%-16s %8.3fs  %s' % ('restore', elapsed,
+                                    ', '.join('%s=%d' % item
+                                              for item in sorted(dp.sent.items()))))
+        router.delete()
+    finally:
+        plexus.state.STATE_SNAPSHOT_THRESHOLD = snapshot_threshold
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
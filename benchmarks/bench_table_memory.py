@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Measure the memory held per entry in each of the router's tables:
+# routes, addresses, learned MACs and penalty box entries. Routes are
+# also measured in their former layout, with a per-instance __dict__
+# and keyed by "address/netmask" strings.
+#
+# Usage: python benchmarks/bench_table_memory.py [entries]
+
+import os
+import resource
+import sys
+import traceback
+
+from stubdp import *
+
+from plexus.tables import *
+from plexus.util import *
+
+
+class DictRoute(object):
+    # The former route record.
+    def __init__(self, route_id, dst_ip, dst_netmask, dst_vlan, gateway_ip):
+        super(DictRoute, self).__init__()
+        self.route_id = route_id
+        self.dst_ip = dst_ip
+        self.dst_netmask = dst_netmask
+        self.dst_vlan = dst_vlan
+        self.gateway_ip = gateway_ip
+        self.gateway_mac = None
+        self.out_port = None
+        self.src_ip = 0
+        self.src_netmask = 0
+
+
+def make_prefixes(count):
+    # Distinct /30s, from 10.0.0.0 up.
+    return [ipv4_int_to_text(0x0a000000 + (n << 2)) for n in range(count)]
+
+
+def build_routes(prefixes):
+    table = PolicyRoutingTable()
+    for dst_ip in prefixes:
+        table.add('%s/30' % dst_ip, None, '192.168.0.1')
+    return table
+
+
+def build_dict_routes(prefixes):
+    table = {}
+    for n, dst_ip in enumerate(prefixes):
+        table['%s/%d' % (dst_ip, 30)] = DictRoute(n + 1, dst_ip, 30, None, '192.168.0.1')
+    return table
+
+
+def build_addresses(prefixes):
+    # AddressData.add() checks every address for overlaps; that is
+    # skipped here, as only the memory held is of interest.
+    table = AddressData()
+    for n, nw_addr in enumerate(prefixes):
+        default_gw = ipv4_int_to_text(ipv4_text_to_int(nw_addr) + 1)
+        table[prefix_key(nw_addr, 30)] = Address(n + 1, nw_addr, 30, default_gw)
+    return table
+
+
+def build_macs(prefixes):
+    table = MACAddressTable()
+    for n in range(len(prefixes)):
+        table.learn(1 + n % 10, '02:00:%02x:%02x:%02x:%02x' % ((n >> 24) & 0xff, (n >> 16) & 0xff,
+                                                              (n >> 8) & 0xff, n & 0xff), 1)
+    table.shutdown()
+    return table
+
+
+def build_penalty_box(prefixes):
+    table = PenaltyBoxList()
+    for src_ip in prefixes:
+        table.append(PenaltyBoxEntry(1, ether.ETH_TYPE_IP, src_ip, '192.168.0.1'))
+    table.shutdown()
+    return table
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def measure_memory(build, prefixes):
+    # Each table is built in a child process, so that none reuses
+    # memory freed by another.
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            before = rss()
+            table = build(prefixes)
+            os.write(w, str(rss() - before).encode())
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(0)
+    # Else the read below would never see end of file, were the child to fail.
+    os.close(w)
+    result = os.read(r, 64)
+    os.close(r)
+    os.waitpid(pid, 0)
+    if not result:
+        raise RuntimeError('Measurement failed, in the child process.')
+    return int(result)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    # Built before any measurement, so the strings are not counted.
+    prefixes = make_prefixes(count)
+    print('%d entries per table' % count)
+
+    for name, build in (('route', build_routes),
+                        ('route-dict', build_dict_routes),
+                        ('address', build_addresses),
+                        ('MAC', build_macs),
+                        ('penalty', build_penalty_box)):
+        memory = measure_memory(build, prefixes)
+        print('%-12s %8.1f MB %6.0f bytes/entry' % (name, memory / 1e6,
+                                                   float(memory) / count))
+
+
+if __name__ == '__main__':
+    main()
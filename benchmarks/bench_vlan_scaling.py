@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Measure how memory and greenlets grow with the number of VLANs on a
+# switch, as only some of them see packet-ins. Per-VLAN packet-in state
+# should follow the active VLANs, not the configured ones.
+#
+# Usage: python benchmarks/bench_vlan_scaling.py [vlans]
+
+import gc
+import os
+import resource
+import sys
+
+import greenlet
+
+from stubdp import *
+
+from ryu.lib.packet import ipv4
+
+
+def add_vlans(router, vlan_count):
+    for vlan_id in range(VLANID_MIN, VLANID_MIN + vlan_count):
+        router._add_vlan_router(vlan_id)
+
+
+def touch_vlans(router, dp, active_count):
+    # One IPv4 packet-in on each active VLAN, as counted by its penalty box.
+    msg = StubPacketIn(dp, 1)
+    header_list = {IPV4: ipv4.ipv4(src='10.0.0.2', dst='10.0.1.2')}
+    for vlan_id in range(VLANID_MIN, VLANID_MIN + active_count):
+        router[vlan_id]._check_penalty_box_ipv4(msg, header_list)
+
+
+def count_greenlets():
+    return len([obj for obj in gc.get_objects()
+                if isinstance(obj, greenlet.greenlet) and not obj.dead])
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def measure(vlan_count, active_count):
+    # Each router is built in a child process, so that none reuses
+    # memory freed by another.
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        router, dp = make_router()
+        before_rss = rss()
+        before_greenlets = count_greenlets()
+        add_vlans(router, vlan_count)
+        touch_vlans(router, dp, active_count)
+        os.write(w, ('%d %d' % (rss() - before_rss,
+                                count_greenlets() - before_greenlets)).encode())
+        os._exit(0)
+    os.waitpid(pid, 0)
+    memory, greenlets = os.read(r, 64).split()
+    return int(memory), int(greenlets)
+
+
+def main():
+    vlan_count = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    print('%d VLANs configured' % vlan_count)
+    for active_count in (0, vlan_count // 100, vlan_count // 10, vlan_count):
+        memory, greenlets = measure(vlan_count, active_count)
+        print('%5d active %8.1f MB %6.0f bytes/VLAN %6d greenlets' % (
+            active_count, memory / 1e6, float(memory) / vlan_count, greenlets))
+
+
+if __name__ == '__main__':
+    main()
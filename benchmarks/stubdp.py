@@ -0,0 +1,121 @@
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Stub datapath, for driving Plexus routers without a switch attached.
+
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ryu.ofproto import ofproto_v1_0
+from ryu.ofproto import ofproto_v1_0_parser
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+
+from plexus import *
+
+
+PARSERS = {ofproto_v1_0.OFP_VERSION: ofproto_v1_0_parser,
+           ofproto_v1_3.OFP_VERSION: ofproto_v1_3_parser}
+
+
+class StubDatapath(object):
+    # Accepts and counts everything the controller sends; if record is
+    # set, the messages themselves are also kept, in order.
+    def __init__(self, dp_id=1, n_tables=254, ofproto=ofproto_v1_3, record=False):
+        super(StubDatapath, self).__init__()
+        self.id = dp_id
+        self.ofproto = ofproto
+        self.ofproto_parser = PARSERS[ofproto.OFP_VERSION]
+        self.n_tables = n_tables
+        self.xid = 0
+        self.sent = {}
+        self.record = record
+        self.messages = []
+        self.closed = False
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg):
+        name = msg.__class__.__name__
+        self.sent[name] = self.sent.get(name, 0) + 1
+        if self.record:
+            self.messages.append(msg)
+
+    def send_packet_out(self, buffer_id=UINT32_MAX, in_port=None, actions=None, data=None):
+        # As Ryu's Datapath.send_packet_out().
+        self.send_msg(self.ofproto_parser.OFPPacketOut(self, buffer_id, in_port, actions, data))
+
+    def close(self):
+        self.closed = True
+
+    def reset(self):
+        self.sent = {}
+        self.messages = []
+
+
+class StubMatchField(object):
+    def __init__(self, header, value):
+        super(StubMatchField, self).__init__()
+        self.header = header
+        self.value = value
+
+
+class StubPacketIn(object):
+    # Just enough of an OpenFlow 1.0 or 1.3 packet in for the handlers
+    # that take one, alongside an already parsed header list.
+    def __init__(self, dp, in_port, data=None):
+        super(StubPacketIn, self).__init__()
+        self.datapath = dp
+        self.data = data
+        self.buffer_id = UINT32_MAX
+        self.reason = dp.ofproto.OFPR_NO_MATCH
+        self.total_len = len(data) if data is not None else 0
+        # OpenFlow 1.0 gives the in_port on its own; 1.3, in the match.
+        self.in_port = in_port
+        self.match = StubMatch([StubMatchField(ofproto_v1_3.OXM_OF_IN_PORT, in_port)])
+
+
+class StubMatch(object):
+    def __init__(self, fields):
+        super(StubMatch, self).__init__()
+        self.fields = fields
+
+
+def make_ports(count, ofproto=ofproto_v1_3):
+    ports = []
+    for port_no in range(1, count + 1):
+        hw_addr = '02:00:00:00:%02x:%02x' % (port_no >> 8, port_no & 0xff)
+        if ofproto.OFP_VERSION == ofproto_v1_0.OFP_VERSION:
+            ports.append(ofproto_v1_0_parser.OFPPhyPort(port_no, hw_addr, 'port%d' % port_no,
+                                                        0, 0, 0, 0, 0, 0))
+        else:
+            ports.append(ofproto_v1_3_parser.OFPPort(port_no, hw_addr, 'port%d' % port_no,
+                                                     0, 0, 0, 0, 0, 0, 0, 0))
+    return ports
+
+
+def make_router(port_count=4, flow_table_size=1000000, ofproto=ofproto_v1_3, record=False):
+    # Imported here, so that callers can set up configuration first.
+    from plexus.router import Router
+
+    CONF.set_override('flow_table_size', flow_table_size, group='plexus')
+    logger = logging.getLogger('plexus.benchmark')
+    logger.setLevel(logging.WARNING)
+    dp = StubDatapath(ofproto=ofproto, record=record)
+    router = Router(dp, make_ports(port_count, ofproto), {}, logger)
+    return router, dp
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Emulate many OpenFlow 1.0 or 1.3 switches connecting to a running
+# Plexus at once, as after a controller restart or network outage.
+#
+# Each switch answers the handshake, echo, stats/multipart, role and
+# barrier requests, and counts the flow mods and packet outs sent to it.
+# A switch is taken as programmed once it has had at least MIN_FLOW_MODS
+# flow mods and then none for SETTLE_TIME; its time is that of its last
+# flow mod. Once programmed, each switch sends packet-ins (ARP requests
+# for ARP_TARGET). If the controller's PID is given, its peak memory and
+# CPU use are sampled throughout.
+#
+# Usage: python benchmarks/switch_emulator.py [switches] [of_version] [controller_pid]
+#                                             [packet_ins] [host:port]
+
+import os
+import resource
+import struct
+import sys
+import time
+
+import eventlet
+
+from stubdp import *
+
+from ryu.lib.packet import arp
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import packet
+
+MIN_FLOW_MODS = 2
+SETTLE_TIME = 2.0  # sec
+STORM_TIMEOUT = 300  # sec
+SAMPLE_INTERVAL = 0.1  # sec
+PORT_COUNT = 48
+TABLE_MAX_ENTRIES = 2000
+ARP_TARGET = '10.0.0.1'
+
+# Message layouts, after the common header.
+OFP_HEADER = '!BBHI'
+OFP_HEADER_SIZE = struct.calcsize(OFP_HEADER)
+V1_0_FEATURES = '!QIB3xII'
+V1_0_PHY_PORT = '!H6s16sIIIIII'
+V1_0_STATS = '!HH'
+V1_0_TABLE_STATS = '!B3x32sIIIQQ'
+V1_0_PACKET_IN = '!IHHBx'
+V1_3_FEATURES = '!QIBB2xII'
+V1_3_PORT = '!I4x6s2x16sIIIIIIII'
+V1_3_MULTIPART = '!HH4x'
+V1_3_ROLE = '!I4xQ'
+V1_3_PACKET_IN = '!IHBBQ'
+# OXM match on in_port alone, padded to 8 bytes, then 2 bytes of padding.
+V1_3_INPORT_MATCH = '!HHII4x2x'
+V1_3_OXM_IN_PORT = 0x80000004
+
+VERSIONS = {'1.0': ofproto_v1_0, '1.3': ofproto_v1_3}
+
+
+class EmulatedSwitch(object):
+    def __init__(self, dpid, ofproto, address, packet_in_count):
+        super(EmulatedSwitch, self).__init__()
+        self.dpid = dpid
+        self.ofproto = ofproto
+        self.address = address
+        self.packet_in_count = packet_in_count
+        self.sock = None
+        self.xid = 0
+        self.connected_at = None
+        self.closed_at = None
+        self.error = None
+        self.last_flow_mod = None
+        self.programmed_at = None
+        self.packet_ins_sent = 0
+        # Received message counts, by type; and, after the first
+        # packet-in was sent, separately.
+        self.received = {}
+        self.received_after_packet_in = {}
+
+    def run(self):
+        try:
+            self.sock = eventlet.connect(self.address)
+            self.connected_at = time.time()
+            self.send(self.ofproto.OFPT_HELLO)
+            while True:
+                header = self._recv(OFP_HEADER_SIZE)
+                version, msg_type, msg_len, xid = struct.unpack(OFP_HEADER, header)
+                self.handle(msg_type, xid, self._recv(msg_len - OFP_HEADER_SIZE))
+        except EOFError:
+            pass
+        except Exception as e:
+            self.error = e
+        self.closed_at = time.time()
+
+    def _recv(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def send(self, msg_type, body=b'', xid=None):
+        if xid is None:
+            self.xid += 1
+            xid = self.xid
+        self.sock.sendall(struct.pack(OFP_HEADER, self.ofproto.OFP_VERSION, msg_type,
+                                      OFP_HEADER_SIZE + len(body), xid) + body)
+
+    def _count(self, msg_type):
+        counts = self.received_after_packet_in if self.packet_ins_sent else self.received
+        counts[msg_type] = counts.get(msg_type, 0) + 1
+
+    def handle(self, msg_type, xid, body):
+        ofp = self.ofproto
+        self._count(msg_type)
+        if msg_type == ofp.OFPT_ECHO_REQUEST:
+            self.send(ofp.OFPT_ECHO_REPLY, body, xid)
+        elif msg_type == ofp.OFPT_FEATURES_REQUEST:
+            self.send(ofp.OFPT_FEATURES_REPLY, self.features(), xid)
+        elif msg_type == ofp.OFPT_GET_CONFIG_REQUEST:
+            self.send(ofp.OFPT_GET_CONFIG_REPLY, struct.pack('!HH', 0, 128), xid)
+        elif msg_type == ofp.OFPT_BARRIER_REQUEST:
+            self.send(ofp.OFPT_BARRIER_REPLY, b'', xid)
+        elif msg_type == ofp.OFPT_FLOW_MOD:
+            self.last_flow_mod = time.time()
+        elif ofp is ofproto_v1_0 and msg_type == ofp.OFPT_STATS_REQUEST:
+            stats_type, flags = struct.unpack_from(V1_0_STATS, body)
+            self.send(ofp.OFPT_STATS_REPLY,
+                      struct.pack(V1_0_STATS, stats_type, 0) + self.stats(stats_type), xid)
+        elif ofp is ofproto_v1_3 and msg_type == ofp.OFPT_MULTIPART_REQUEST:
+            stats_type, flags = struct.unpack_from(V1_3_MULTIPART, body)
+            self.send(ofp.OFPT_MULTIPART_REPLY,
+                      struct.pack(V1_3_MULTIPART, stats_type, 0) + self.stats(stats_type), xid)
+        elif ofp is ofproto_v1_3 and msg_type == ofp.OFPT_ROLE_REQUEST:
+            role, generation_id = struct.unpack_from(V1_3_ROLE, body)
+            self.send(ofp.OFPT_ROLE_REPLY, struct.pack(V1_3_ROLE, role, generation_id), xid)
+
+    def ports(self):
+        ports = []
+        for port_no in range(1, PORT_COUNT + 1):
+            hw_addr = mac_lib.haddr_to_bin('02:%02x:%02x:%02x:%02x:%02x' % (
+                (self.dpid >> 16) & 0xff, (self.dpid >> 8) & 0xff, self.dpid & 0xff,
+                port_no >> 8, port_no & 0xff))
+            name = ('port%d' % port_no).encode()
+            if self.ofproto is ofproto_v1_0:
+                ports.append(struct.pack(V1_0_PHY_PORT, port_no, hw_addr, name,
+                                         0, 0, 0, 0, 0, 0))
+            else:
+                ports.append(struct.pack(V1_3_PORT, port_no, hw_addr, name,
+                                         0, 0, 0, 0, 0, 0, 10000000, 10000000))
+        return b''.join(ports)
+
+    def features(self):
+        if self.ofproto is ofproto_v1_0:
+            # Ports are listed here at OpenFlow 1.0, and asked for apart at 1.3.
+            return struct.pack(V1_0_FEATURES, self.dpid, 256, 1, 0, 0xfff) + self.ports()
+        return struct.pack(V1_3_FEATURES, self.dpid, 256, 254, 0, 0, 0)
+
+    def stats(self, stats_type):
+        # No flows; one table, at OpenFlow 1.0; the ports, at 1.3.
+        # Anything else is answered with an empty reply.
+        if self.ofproto is ofproto_v1_0 and stats_type == ofproto_v1_0.OFPST_TABLE:
+            return struct.pack(V1_0_TABLE_STATS, 0, b'classifier', 0x3fffff,
+                               TABLE_MAX_ENTRIES, 0, 0, 0)
+        if self.ofproto is ofproto_v1_3 and stats_type == ofproto_v1_3.OFPMP_PORT_DESC:
+            return self.ports()
+        return b''
+
+    def send_packet_ins(self):
+        for n in range(self.packet_in_count):
+            in_port = 1 + n % PORT_COUNT
+            src_mac = '02:ff:%02x:%02x:%02x:%02x' % ((self.dpid >> 8) & 0xff, self.dpid & 0xff,
+                                                     (n >> 8) & 0xff, n & 0xff)
+            pkt = packet.Packet()
+            pkt.add_protocol(ethernet.ethernet(mac_lib.BROADCAST_STR, src_mac, ether.ETH_TYPE_ARP))
+            pkt.add_protocol(arp.arp(opcode=arp.ARP_REQUEST, src_mac=src_mac,
+                                     src_ip='10.0.%d.%d' % (1 + (n >> 8) % 254, 1 + n % 254),
+                                     dst_mac=mac_lib.DONTCARE_STR, dst_ip=ARP_TARGET))
+            pkt.serialize()
+            data = bytes(pkt.data)
+            if self.ofproto is ofproto_v1_0:
+                body = struct.pack(V1_0_PACKET_IN, UINT32_MAX, len(data), in_port,
+                                   ofproto_v1_0.OFPR_NO_MATCH)
+            else:
+                body = (struct.pack(V1_3_PACKET_IN, UINT32_MAX, len(data),
+                                    ofproto_v1_3.OFPR_NO_MATCH, 0, 0) +
+                        struct.pack(V1_3_INPORT_MATCH, ofproto_v1_3.OFPMT_OXM, 12,
+                                    V1_3_OXM_IN_PORT, in_port))
+            self.packet_ins_sent += 1
+            self.send(self.ofproto.OFPT_PACKET_IN, body + data)
+            eventlet.sleep(0)
+
+
+class ProcessSampler(object):
+    # Peak memory, and CPU time, of another process, from /proc.
+    def __init__(self, pid):
+        super(ProcessSampler, self).__init__()
+        self.pid = pid
+        self.peak_rss = 0
+        self.peak_cpu = 0.0
+        self.start_cpu = self.cpu_time()
+        self.last = (time.time(), self.start_cpu)
+
+    def cpu_time(self):
+        with open('/proc/%d/stat' % self.pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+    def sample(self):
+        with open('/proc/%d/statm' % self.pid) as f:
+            rss = int(f.read().split()[1]) * resource.getpagesize()
+        self.peak_rss = max(self.peak_rss, rss)
+        now, cpu = time.time(), self.cpu_time()
+        last_time, last_cpu = self.last
+        if now > last_time:
+            self.peak_cpu = max(self.peak_cpu, (cpu - last_cpu) / (now - last_time))
+        self.last = (now, cpu)
+
+    @property
+    def cpu_used(self):
+        return self.last[1] - self.start_cpu
+
+
+def is_programmed(switch, now):
+    return (switch.received.get(switch.ofproto.OFPT_FLOW_MOD, 0) >= MIN_FLOW_MODS and
+            now - switch.last_flow_mod >= SETTLE_TIME)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(p / 100.0 * (len(values) - 1))]
+
+
+def main():
+    switch_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    version = sys.argv[2] if len(sys.argv) > 2 else '1.3'
+    ofproto = VERSIONS[version]
+    pid = int(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3] != '-' else None
+    packet_in_count = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+    host, port = (sys.argv[5] if len(sys.argv) > 5 else '127.0.0.1:6633').rsplit(':', 1)
+
+    sampler = ProcessSampler(pid) if pid is not None else None
+    switches = [EmulatedSwitch(dpid, ofproto, (host, int(port)), packet_in_count)
+                for dpid in range(1, switch_count + 1)]
+    start = time.time()
+    threads = [eventlet.spawn(switch.run) for switch in switches]
+
+    # Watch for each switch to be programmed, then have it send packet-ins.
+    injectors = []
+    pending = list(switches)
+    while pending and time.time() - start < STORM_TIMEOUT:
+        eventlet.sleep(SAMPLE_INTERVAL)
+        if sampler is not None:
+            sampler.sample()
+        now = time.time()
+        for switch in list(pending):
+            if switch.closed_at is not None:
+                pending.remove(switch)
+            elif switch.last_flow_mod is not None and is_programmed(switch, now):
+                switch.programmed_at = switch.last_flow_mod
+                pending.remove(switch)
+                injectors.append(eventlet.spawn(switch.send_packet_ins))
+
+    # Give the controller time to answer the packet-ins.
+    for injector in injectors:
+        injector.wait()
+    deadline = time.time() + SETTLE_TIME
+    while time.time() < deadline:
+        eventlet.sleep(SAMPLE_INTERVAL)
+        if sampler is not None:
+            sampler.sample()
+
+    connected = [switch for switch in switches if switch.connected_at is not None]
+    programmed = [switch for switch in switches if switch.programmed_at is not None]
+    print('%d switches, OpenFlow %s' % (switch_count, version))
+    if connected:
+        print('connected       %d, all within %.2fs' % (
+            len(connected), max(switch.connected_at for switch in connected) - start))
+    failed = [switch for switch in switches if switch.error is not None]
+    if failed:
+        print('failed          %d (e.g. %s)' % (len(failed), failed[0].error))
+    if programmed:
+        times = [switch.programmed_at - switch.connected_at for switch in programmed]
+        print('programmed      %d, all %.2fs after the first connect; '
+              'per switch p50 %.2fs p99 %.2fs max %.2fs' % (
+                  len(programmed), max(switch.programmed_at for switch in programmed) - start,
+                  percentile(times, 50), percentile(times, 99), max(times)))
+
+    def total(counts_name, msg_type):
+        return sum(getattr(switch, counts_name).get(msg_type, 0) for switch in switches)
+
+    ofp = ofproto
+    stats_request = ofp.OFPT_STATS_REQUEST if ofp is ofproto_v1_0 else ofp.OFPT_MULTIPART_REQUEST
+    print('during connect  flow mods %d, stats requests %d, barriers %d, echoes %d' % (
+        total('received', ofp.OFPT_FLOW_MOD), total('received', stats_request),
+        total('received', ofp.OFPT_BARRIER_REQUEST), total('received', ofp.OFPT_ECHO_REQUEST)))
+    print('packet-ins      %d sent; answered with %d packet outs, %d flow mods' % (
+        sum(switch.packet_ins_sent for switch in switches),
+        total('received_after_packet_in', ofp.OFPT_PACKET_OUT),
+        total('received_after_packet_in', ofp.OFPT_FLOW_MOD)))
+    if sampler is not None:
+        print('controller      peak RSS %.1f MB, CPU %.2fs (peak %.0f%%)' % (
+            sampler.peak_rss / 1e6, sampler.cpu_used, sampler.peak_cpu * 100))
+
+    for thread in threads:
+        thread.kill()
+    return 0 if len(programmed) == switch_count else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Minimal stand-in for Switchboard's state callback, for exercising
+# Plexus' state restore without a Switchboard instance.
+#
+# Usage: python benchmarks/switchboard_stub.py state.json [port] [delay]
+#
+# Point Plexus at it with, in the [switchboard] configuration section:
+#   state_url = http://127.0.0.1:<port>/sdn_callback/restore_state
+#
+# state.json holds: {"switches": {"<dpid>" or "all": {"<vlan_id>": {
+#   "address": [...], "route": [...], "dhcp_servers": [...]}}}}
+# Each request served is logged, so that coalescing of fetches by
+# joining switches can be checked.
+
+import BaseHTTPServer
+import SocketServer
+import sys
+import time
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive
+    state = '{}'
+    delay = 0.0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = self.state
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    StubHandler.state = open(sys.argv[1]).read()
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8081
+    StubHandler.delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    server = StubServer(('127.0.0.1', port), StubHandler)
+    print('Serving Switchboard state on port %d' % port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -84,14 +84,43 @@ PENALTY_BOX_IPV4_DISCONNECT_THRESHOLD = (PENALTY_BOX_ENTRY_IPV4_MAXHITS * 2)
 # Hard timeout for IPv4 matching penalty box rules, in seconds.
 PENALTY_BOX_IPV4_HARD_TIMEOUT = 15
 
+# Hard timeout for drop flows of unroutable destinations, in seconds.
+NEGATIVE_ROUTE_HARD_TIMEOUT = 10
+# Maximum number of drop flows of unroutable destinations per VlanRouter.
+NEGATIVE_ROUTE_BUDGET = 256
+# Shortest prefix to which a drop flow of an unroutable destination is widened.
+NEGATIVE_ROUTE_MIN_NETMASK = 16
+
+# Keys tracked per datapath, by the heavy hitter sketches of packet-ins
+# by in_port and by source IP.
+HEAVY_HITTER_CAPACITY = 64
+# Seconds over which heavy hitter packet-in rates are measured.
+HEAVY_HITTER_WINDOW = 3
+# Packet-ins per second from one source IP, above which it is blocked.
+HEAVY_HITTER_SOURCE_MAXRATE = 100
+# Hard timeout for heavy hitter source blocking rules, in seconds.
+HEAVY_HITTER_HARD_TIMEOUT = 15
+# Number of top talkers reported, of each kind.
+HEAVY_HITTER_REPORT_COUNT = 10
+
 # Time, in seconds, that a cached MAC address should be retained after last update
 MAC_ADDRESS_TTL = 300
 # Time, in seconds, between MAC address table garbage collections
 MAC_ADDRESS_GC_INTERVAL = 15
 
 ARP_REPLY_TIMER = 10  # sec
-OFP_REPLY_TIMER = 1.0  # sec
+OFP_REPLY_TIMER = 1.0  # sec; initial reply timeout, before any RTT is measured
+OFP_REPLY_TIMER_MIN = 0.25  # sec
+OFP_REPLY_TIMER_MAX = 10.0  # sec
 CHK_ROUTING_TBL_INTERVAL = 30  # Seconds before cyclically checking reachability of all switch-defined routers
+GATEWAY_PROBE_RATE = 200  # ARP requests sent per second, at most, by gateway probes of all switches
+GATEWAY_PROBE_FAILURES = 3  # Unanswered probes, ARP_REPLY_TIMER apart, before a gateway is unreachable
+GATEWAY_PROBE_BACKOFF_MAX = 300  # Maximum seconds between probes of an unreachable gateway
+# Gateway liveness states (see GatewayStateTable)
+GATEWAY_UNKNOWN = 'unknown'
+GATEWAY_REACHABLE = 'reachable'
+GATEWAY_STALE = 'stale'
+GATEWAY_UNREACHABLE = 'unreachable'
 
 SWITCHID_PATTERN = dpid_lib.DPID_PATTERN + r'|all'
 VLANID_PATTERN = r'[0-9]{1,4}|all'
@@ -106,10 +135,17 @@ DHCP_CLIENT_PORT = 68
 COOKIE_DEFAULT_ID = 0
 COOKIE_SHIFT_VLANID = 32
 COOKIE_SHIFT_ROUTEID = 16
+COOKIE_MASK_VLANID = UINT64_MAX ^ UINT32_MAX
+COOKIE_MASK_ROUTEID = UINT32_MAX ^ UINT16_MAX
+COOKIE_MASK_ADDRESSID = UINT16_MAX
 
 INADDR_ANY_BASE = '0.0.0.0'
 INADDR_ANY_MASK = '0'
 INADDR_ANY = INADDR_ANY_BASE + '/' + INADDR_ANY_MASK
+# Routing and address tables are keyed by prefix_key(); this is 0.0.0.0/0.
+INADDR_ANY_KEY = 0
+PREFIX_KEY_SHIFT = 6
+PREFIX_KEY_MASK = (1 << PREFIX_KEY_SHIFT) - 1
 
 INADDR_BROADCAST_BASE = '255.255.255.255'
 INADDR_BROADCAST_MASK = '32'
@@ -140,6 +176,32 @@ REST_SOURCE = 'source'
 REST_BARE = 'bare'
 REST_WIPE = 'wipe'
 REST_DHCP = 'dhcp_servers'
+REST_FLOWS_SAVED = 'route_flows_saved'
+REST_FLOW_TABLE = 'flow_table'
+REST_BUDGET = 'budget'
+REST_OCCUPANCY = 'occupancy'
+REST_EVICTIONS = 'evictions'
+REST_TOP_TALKERS = 'top_talkers'
+REST_RATE = 'rate'
+REST_SWITCHES = 'switches'
+REST_SEQ = 'seq'
+REST_SINCE = 'since'
+REST_TIMEOUT = 'timeout'
+REST_TIME = 'time'
+REST_EVENT = 'event'
+REST_EVENTS = 'events'
+REST_RESYNC = 'resync'
+REST_JOURNAL_ID = 'journal_id'
+REST_PORT_NO = 'port_no'
+REST_IN_PORT = 'in_port'
+REST_LIMIT = 'limit'
+REST_CURSOR = 'cursor'
+REST_NEXT_CURSOR = 'next_cursor'
+REST_FIELDS = 'fields'
+# Fields that may be selected in GET responses.
+REST_ADDRESS_FIELDS = frozenset([REST_ADDRESSID, REST_ADDRESS])
+REST_ROUTE_FIELDS = frozenset([REST_ROUTEID, REST_DESTINATION, REST_GATEWAY,
+                               REST_GATEWAY_MAC, REST_SOURCE])
 
 PRIORITY_VLAN_SHIFT = 1000
 PRIORITY_NETMASK_SHIFT = 32
@@ -158,6 +220,75 @@ PRIORITY_PENALTYBOX = 8
 PRIORITY_TYPE_ROUTE = 'priority_route'
 
 SWITCHBOARD_REPLY_TIMEOUT = 10
+SWITCHBOARD_STATE_TTL = 10  # Seconds a fetched Switchboard state is reused for joining switches
+SWITCHBOARD_POOL_SIZE = 4  # Keep-alive connections kept open to Switchboard
+
+# Maximum number of routers accessed concurrently by a single REST request
+MAX_CONCURRENT_ROUTER_ACCESS = 32
+
+# Flow classes, for flow table occupancy accounting.
+FLOW_CLASS_ROUTE = 'route'
+FLOW_CLASS_PACKETIN = 'packet_in'
+FLOW_CLASS_HOST = 'host'
+FLOW_CLASS_L2 = 'l2'
+FLOW_CLASS_PENALTY = 'penalty'
+FLOW_CLASS_NEGATIVE = 'negative'
+# Flow classes that may be evicted when a flow table nears capacity,
+# least recently used first.
+FLOW_CLASSES_EVICTABLE = (FLOW_CLASS_HOST, FLOW_CLASS_L2, FLOW_CLASS_NEGATIVE)
+# Flow classes for which the switch is asked to report flow removal.
+FLOW_CLASSES_NOTIFY_REMOVAL = (FLOW_CLASS_ROUTE, FLOW_CLASS_HOST, FLOW_CLASS_L2)
+# Maximum number of flows evicted at once, when a flow table nears capacity.
+FLOW_EVICTION_BATCH = 16
+# Flow classes of flows adopted from a previous run, by base priority
+# (see OfCtl.get_adopted_flow_class()); all others are packet in flows.
+FLOW_CLASSES_ADOPTED = {PRIORITY_IMPLICIT_ROUTING: FLOW_CLASS_HOST,
+                        PRIORITY_L2_SWITCHING: FLOW_CLASS_L2,
+                        PRIORITY_PENALTYBOX: FLOW_CLASS_PENALTY}
+
+# Change journal, for the change-feed endpoint.
+CHANGE_JOURNAL_SIZE = 4096  # Events retained, before clients must resync
+CHANGE_FEED_TIMEOUT = 30  # Default seconds a change-feed request waits for events
+CHANGE_FEED_MAX_TIMEOUT = 300
+# Change journal event types
+EVENT_ROUTER_JOIN = 'router_join'
+EVENT_ROUTER_LEAVE = 'router_leave'
+EVENT_PORT_UP = 'port_up'
+EVENT_PORT_DOWN = 'port_down'
+EVENT_ADDRESS_ADD = 'address_add'
+EVENT_ADDRESS_DELETE = 'address_delete'
+EVENT_ROUTE_ADD = 'route_add'
+EVENT_ROUTE_DELETE = 'route_delete'
+EVENT_GATEWAY_RESOLVED = 'gateway_resolved'
+EVENT_GATEWAY_LOST = 'gateway_lost'
+EVENT_PENALTY_BOX = 'penalty_box'
+EVENT_VLAN_ADD = 'vlan_add'
+EVENT_VLAN_DELETE = 'vlan_delete'
+EVENT_DHCP_SET = 'dhcp_set'
+# Change journal events that alter state set over REST; these are saved to disk.
+EVENTS_PERSISTED = (EVENT_VLAN_ADD, EVENT_VLAN_DELETE,
+                    EVENT_ADDRESS_ADD, EVENT_ADDRESS_DELETE,
+                    EVENT_ROUTE_ADD, EVENT_ROUTE_DELETE,
+                    EVENT_DHCP_SET)
+
+# Local state persistence, for warm restart.
+STATE_SNAPSHOT_FILE = 'snapshot.json'
+STATE_JOURNAL_FILE = 'journal.jsonl'
+STATE_FLUSH_INTERVAL = 1.0  # Seconds between batched journal writes
+STATE_SNAPSHOT_THRESHOLD = 10000  # Journal records written before a new snapshot
+STATE_SNAPSHOT_ENCODE_DEPTH = 4  # Dict levels of a snapshot taken apart when encoding it, down to the address and route tables
+STATE_SNAPSHOT_ENCODE_CHUNK = 500  # Table entries encoded at a time in a snapshot
+STATE_DATABASE_FILE = 'state.sqlite'
+STATE_DATABASE_TIMEOUT = 30  # Seconds to wait for another worker's lock on the database
+STATE_ROLE_GENERATION_FILE = 'role_generation'
+# Values of state_backend
+STATE_BACKEND_FILE = 'file'
+STATE_BACKEND_SQLITE = 'sqlite'
+STATE_BACKEND_MEMORY = 'memory'
+
+# REST front end, for multiple workers.
+FRONTEND_REPLY_TIMEOUT = 60  # Seconds to wait for a worker to answer
+FRONTEND_POOL_SIZE = 16  # Keep-alive connections kept open to each worker
 
 CONF = cfg.CONF
 plexus_configuration_group = 'plexus'
@@ -167,8 +298,44 @@ plexus_backdoor_opt = cfg.BoolOpt('backdoor_enable',
 plexus_backdoor_port_opt = cfg.IntOpt('backdoor_listen_port',
                                       default = 3000,
                                       help='Port on which the backdoor REPL should listen, on the local interface')
+plexus_route_aggregation_opt = cfg.BoolOpt('route_aggregation',
+                                           default = True,
+                                           help = 'Merge routes sharing a next hop into covering prefixes, before installing flows')
+plexus_flow_table_size_opt = cfg.IntOpt('flow_table_size',
+                                        default = 0,
+                                        help = 'Number of flows each switch can hold; 0 to discover from the switch')
+plexus_flow_table_high_water_opt = cfg.FloatOpt('flow_table_high_water',
+                                                default = 0.9,
+                                                help = 'Fraction of the flow table size at which flows start being evicted')
 CONF.register_opt(plexus_backdoor_opt, group = plexus_configuration_group)
 CONF.register_opt(plexus_backdoor_port_opt, group = plexus_configuration_group)
+CONF.register_opt(plexus_route_aggregation_opt, group = plexus_configuration_group)
+CONF.register_opt(plexus_flow_table_size_opt, group = plexus_configuration_group)
+plexus_state_persistence_opt = cfg.BoolOpt('state_persistence',
+                                           default = True,
+                                           help = 'Save routing state to local disk, and restore it when switches join')
+plexus_state_directory_opt = cfg.StrOpt('state_directory',
+                                        default = '/var/lib/plexus',
+                                        help = 'Directory in which routing state is saved')
+CONF.register_opt(plexus_flow_table_high_water_opt, group = plexus_configuration_group)
+plexus_adopt_flows_opt = cfg.BoolOpt('adopt_flows',
+                                     default = True,
+                                     help = 'When a switch with saved state joins, keep its flows that match the restored state, rather than clearing them all')
+plexus_state_backend_opt = cfg.StrOpt('state_backend',
+                                      default = STATE_BACKEND_FILE,
+                                      help = 'Where routing state is saved: file (private to one worker), sqlite (shared among workers) or memory (not saved)')
+plexus_worker_count_opt = cfg.IntOpt('worker_count',
+                                     default = 1,
+                                     help = 'Number of worker processes among which switches are divided, by DPID')
+plexus_worker_index_opt = cfg.IntOpt('worker_index',
+                                     default = 0,
+                                     help = 'Index of this worker process, from 0 to worker_count - 1')
+CONF.register_opt(plexus_state_persistence_opt, group = plexus_configuration_group)
+CONF.register_opt(plexus_state_directory_opt, group = plexus_configuration_group)
+CONF.register_opt(plexus_adopt_flows_opt, group = plexus_configuration_group)
+CONF.register_opt(plexus_state_backend_opt, group = plexus_configuration_group)
+CONF.register_opt(plexus_worker_count_opt, group = plexus_configuration_group)
+CONF.register_opt(plexus_worker_index_opt, group = plexus_configuration_group)
 
 switchboard_configuration_group = 'switchboard'
 switchboard_stateurl_opt = cfg.StrOpt('state_url',
@@ -183,3 +350,17 @@ switchboard_password_opt = cfg.StrOpt('password',
 CONF.register_opt(switchboard_stateurl_opt, group = switchboard_configuration_group)
 CONF.register_opt(switchboard_username_opt, group = switchboard_configuration_group)
 CONF.register_opt(switchboard_password_opt, group = switchboard_configuration_group)
+
+frontend_configuration_group = 'frontend'
+frontend_listen_host_opt = cfg.StrOpt('listen_host',
+                                      default = '127.0.0.1',
+                                      help = 'Address on which the REST front end listens')
+frontend_listen_port_opt = cfg.IntOpt('listen_port',
+                                      default = 8080,
+                                      help = 'Port on which the REST front end listens')
+frontend_workers_opt = cfg.ListOpt('workers',
+                                   default = [],
+                                   help = 'REST API URL of each worker, in order of worker_index')
+CONF.register_opt(frontend_listen_host_opt, group = frontend_configuration_group)
+CONF.register_opt(frontend_listen_port_opt, group = frontend_configuration_group)
+CONF.register_opt(frontend_workers_opt, group = frontend_configuration_group)
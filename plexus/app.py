@@ -13,10 +13,14 @@
 
 # Plexus controller application entry point/main program
 
-import requests
-import urllib3.contrib.pyopenssl
+import hashlib
+import json
+import os
+import sys
 
-import eventlet.backdoor as backdoor
+import six
+from eventlet import greenpool
+from webob import Response
 
 from ryu.app.wsgi import ControllerBase
 from ryu.app.wsgi import WSGIApplication
@@ -32,6 +36,9 @@ from ryu.lib import hub
 
 from plexus import *
 from plexus.router import *
+from plexus.schema import *
+from plexus.state import *
+from plexus.switchboard import *
 from plexus.util import *
 
 
@@ -49,8 +56,14 @@ class Plexus(app_manager.RyuApp):
         # logger configure
         PlexusController.set_logger(self.logger)
 
+        # Load routing state saved by a previous run, and keep saving it.
+        if CONF.plexus.state_persistence:
+            backend = make_state_backend(self.logger)
+            PlexusController.set_state_store(StateStore(backend, self.logger))
+
         # Set up backdoor REPL, if requested.
         if CONF.plexus.backdoor_enable:
+            import eventlet.backdoor as backdoor
             hub.spawn(backdoor.backdoor_server, hub.listen(('localhost', CONF.plexus.backdoor_listen_port)))
 
         wsgi = kwargs['wsgi']
@@ -90,6 +103,38 @@ class Plexus(app_manager.RyuApp):
                        requirements=requirements,
                        action='delete_vlan_data',
                        conditions=dict(method=['DELETE']))
+        # For the change feed
+        path = '/router/events'
+        mapper.connect('router', path, controller=PlexusController,
+                       action='get_events',
+                       conditions=dict(method=['GET']))
+        # For bulk setting of address, routing and DHCP data
+        path = '/router/{switch_id}/bulk'
+        mapper.connect('router', path, controller=PlexusController,
+                       requirements=requirements,
+                       action='set_bulk_data',
+                       conditions=dict(method=['POST']))
+        path = '/router/{switch_id}/{vlan_id}/bulk'
+        mapper.connect('router', path, controller=PlexusController,
+                       requirements=requirements,
+                       action='set_vlan_bulk_data',
+                       conditions=dict(method=['POST']))
+        # For flow table occupancy
+        path = '/router/{switch_id}/flow_table'
+        mapper.connect('router', path, controller=PlexusController,
+                       requirements=requirements,
+                       action='get_flow_table',
+                       conditions=dict(method=['GET']))
+        # For packet-in top talkers
+        path = '/router/{switch_id}/top_talkers'
+        mapper.connect('router', path, controller=PlexusController,
+                       requirements=requirements,
+                       action='get_top_talkers',
+                       conditions=dict(method=['GET']))
+
+    def close(self):
+        super(Plexus, self).close()
+        PlexusController.close_state_store()
 
     @set_ev_cls(dpset.EventDP, dpset.DPSET_EV_DISPATCHER)
     def datapath_handler(self, ev):
@@ -130,17 +175,15 @@ class Plexus(app_manager.RyuApp):
         if (dp.id not in self.waiters
                 or msg.xid not in self.waiters[dp.id]):
             return
-        event, msgs = self.waiters[dp.id][msg.xid]
-        msgs.append(msg)
+        future = self.waiters[dp.id][msg.xid]
 
         if ofproto_v1_3.OFP_VERSION == dp.ofproto.OFP_VERSION:
             more = dp.ofproto.OFPMPF_REPLY_MORE
         else:
             more = dp.ofproto.OFPSF_REPLY_MORE
-        if msg.flags & more:
-            return
-        del self.waiters[dp.id][msg.xid]
-        event.set()
+        if not (msg.flags & more):
+            del self.waiters[dp.id][msg.xid]
+        future.add_reply(msg, more=bool(msg.flags & more))
 
     # for OpenFlow version1.0
     @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
@@ -152,41 +195,131 @@ class Plexus(app_manager.RyuApp):
     def stats_reply_handler_v1_2(self, ev):
         self._stats_reply_handler(ev)
 
-    #TODO: Update routing table when port status is changed, or ports are added/removed.
+    # for flow table capacity discovery, OpenFlow version1.0
+    @set_ev_cls(ofp_event.EventOFPTableStatsReply, MAIN_DISPATCHER)
+    def table_stats_reply_handler(self, ev):
+        self._stats_reply_handler(ev)
+
+    # for flow table capacity discovery, OpenFlow version1.3
+    @set_ev_cls(ofp_event.EventOFPTableFeaturesStatsReply, MAIN_DISPATCHER)
+    def table_features_stats_reply_handler(self, ev):
+        self._stats_reply_handler(ev)
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def flow_removed_handler(self, ev):
+        PlexusController.flow_removed_handler(ev.msg)
 
 
 class PlexusController(ControllerBase):
     _ROUTER_LIST = {}
     _LOGGER = None
+    # Keeps ETags from one run of the controller from matching the next.
+    _BOOT_ID = os.urandom(8)
+    _JOURNAL = ChangeJournal()
+    # Gateway probes of all switches are paced together.
+    _PROBE_SCHEDULER = GatewayProbeScheduler()
 
     def __init__(self, req, link, data, **config):
         super(PlexusController, self).__init__(req, link, data, **config)
         self.waiters = data['waiters']
 
+    _SWITCHBOARD = None
+    _STATE_STORE = None
+
     @classmethod
     def set_logger(cls, logger):
         cls._LOGGER = logger
+        cls._SWITCHBOARD = SwitchboardClient(logger)
+
+    @classmethod
+    def set_state_store(cls, state_store):
+        cls._STATE_STORE = state_store
+        cls._JOURNAL.listeners.append(state_store.journal_listener)
+
+    @classmethod
+    def close_state_store(cls):
+        if cls._STATE_STORE is not None:
+            cls._JOURNAL.listeners.remove(cls._STATE_STORE.journal_listener)
+            cls._STATE_STORE.close()
+            cls._STATE_STORE = None
 
     @classmethod
     def register_router(cls, dp, ports, waiters):
-        logger = RouterLoggerAdapter(cls._LOGGER, {'sw_id': dpid_lib.dpid_to_str(dp.id)})
+        dpid_str = dpid_lib.dpid_to_str(dp.id)
+        logger = RouterLoggerAdapter(cls._LOGGER, {'sw_id': dpid_str})
+
+        # With several workers, each routes only the switches it owns.
+        if CONF.plexus.worker_count > 1:
+            master = (get_dpid_worker(dpid_str, CONF.plexus.worker_count) ==
+                      CONF.plexus.worker_index)
+            try:
+                generation_id = next_role_generation_id(CONF.plexus.state_directory)
+                OfCtl.factory(dp, logger).set_role(master, generation_id)
+            except OFPUnknownVersion as message:
+                logger.error(str(message))
+                return
+            except EnvironmentError:
+                logger.exception('Unable to number role request!')
+                return
+            if not master:
+                logger.info('Switch belongs to another worker.')
+                return
+
+        if cls._STATE_STORE is not None:
+            cls._STATE_STORE.refresh_switch(dpid_str)
+        restore = (cls._STATE_STORE is not None and
+                   cls._STATE_STORE.has_switch(dpid_str))
+        # With state to restore, the switch's flows can be kept, and forwarding
+        # continues undisturbed; otherwise, they must all go.
+        adopt = restore and CONF.plexus.adopt_flows
         try:
-            router = Router(dp, ports, waiters, logger)
+            router = Router(dp, ports, waiters, logger, cls._JOURNAL, adopt=adopt,
+                            probe_scheduler=cls._PROBE_SCHEDULER)
         except OFPUnknownVersion as message:
             logger.error(str(message))
             return
         cls._ROUTER_LIST.setdefault(dp.id, router)
         logger.info('Join as router.')
 
-        logger.info('Requesting configuration from Switchboard.')
-        try:
-            urllib3.contrib.pyopenssl.inject_into_urllib3()
-            payload = {'rest_caller_id': CONF.switchboard.username, 'rest_caller_pw': CONF.switchboard.password}
-            r = requests.get(CONF.switchboard.state_url, params=payload, timeout=SWITCHBOARD_REPLY_TIMEOUT)
-        except:
-            logger.exception('Error in retrieving Switchboard configuration!')
+        # Locally saved state is restored at once, in place of Switchboard's.
+        # Switchboard is then not asked at all, so changes made there since
+        # the state was saved go unseen until the saved state is removed.
+        if restore:
+            cls._STATE_STORE.restore_router(router)
+            if adopt:
+                # Flow stats are awaited off the event loop.
+                hub.spawn(router.adopt_flows, waiters)
+        # Switchboard is asked off the event loop; joins keep flowing meanwhile.
+        elif CONF.switchboard.state_url:
+            hub.spawn(cls._restore_router_state, router)
+
+    @classmethod
+    def _restore_router_state(cls, router):
+        router.logger.info('Requesting configuration from Switchboard.')
+        state = cls._SWITCHBOARD.get_state()
+        if state is None:
+            return
+        if cls._ROUTER_LIST.get(router.dp.id) is not router:
+            # Switch left, or re-joined, while the state was being fetched.
             return
 
+        # One batch per VLAN, applied as a bulk set.
+        switch_state = SwitchboardClient.get_switch_state(state, router.dpid_str)
+        for vlan_id, param in sorted(switch_state.items()):
+            try:
+                param = validate_param('set_bulk_data', param)
+                msg = router.set_bulk_data(vlan_id, param, router.waiters)
+            except Exception:
+                router.logger.exception('Invalid Switchboard configuration for VLAN [%s]!',
+                                        vlan_id)
+                continue
+            for vlan_msg in msg[REST_COMMAND_RESULT]:
+                if vlan_msg[REST_RESULT] != REST_OK:
+                    router.logger.warning('Switchboard configuration for VLAN [%s] '
+                                          'rejected: %s', vlan_id, vlan_msg[REST_DETAILS])
+        router.logger.info('Applied Switchboard configuration for [%d] VLAN(s).',
+                           len(switch_state))
+
     @classmethod
     def unregister_router(cls, dp):
         if dp.id in cls._ROUTER_LIST:
@@ -226,50 +359,127 @@ class PlexusController(ControllerBase):
             router = cls._ROUTER_LIST[dp_id]
             router.packet_in_handler(msg)
 
+    @classmethod
+    def flow_removed_handler(cls, msg):
+        dp_id = msg.datapath.id
+        if dp_id in cls._ROUTER_LIST:
+            router = cls._ROUTER_LIST[dp_id]
+            router.flow_removed_handler(msg)
+
     # GET /router/{switch_id}
     @rest_command
     def get_data(self, req, switch_id, **_kwargs):
-        return self._access_router(switch_id, VLANID_NONE,
-                                   'get_data', req.body)
+        return self._get_router_data(req, switch_id, VLANID_NONE)
 
     # GET /router/{switch_id}/{vlan_id}
     @rest_command
     def get_vlan_data(self, req, switch_id, vlan_id, **_kwargs):
-        return self._access_router(switch_id, vlan_id,
-                                   'get_data', req.body)
+        return self._get_router_data(req, switch_id, vlan_id)
+
+    def _get_router_data(self, req, switch_id, vlan_id):
+        # Pollers that send back the ETag they last saw get a 304,
+        # without serialization, if nothing they asked for has changed.
+        routers = self._get_router(switch_id)
+        generations = [routers[dp_id].get_generation(vlan_id)
+                       for dp_id in sorted(routers)]
+        etag = hashlib.md5(repr((self._BOOT_ID, req.query_string,
+                                 generations))).hexdigest()
+        if etag in req.if_none_match:
+            return Response(status=304, etag=etag)
+
+        if req.GET:
+            msg = self._access_router(switch_id, vlan_id, 'get_data', req)
+            body = json.dumps(msg)
+        else:
+            # Unqualified GETs are answered from the serialized fragments
+            # cached by each VlanRouter.
+            body = '[%s]' % ', '.join(routers[dp_id].get_data_json(vlan_id)
+                                      for dp_id in sorted(routers))
+        return Response(content_type='application/json',
+                        body=body, etag=etag)
+
+    # GET /router/events
+    @rest_command
+    def get_events(self, req, **_kwargs):
+        # Long-poll: waits up to timeout seconds for events after since.
+        query = validate_request('get_events', None, req.GET)
+        return self._JOURNAL.wait_since(query.get(REST_SINCE, 0),
+                                        query.get(REST_TIMEOUT, CHANGE_FEED_TIMEOUT))
 
     # POST /router/{switch_id}
     @rest_command
     def set_data(self, req, switch_id, **_kwargs):
         return self._access_router(switch_id, VLANID_NONE,
-                                   'set_data', req.body)
+                                   'set_data', req)
 
     # POST /router/{switch_id}/{vlan_id}
     @rest_command
     def set_vlan_data(self, req, switch_id, vlan_id, **_kwargs):
         return self._access_router(switch_id, vlan_id,
-                                   'set_data', req.body)
+                                   'set_data', req)
+
+    # POST /router/{switch_id}/bulk
+    @rest_command
+    def set_bulk_data(self, req, switch_id, **_kwargs):
+        return self._access_router(switch_id, VLANID_NONE,
+                                   'set_bulk_data', req)
+
+    # POST /router/{switch_id}/{vlan_id}/bulk
+    @rest_command
+    def set_vlan_bulk_data(self, req, switch_id, vlan_id, **_kwargs):
+        return self._access_router(switch_id, vlan_id,
+                                   'set_bulk_data', req)
+
+    # GET /router/{switch_id}/flow_table
+    @rest_command
+    def get_flow_table(self, req, switch_id, **_kwargs):
+        return self._access_router(switch_id, VLANID_NONE,
+                                   'get_flow_table', req)
+
+    # GET /router/{switch_id}/top_talkers
+    @rest_command
+    def get_top_talkers(self, req, switch_id, **_kwargs):
+        return self._access_router(switch_id, VLANID_NONE,
+                                   'get_top_talkers', req)
 
     # DELETE /router/{switch_id}
     @rest_command
     def delete_data(self, req, switch_id, **_kwargs):
         return self._access_router(switch_id, VLANID_NONE,
-                                   'delete_data', req.body)
+                                   'delete_data', req)
 
     # DELETE /router/{switch_id}/{vlan_id}
     @rest_command
     def delete_vlan_data(self, req, switch_id, vlan_id, **_kwargs):
         return self._access_router(switch_id, vlan_id,
-                                   'delete_data', req.body)
-
-    def _access_router(self, switch_id, vlan_id, func, rest_param):
+                                   'delete_data', req)
+
+    def _access_router(self, switch_id, vlan_id, func, req):
+        routers = self._get_router(switch_id).values()
+        param = validate_request(func, req.body, req.GET)
+        if len(routers) == 1:
+            function = getattr(routers[0], func)
+            return [function(vlan_id, param, self.waiters)]
+
+        # Fan out to all routers concurrently, through a bounded set of
+        # workers, so that one slow switch does not hold up the rest.
+        def _call(router):
+            # Errors are returned, so that every router is still accessed;
+            # each call gets its own copy of param, as it may be changed.
+            try:
+                return getattr(router, func)(vlan_id, dict(param), self.waiters), None
+            except Exception:
+                return None, sys.exc_info()
+
+        pool = greenpool.GreenPool(min(len(routers), MAX_CONCURRENT_ROUTER_ACCESS))
         rest_message = []
-        routers = self._get_router(switch_id)
-        param = eval(rest_param) if rest_param else {}
-        for router in routers.values():
-            function = getattr(router, func)
-            data = function(vlan_id, param, self.waiters)
-            rest_message.append(data)
+        error = None
+        for message, exc_info in pool.imap(_call, routers):
+            rest_message.append(message)
+            if error is None:
+                error = exc_info
+        if error is not None:
+            six.reraise(*error)
 
         return rest_message
 
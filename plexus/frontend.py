@@ -0,0 +1,158 @@
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# REST front end, for switches divided among several worker processes.
+#
+# Requests for a switch are passed to the worker owning it (see
+# get_dpid_worker()); requests for "all" switches go to every worker,
+# and their results are joined. The change feed is not passed on, as
+# each worker numbers its own events; subscribe to each worker instead.
+#
+# Usage: python -m plexus.frontend --config-file /etc/plexus/frontend.conf
+
+import json
+import logging
+import re
+import sys
+
+from webob import Request
+from webob import Response
+
+from plexus import *
+from plexus.util import *
+
+_SWITCHID_RE = re.compile(r'^(%s)$' % SWITCHID_PATTERN)
+
+
+class Frontend(object):
+    def __init__(self, workers, logger):
+        super(Frontend, self).__init__()
+        self.workers = [url.rstrip('/') for url in workers]
+        self.logger = logger
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            import requests
+            import requests.adapters
+
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.workers),
+                                                    pool_maxsize=FRONTEND_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    def __call__(self, environ, start_response):
+        req = Request(environ)
+        try:
+            resp = self.route(req)
+        except Exception:
+            self.logger.exception('Error in passing on request [%s %s]!',
+                                  req.method, req.path_qs)
+            resp = self._error(500, 'Internal error.')
+        return resp(environ, start_response)
+
+    @staticmethod
+    def _error(status, details):
+        body = json.dumps({REST_RESULT: REST_NG, REST_DETAILS: details})
+        return Response(status=status, content_type='application/json', body=body)
+
+    def route(self, req):
+        parts = req.path_info.strip('/').split('/')
+        if len(parts) < 2 or parts[0] != 'router':
+            return self._error(404, 'Not found.')
+        if parts[1] == 'events':
+            return self._error(404, 'The change feed is served by each worker.')
+
+        switch_id = parts[1].lower()
+        if not _SWITCHID_RE.match(switch_id):
+            return self._error(404, 'Not found.')
+        if switch_id == REST_ALL:
+            return self._fan_out(req)
+        return self._forward(req, get_dpid_worker(switch_id, len(self.workers)))
+
+    def _request(self, index, req):
+        headers = dict((name, req.headers[name])
+                       for name in ('Content-Type', 'If-None-Match')
+                       if name in req.headers)
+        return self._get_session().request(req.method, self.workers[index] + req.path_qs,
+                                           data=req.body, headers=headers,
+                                           timeout=FRONTEND_REPLY_TIMEOUT)
+
+    def _try_request(self, index, req):
+        # Returns the exception raised, if any, as hub.spawn() would only
+        # log it, and leave wait() returning None.
+        try:
+            return self._request(index, req)
+        except Exception as e:
+            return e
+
+    def _forward(self, req, index):
+        try:
+            r = self._request(index, req)
+        except Exception as e:
+            self.logger.error('Worker [%d] unreachable: %s', index, e)
+            return self._error(502, 'Worker %d unreachable.' % index)
+
+        resp = Response(status=r.status_code, body=r.content)
+        for name in ('Content-Type', 'ETag'):
+            if name in r.headers:
+                resp.headers[name] = r.headers[name]
+        return resp
+
+    def _fan_out(self, req):
+        # Workers are asked concurrently; each answers for its own switches.
+        threads = [hub.spawn(self._try_request, index, req)
+                   for index in range(len(self.workers))]
+        results = []
+        failures = []
+        not_found = None
+        for index, thread in enumerate(threads):
+            r = thread.wait()
+            if isinstance(r, Exception):
+                self.logger.error('Worker [%d] unreachable: %s', index, r)
+                failures.append('Worker %d unreachable.' % index)
+                continue
+            if r.status_code == 404:
+                # No switches on this worker.
+                not_found = r
+            elif 200 <= r.status_code < 300:
+                results.extend(r.json())
+            else:
+                failures.append('Worker %d: %s' % (index, r.text))
+
+        if not results and not failures and not_found is not None:
+            return Response(status=404, body=not_found.content,
+                            content_type='application/json')
+        status = 200
+        for details in failures:
+            results.append({REST_RESULT: REST_NG, REST_DETAILS: details})
+            status = 502
+        return Response(status=status, content_type='application/json',
+                        body=json.dumps(results))
+
+
+def main():
+    # Else requests to workers, made with requests, would block the hub,
+    # and so every other request too.
+    hub.patch(thread=False)
+    CONF(args=sys.argv[1:], project='plexus')
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger('plexus.frontend')
+    if not CONF.frontend.workers:
+        logger.error('No workers configured, in the [frontend] section.')
+        return 1
+
+    server = hub.WSGIServer((CONF.frontend.listen_host, CONF.frontend.listen_port),
+                            Frontend(CONF.frontend.workers, logger))
+    logger.info('Passing REST requests to [%d] worker(s), on port [%d].',
+                len(CONF.frontend.workers), CONF.frontend.listen_port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,9 +11,12 @@
 # following authors:
 # Author: Victor J. Orlikowski <vjo@duke.edu>
 
+import time
+
 from ryu.exception import OFPUnknownVersion
 
 from plexus import *
+from plexus.tables import *
 from plexus.util import *
 
 class OfCtl(object):
@@ -42,23 +45,213 @@ class OfCtl(object):
         self.sw_id = {'sw_id': dpid_lib.dpid_to_str(dp.id)}
         self.logger = logger
 
+        # Flow table occupancy is shared by every OfCtl for this datapath.
+        if getattr(dp, 'flow_occupancy', None) is None:
+            dp.flow_occupancy = FlowTableOccupancy(CONF.plexus.flow_table_size,
+                                                   CONF.plexus.flow_table_high_water)
+        self.occupancy = dp.flow_occupancy
+
+        # As is the estimate of how long the datapath takes to reply.
+        if getattr(dp, 'reply_timer', None) is None:
+            dp.reply_timer = ReplyTimer()
+        self.reply_timer = dp.reply_timer
+
+        # Set while flows left by a previous run are to be adopted; see
+        # _get_overlap_flags().
+        self.adopting = False
+
     def set_sw_config_for_ttl(self):
         # OpenFlow v1_2/1_3.
         pass
 
+    def set_role(self, master, generation_id):
+        # OpenFlow v1_2/1_3.
+        pass
+
+    def _get_overlap_flags(self):
+        # Flows left by a previous run may be identical to those state is
+        # re-applied with; the switch refuses such an add if it is to check
+        # for overlap, but otherwise replaces the flow in place, as the
+        # occupancy shadow expects (see _track_flow()).
+        if self.adopting or self.occupancy.adopted:
+            return 0
+        return self.dp.ofproto.OFPFF_CHECK_OVERLAP
+
     def clear_flows(self):
         # Abstract method
         raise NotImplementedError()
 
+    def get_table_capacity(self, waiters):
+        # Abstract method
+        raise NotImplementedError()
+
+    def _flow_stats_request(self, cookie=0, cookie_mask=0):
+        # Abstract method
+        raise NotImplementedError()
+
+    @staticmethod
+    def _cookie_filter(vlan_id=None, route_id=None, address_id=None):
+        # Encode the cookie layout used by VlanRouter into a cookie and mask.
+        cookie = 0
+        cookie_mask = 0
+        if vlan_id is not None:
+            cookie |= vlan_id << COOKIE_SHIFT_VLANID
+            cookie_mask |= COOKIE_MASK_VLANID
+        if route_id is not None:
+            cookie |= route_id << COOKIE_SHIFT_ROUTEID
+            cookie_mask |= COOKIE_MASK_ROUTEID
+        if address_id is not None:
+            cookie |= address_id
+            cookie_mask |= COOKIE_MASK_ADDRESSID
+        return cookie, cookie_mask
+
+    def get_all_flow(self, waiters):
+        stats = self._flow_stats_request()
+        return self.send_stats_request(stats, waiters).result()
+
+    def get_flows(self, waiters, vlan_id=None, route_id=None, address_id=None):
+        # Returns the flow stats of flows whose cookie matches the given IDs.
+        # Where the switch supports it, filtering is done by the switch.
+        cookie, cookie_mask = self._cookie_filter(vlan_id, route_id, address_id)
+        stats = self._flow_stats_request(cookie, cookie_mask)
+        msgs = self.send_stats_request(stats, waiters).result()
+        return [flow_stats for msg in msgs for flow_stats in msg.body
+                if (flow_stats.cookie & cookie_mask) == cookie]
+
     def set_flow(self, cookie, priority,
                  in_port=None,
                  dl_type=0, dl_src=0, dl_dst=0, dl_vlan=0,
                  nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
                  nw_proto=0, idle_timeout=0, hard_timeout=0,
-                 flags=0, actions=None):
+                 flags=0, actions=None, command=None,
+                 flow_class=FLOW_CLASS_ROUTE):
         # Abstract method
         raise NotImplementedError()
 
+    def _reserve_flow(self, key, flow_class):
+        # Make room for a new flow, if the flow table is near capacity.
+        # Returns False if the flow should not be installed.
+        if key in self.occupancy or not self.occupancy.near_capacity():
+            return True
+
+        victims = self.occupancy.get_lru(FLOW_CLASSES_EVICTABLE, FLOW_EVICTION_BATCH)
+        for victim_key, victim in victims:
+            self.set_flow(victim.cookie, victim.priority,
+                          command=self.dp.ofproto.OFPFC_DELETE_STRICT,
+                          **victim.match)
+            self.occupancy.evictions += 1
+        if victims:
+            self.logger.info('Evicted %d least recently used flow(s) [occupancy=%d, budget=%d]',
+                             len(victims), len(self.occupancy), self.occupancy.budget)
+
+        if not self.occupancy.near_capacity():
+            return True
+        if flow_class in FLOW_CLASSES_EVICTABLE:
+            self.logger.warning('Flow table full; not installing %s flow.', flow_class)
+            return False
+        self.logger.warning('Flow table full; installing %s flow regardless.', flow_class)
+        return True
+
+    def _track_flow(self, command, key, cookie, priority, match, flow_class,
+                    idle_timeout=0, hard_timeout=0):
+        ofp = self.dp.ofproto
+        if command == ofp.OFPFC_ADD:
+            if self.occupancy.adopted:
+                # The flow replaces any identical one adopted from a previous run.
+                fields = self._normalize_match_fields(match)
+                self.occupancy.remove(self.occupancy.get_adopted_key(cookie, priority, fields))
+            self.occupancy.add(key, flow_class, cookie, priority, match,
+                               idle_timeout=idle_timeout,
+                               hard_timeout=hard_timeout,
+                               notify_removal=(flow_class in FLOW_CLASSES_NOTIFY_REMOVAL))
+        elif command == ofp.OFPFC_DELETE_STRICT:
+            self.occupancy.remove(key)
+
+    def get_match_fields(self, match):
+        # Abstract method
+        raise NotImplementedError()
+
+    @staticmethod
+    def _normalize_match_fields(match):
+        # Convert set_flow() match arguments to the form of get_match_fields().
+        fields = {}
+        if match.get('in_port'):
+            fields['in_port'] = match['in_port']
+        for name in ('dl_src', 'dl_dst'):
+            if match.get(name):
+                fields[name] = mac_lib.haddr_to_str(match[name])
+        if match.get('nw_dst') and match.get('dst_mask'):
+            fields['nw_dst'] = ipv4_text_to_int(match['nw_dst'])
+        return fields
+
+    def flow_removed(self, msg):
+        # Drop a flow the switch reports as removed from the occupancy shadow.
+        # Returns the shadow entry, or None if the flow was not known.
+        removed_fields = self.get_match_fields(msg.match)
+        # A flow we deleted and re-added may be reported after the re-add;
+        # the shadow entry must be no newer than the removed flow.
+        # (Allow a second of slack for the truncated duration.)
+        removed_install_time = time.time() - msg.duration_sec
+        for key in self.occupancy.get_keys(msg.cookie, msg.priority):
+            entry = self.occupancy[key]
+            if entry.install_time > removed_install_time + 1:
+                continue
+            if entry.adopted:
+                fields = entry.match
+            else:
+                fields = self._normalize_match_fields(entry.match)
+            if all(removed_fields.get(name) == value
+                   for name, value in fields.items()):
+                return self.occupancy.remove(key)
+        return None
+
+    @staticmethod
+    def get_adopted_flow_class(cookie, priority):
+        # Infer the class of a flow found on the datapath, from the cookie
+        # layout used by VlanRouter and the priorities of get_priority().
+        if (cookie & COOKIE_MASK_ROUTEID) >> COOKIE_SHIFT_ROUTEID:
+            return FLOW_CLASS_ROUTE
+        base_priority = priority % PRIORITY_VLAN_SHIFT - PRIORITY_NETMASK_SHIFT
+        return FLOW_CLASSES_ADOPTED.get(base_priority, FLOW_CLASS_PACKETIN)
+
+    def adopt_flows(self, flows):
+        # Account for flows left on the datapath by a previous run.
+        # Flows already re-installed by this run are tracked already.
+        installed = set(self.occupancy.get_adopted_key(entry.cookie, entry.priority,
+                                                       self._normalize_match_fields(entry.match))
+                        for entry in self.occupancy.values() if not entry.adopted)
+        for flow_stats in flows:
+            cookie = flow_stats.cookie
+            priority = flow_stats.priority
+            fields = self.get_match_fields(flow_stats.match)
+            if self.occupancy.get_adopted_key(cookie, priority, fields) in installed:
+                continue
+            self.occupancy.adopt(self.get_adopted_flow_class(cookie, priority),
+                                 cookie, priority, fields)
+
+    def get_routing_flow(self, flow_stats):
+        # Abstract method
+        raise NotImplementedError()
+
+    def adopt_routing_flow(self, flow_stats, dl_vlan):
+        # Account for a routing flow left on the datapath by a previous run,
+        # just as if set_routing_flow() had installed it, so that it can be
+        # deleted exactly. Returns the arguments to set_routing_flow() found
+        # by get_routing_flow(), or None if it is not a routing flow.
+        flow = self.get_routing_flow(flow_stats)
+        if flow is None:
+            return None
+        match_fields = dict(in_port=None, dl_type=ether.ETH_TYPE_IP,
+                            dl_src=0, dl_dst=0, dl_vlan=dl_vlan,
+                            nw_src=flow['nw_src'], src_mask=flow['src_mask'],
+                            nw_dst=flow['nw_dst'], dst_mask=flow['dst_mask'],
+                            src_port=0, dst_port=0, nw_proto=0)
+        priority = flow_stats.priority
+        self.occupancy.add((priority, tuple(sorted(match_fields.items()))),
+                           FLOW_CLASS_ROUTE, flow_stats.cookie, priority, match_fields,
+                           notify_removal=(FLOW_CLASS_ROUTE in FLOW_CLASSES_NOTIFY_REMOVAL))
+        return flow
+
     def send_arp(self, arp_opcode, vlan_id, src_mac, dst_mac,
                  src_ip, dst_ip, arp_target_mac, in_port, output):
         # Generate ARP packet
@@ -181,22 +374,97 @@ class OfCtl(object):
             self.dp.ofproto.OFPCML_NO_BUFFER)]
         self.set_flow(cookie, priority, dl_type=dl_type, dl_dst=dl_dst,
                       dl_vlan=dl_vlan, nw_dst=dst_ip, dst_mask=dst_mask,
-                      nw_src=src_ip, src_mask=src_mask, nw_proto=nw_proto, actions=actions)
+                      nw_src=src_ip, src_mask=src_mask, nw_proto=nw_proto, actions=actions,
+                      flow_class=FLOW_CLASS_PACKETIN)
+
+    def delete_routing_flow(self, priority, dl_vlan=0,
+                            nw_src=0, src_mask=32, nw_dst=0, dst_mask=32):
+        # Remove exactly one routing flow, as installed by set_routing_flow.
+        self.set_flow(0, priority, dl_type=ether.ETH_TYPE_IP, dl_vlan=dl_vlan,
+                      nw_src=nw_src, src_mask=src_mask,
+                      nw_dst=nw_dst, dst_mask=dst_mask,
+                      command=self.dp.ofproto.OFPFC_DELETE_STRICT)
 
     def send_stats_request(self, stats, waiters):
+        # Returns a StatsReplyFuture; call result() to wait for the replies.
         self.dp.set_xid(stats)
         waiters_per_dp = waiters.setdefault(self.dp.id, {})
-        event = hub.Event()
-        msgs = []
-        waiters_per_dp[stats.xid] = (event, msgs)
+        xid = stats.xid
+
+        def _cancel():
+            waiters_per_dp.pop(xid, None)
+
+        future = StatsReplyFuture(self.reply_timer, _cancel, self.logger)
+        waiters_per_dp[xid] = future
         self.dp.send_msg(stats)
 
-        try:
-            event.wait(timeout=OFP_REPLY_TIMER)
-        except hub.Timeout:
-            del waiters_per_dp[stats.xid]
+        return future
+
 
-        return msgs
+class ReplyTimer(object):
+    # Estimates a reply timeout for a datapath, from the measured round trip
+    # time of previous replies, in the manner of a TCP retransmission timer.
+    def __init__(self):
+        super(ReplyTimer, self).__init__()
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = OFP_REPLY_TIMER
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        timeout = self.srtt + 4 * self.rttvar
+        self.timeout = min(max(timeout, OFP_REPLY_TIMER_MIN), OFP_REPLY_TIMER_MAX)
+
+    def backoff(self):
+        self.timeout = min(self.timeout * 2, OFP_REPLY_TIMER_MAX)
+
+
+class StatsReplyFuture(object):
+    # The pending (possibly multipart) reply to a stats request.
+    # Each reply part received pushes the deadline back, so that long
+    # multipart replies are not cut short while they are still arriving.
+    def __init__(self, reply_timer, cancel, logger):
+        super(StatsReplyFuture, self).__init__()
+        self.reply_timer = reply_timer
+        self.cancel = cancel
+        self.logger = logger
+        self.event = hub.Event()
+        self.msgs = []
+        self.sent_time = time.time()
+        self.deadline = self.sent_time + reply_timer.timeout
+        self.complete = False
+
+    def add_reply(self, msg, more=False):
+        current_time = time.time()
+        if not self.msgs:
+            self.reply_timer.sample(current_time - self.sent_time)
+        self.msgs.append(msg)
+        self.deadline = current_time + self.reply_timer.timeout
+        if not more:
+            self.complete = True
+            self.event.set()
+
+    def done(self):
+        return self.complete
+
+    def result(self):
+        while not self.complete:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                break
+            self.event.wait(timeout=remaining)
+
+        if not self.complete:
+            self.cancel()
+            self.reply_timer.backoff()
+            self.logger.warning('Stats reply timed out, after [%d] part(s).',
+                                len(self.msgs))
+        return self.msgs
 
 
 @OfCtl.register_of_version(ofproto_v1_0.OFP_VERSION)
@@ -216,33 +484,96 @@ class OfCtl_v1_0(OfCtl):
             priority=ofp.OFP_DEFAULT_PRIORITY,
             actions=[])
         self.dp.send_msg(mod)
+        self.occupancy.clear()
 
     def get_packetin_inport(self, msg):
         return msg.in_port
 
-    def get_all_flow(self, waiters):
+    def _flow_stats_request(self, cookie=0, cookie_mask=0):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
 
+        # Cookie filtering is not supported at OpenFlow V1.0
         match = ofp_parser.OFPMatch(ofp.OFPFW_ALL, 0, 0, 0,
                                     0, 0, 0, 0, 0, 0, 0, 0, 0)
-        stats = ofp_parser.OFPFlowStatsRequest(self.dp, 0, match,
-                                               0xff, ofp.OFPP_NONE)
-        return self.send_stats_request(stats, waiters)
+        return ofp_parser.OFPFlowStatsRequest(self.dp, 0, match,
+                                              0xff, ofp.OFPP_NONE)
+
+    def get_table_capacity(self, waiters):
+        ofp_parser = self.dp.ofproto_parser
+
+        stats = ofp_parser.OFPTableStatsRequest(self.dp, 0)
+        msgs = self.send_stats_request(stats, waiters).result()
+        return sum(table.max_entries
+                   for msg in msgs for table in msg.body
+                   if table.table_id == 0)
 
     def get_match_dst_ip(self, match):
         return match.nw_dst
 
+    def get_match_fields(self, match):
+        ofp = self.dp.ofproto
+        wildcards = match.wildcards
+        fields = {}
+        if not wildcards & ofp.OFPFW_IN_PORT:
+            fields['in_port'] = match.in_port
+        if not wildcards & ofp.OFPFW_DL_SRC:
+            fields['dl_src'] = mac_lib.haddr_to_str(match.dl_src)
+        if not wildcards & ofp.OFPFW_DL_DST:
+            fields['dl_dst'] = mac_lib.haddr_to_str(match.dl_dst)
+        if ((wildcards & ofp.OFPFW_NW_DST_MASK) >> ofp.OFPFW_NW_DST_SHIFT) < 32:
+            fields['nw_dst'] = match.nw_dst
+        return fields
+
+    def get_routing_flow(self, flow_stats):
+        # The arguments to set_routing_flow() that install flow_stats,
+        # or None if it is not a routing flow.
+        ofp = self.dp.ofproto
+        ofp_parser = self.dp.ofproto_parser
+        match = flow_stats.match
+        if not match.wildcards & ofp.OFPFW_NW_PROTO:
+            return None
+
+        flow = {'dst_mac': None, 'outport': None}
+        for name, ip_int, mask, shift in (
+                ('src', match.nw_src, ofp.OFPFW_NW_SRC_MASK, ofp.OFPFW_NW_SRC_SHIFT),
+                ('dst', match.nw_dst, ofp.OFPFW_NW_DST_MASK, ofp.OFPFW_NW_DST_SHIFT)):
+            netmask = max(32 - ((match.wildcards & mask) >> shift), 0)
+            flow['nw_' + name] = ipv4_int_to_text(ip_int) if netmask else 0
+            flow[name + '_mask'] = netmask
+        for action in flow_stats.actions:
+            if isinstance(action, ofp_parser.OFPActionSetDlDst):
+                flow['dst_mac'] = mac_lib.haddr_to_str(action.dl_addr)
+            elif isinstance(action, ofp_parser.OFPActionOutput):
+                flow['outport'] = action.port
+        if flow['dst_mac'] is None or flow['outport'] is None:
+            return None
+        return flow
+
     def set_flow(self, cookie, priority,
                  in_port=None,
                  dl_type=0, dl_src=0, dl_dst=0, dl_vlan=0,
                  nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
                  src_port=0, dst_port=0,
                  nw_proto=0, idle_timeout=0, hard_timeout=0,
-                 flags=0, actions=None):
+                 flags=0, actions=None, command=None,
+                 flow_class=FLOW_CLASS_ROUTE):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
-        cmd = ofp.OFPFC_ADD
+        cmd = ofp.OFPFC_ADD if command is None else command
+
+        match_fields = dict(in_port=in_port, dl_type=dl_type,
+                            dl_src=dl_src, dl_dst=dl_dst, dl_vlan=dl_vlan,
+                            nw_src=nw_src, src_mask=src_mask,
+                            nw_dst=nw_dst, dst_mask=dst_mask,
+                            src_port=src_port, dst_port=dst_port,
+                            nw_proto=nw_proto)
+        flow_key = (priority, tuple(sorted(match_fields.items())))
+        if cmd == ofp.OFPFC_ADD:
+            if not self._reserve_flow(flow_key, flow_class):
+                return
+            if flow_class in FLOW_CLASSES_NOTIFY_REMOVAL:
+                flags |= ofp.OFPFF_SEND_FLOW_REM
 
         # Match
         wildcards = ofp.OFPFW_ALL
@@ -283,17 +614,29 @@ class OfCtl_v1_0(OfCtl):
                                   idle_timeout=idle_timeout, hard_timeout=hard_timeout,
                                   priority=priority, flags=flags, actions=actions)
         self.dp.send_msg(m)
+        self._track_flow(cmd, flow_key, cookie, priority, match_fields, flow_class,
+                         idle_timeout=idle_timeout, hard_timeout=hard_timeout)
+
+    def set_packetin_flow(self, cookie, priority, dl_type=0, dl_dst=0,
+                          dl_vlan=0, dst_ip=0, dst_mask=32, src_ip=0, src_mask=32, nw_proto=0):
+        # OpenFlow V1.0 has no OFPCML_NO_BUFFER; the default max_len is used.
+        actions = [self.dp.ofproto_parser.OFPActionOutput(
+            self.dp.ofproto.OFPP_CONTROLLER)]
+        self.set_flow(cookie, priority, dl_type=dl_type, dl_dst=dl_dst,
+                      dl_vlan=dl_vlan, nw_dst=dst_ip, dst_mask=dst_mask,
+                      nw_src=src_ip, src_mask=src_mask, nw_proto=nw_proto, actions=actions,
+                      flow_class=FLOW_CLASS_PACKETIN)
 
     def set_routing_flow(self, cookie, priority, outport,
                          in_port=None, dl_vlan=0,
                          nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
                          src_port=0, dst_port=0, src_mac=0, dst_mac=0,
                          nw_proto=0, idle_timeout=0, hard_timeout=0,
-                         **dummy):
+                         flow_class=FLOW_CLASS_ROUTE, **dummy):
         ofp_parser = self.dp.ofproto_parser
 
         dl_type = ether.ETH_TYPE_IP
-        flags = self.dp.ofproto.OFPFF_CHECK_OVERLAP
+        flags = self._get_overlap_flags()
         #flags = 0
 
         # Decrement TTL value is not supported at OpenFlow V1.0
@@ -314,7 +657,7 @@ class OfCtl_v1_0(OfCtl):
                       src_port=src_port, dst_port=dst_port,
                       nw_proto=nw_proto,
                       idle_timeout=idle_timeout, hard_timeout=hard_timeout,
-                      flags=flags, actions=actions)
+                      flags=flags, actions=actions, flow_class=flow_class)
 
     def delete_flow(self, flow_stats):
         match = flow_stats.match
@@ -326,6 +669,7 @@ class OfCtl_v1_0(OfCtl):
         flow_mod = self.dp.ofproto_parser.OFPFlowMod(
             self.dp, match, cookie, cmd, priority=priority, actions=actions)
         self.dp.send_msg(flow_mod)
+        self.occupancy.delete_cookie(cookie, priority)
         self.logger.info('Delete flow [cookie=0x%x]', cookie)
 
 
@@ -337,6 +681,17 @@ class OfCtl_after_v1_2(OfCtl):
     def set_sw_config_for_ttl(self):
         pass
 
+    def set_role(self, master, generation_id):
+        # Claim the switch, or leave it to another controller.
+        # The generation id must only ever increase, in any worker (see
+        # next_role_generation_id()), so that a claim always supersedes
+        # those made before it.
+        ofp = self.dp.ofproto
+        role = ofp.OFPCR_ROLE_MASTER if master else ofp.OFPCR_ROLE_SLAVE
+        msg = self.dp.ofproto_parser.OFPRoleRequest(self.dp, role, generation_id)
+        self.dp.send_msg(msg)
+        self.logger.info('Set controller role [%s].', 'master' if master else 'slave')
+
     def clear_flows(self):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
@@ -344,6 +699,7 @@ class OfCtl_after_v1_2(OfCtl):
                                     ofp.OFPFC_DELETE, 0, 0, 1, ofp.OFPCML_NO_BUFFER,
                                     ofp.OFPP_ANY, ofp.OFPG_ANY, 0, ofp_parser.OFPMatch(), [])
         self.dp.send_msg(mod)
+        self.occupancy.clear()
 
     def get_packetin_inport(self, msg):
         in_port = self.dp.ofproto.OFPP_ANY
@@ -353,22 +709,87 @@ class OfCtl_after_v1_2(OfCtl):
                 break
         return in_port
 
-    def get_all_flow(self, waiters):
-        pass
+    def _get_table_ids(self):
+        # Tables that set_flow will install flows into.
+        if self.dp.n_tables == 1:
+            return [0]
+        return [0, 1]
 
     def get_match_dst_ip(self, match):
         return match.ipv4_dst
 
+    def get_match_fields(self, match):
+        fields = {}
+        for name, field in (('in_port', 'in_port'),
+                            ('dl_src', 'eth_src'),
+                            ('dl_dst', 'eth_dst'),
+                            ('nw_dst', 'ipv4_dst')):
+            value = match.get(field)
+            if value is None:
+                continue
+            if isinstance(value, tuple):
+                # Masked field; (value, mask).
+                value = value[0]
+            if name == 'nw_dst':
+                value = ipv4_text_to_int(value)
+            fields[name] = value
+        return fields
+
+    def get_routing_flow(self, flow_stats):
+        # The arguments to set_routing_flow() that install flow_stats,
+        # or None if it is not a routing flow.
+        ofp_parser = self.dp.ofproto_parser
+        match = flow_stats.match
+        if match.get('ip_proto') is not None:
+            return None
+
+        flow = {'dst_mac': None, 'outport': None}
+        for name, field in (('src', 'ipv4_src'), ('dst', 'ipv4_dst')):
+            value = match.get(field)
+            netmask = 0
+            if isinstance(value, tuple):
+                # Masked field; (value, mask).
+                value, mask = value
+                netmask = bin(ipv4_text_to_int(mask)).count('1')
+            elif value is not None:
+                netmask = 32
+            flow['nw_' + name] = value if netmask else 0
+            flow[name + '_mask'] = netmask
+        for instruction in flow_stats.instructions:
+            for action in getattr(instruction, 'actions', []):
+                if (isinstance(action, ofp_parser.OFPActionSetField) and
+                        action.key == 'eth_dst'):
+                    flow['dst_mac'] = action.value
+                elif isinstance(action, ofp_parser.OFPActionOutput):
+                    flow['outport'] = action.port
+        if flow['dst_mac'] is None or flow['outport'] is None:
+            return None
+        return flow
+
     def set_flow(self, cookie, priority,
                  in_port=None,
                  dl_type=0, dl_src=0, dl_dst=0, dl_vlan=0,
                  nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
                  src_port=0, dst_port=0,
                  nw_proto=0, idle_timeout=0, hard_timeout=0,
-                 flags=0, actions=None):
+                 flags=0, actions=None, command=None,
+                 flow_class=FLOW_CLASS_ROUTE):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
-        cmd = ofp.OFPFC_ADD
+        cmd = ofp.OFPFC_ADD if command is None else command
+
+        match_fields = dict(in_port=in_port, dl_type=dl_type,
+                            dl_src=dl_src, dl_dst=dl_dst, dl_vlan=dl_vlan,
+                            nw_src=nw_src, src_mask=src_mask,
+                            nw_dst=nw_dst, dst_mask=dst_mask,
+                            src_port=src_port, dst_port=dst_port,
+                            nw_proto=nw_proto)
+        flow_key = (priority, tuple(sorted(match_fields.items())))
+        if cmd == ofp.OFPFC_ADD:
+            if not self._reserve_flow(flow_key, flow_class):
+                return
+            if flow_class in FLOW_CLASSES_NOTIFY_REMOVAL:
+                flags |= ofp.OFPFF_SEND_FLOW_REM
 
         table_id = 0 # The default is table 0
 
@@ -432,18 +853,20 @@ class OfCtl_after_v1_2(OfCtl):
                                   priority, UINT32_MAX, ofp.OFPP_ANY,
                                   ofp.OFPG_ANY, flags, match, inst)
         self.dp.send_msg(m)
+        self._track_flow(cmd, flow_key, cookie, priority, match_fields, flow_class,
+                         idle_timeout=idle_timeout, hard_timeout=hard_timeout)
 
     def set_routing_flow(self, cookie, priority, outport,
                          in_port=None, dl_vlan=0,
                          nw_src=0, src_mask=32, nw_dst=0, dst_mask=32,
                          src_port=0, dst_port=0, src_mac=0, dst_mac=0,
                          nw_proto=0, idle_timeout=0, hard_timeout=0,
-                         dec_ttl=False):
+                         dec_ttl=False, flow_class=FLOW_CLASS_ROUTE):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
 
         dl_type = ether.ETH_TYPE_IP
-        flags = self.dp.ofproto.OFPFF_CHECK_OVERLAP
+        flags = self._get_overlap_flags()
         #flags = 0
 
         actions = []
@@ -463,7 +886,7 @@ class OfCtl_after_v1_2(OfCtl):
                       src_port=src_port, dst_port=dst_port,
                       nw_proto=nw_proto,
                       idle_timeout=idle_timeout, hard_timeout=hard_timeout,
-                      flags=flags, actions=actions)
+                      flags=flags, actions=actions, flow_class=flow_class)
 
     def delete_flow(self, flow_stats):
         ofp = self.dp.ofproto
@@ -479,6 +902,7 @@ class OfCtl_after_v1_2(OfCtl):
                                          0, 0, 0, UINT32_MAX, ofp.OFPP_ANY,
                                          ofp.OFPG_ANY, 0, match, inst)
         self.dp.send_msg(flow_mod)
+        self.occupancy.delete_cookie(cookie)
         self.logger.info('Delete flow [cookie=0x%x]', cookie)
 
 
@@ -496,14 +920,23 @@ class OfCtl_v1_2(OfCtl_after_v1_2):
         self.dp.send_msg(m)
         self.logger.info('Set SW config for TTL error packet in.')
 
-    def get_all_flow(self, waiters):
+    def _flow_stats_request(self, cookie=0, cookie_mask=0):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
 
         match = ofp_parser.OFPMatch()
-        stats = ofp_parser.OFPFlowStatsRequest(self.dp, ofp.OFPTT_ALL, ofp.OFPP_ANY,
-                                               ofp.OFPG_ANY, 0, 0, match)
-        return self.send_stats_request(stats, waiters)
+        return ofp_parser.OFPFlowStatsRequest(self.dp, ofp.OFPTT_ALL, ofp.OFPP_ANY,
+                                              ofp.OFPG_ANY, cookie, cookie_mask, match)
+
+    def get_table_capacity(self, waiters):
+        ofp_parser = self.dp.ofproto_parser
+
+        stats = ofp_parser.OFPTableStatsRequest(self.dp, 0)
+        msgs = self.send_stats_request(stats, waiters).result()
+        table_ids = self._get_table_ids()
+        return sum(table.max_entries
+                   for msg in msgs for table in msg.body
+                   if table.table_id in table_ids)
 
 
 @OfCtl.register_of_version(ofproto_v1_3.OFP_VERSION)
@@ -527,11 +960,21 @@ class OfCtl_v1_3(OfCtl_after_v1_2):
         self.dp.send_msg(m)
         self.logger.info('Set SW config for TTL error packet in.')
 
-    def get_all_flow(self, waiters):
+    def _flow_stats_request(self, cookie=0, cookie_mask=0):
         ofp = self.dp.ofproto
         ofp_parser = self.dp.ofproto_parser
 
         match = ofp_parser.OFPMatch()
-        stats = ofp_parser.OFPFlowStatsRequest(self.dp, 0, ofp.OFPTT_ALL, ofp.OFPP_ANY,
-                                               ofp.OFPG_ANY, 0, 0, match)
-        return self.send_stats_request(stats, waiters)
+        return ofp_parser.OFPFlowStatsRequest(self.dp, 0, ofp.OFPTT_ALL, ofp.OFPP_ANY,
+                                              ofp.OFPG_ANY, cookie, cookie_mask, match)
+
+    def get_table_capacity(self, waiters):
+        ofp_parser = self.dp.ofproto_parser
+
+        # An empty body queries table features, without modifying them.
+        stats = ofp_parser.OFPTableFeaturesStatsRequest(self.dp, 0, [])
+        msgs = self.send_stats_request(stats, waiters).result()
+        table_ids = self._get_table_ids()
+        return sum(table.max_entries
+                   for msg in msgs for table in msg.body
+                   if table.table_id in table_ids)
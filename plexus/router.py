@@ -11,8 +11,10 @@
 # following authors:
 # Author: Victor J. Orlikowski <vjo@duke.edu>
 
+import itertools
+import json
+import time
 import warnings
-from distutils.util import strtobool
 
 from plexus import *
 from plexus.ofctl import *
@@ -20,22 +22,38 @@ from plexus.tables import *
 from plexus.util import *
 
 class Router(dict):
-    def __init__(self, dp, ports, waiters, logger):
+    def __init__(self, dp, ports, waiters, logger, journal=None, adopt=False,
+                 probe_scheduler=None):
         super(Router, self).__init__()
         self.dp = dp
         self.waiters = waiters
         self.logger = logger
+        self.journal = journal if journal is not None else ChangeJournal()
+        if probe_scheduler is None:
+            probe_scheduler = GatewayProbeScheduler()
+        self.probe_scheduler = probe_scheduler
         self.dpid_str = dpid_lib.dpid_to_str(dp.id)
         self.sw_id = {'sw_id': self.dpid_str}
 
         self.port_data = PortData(ports)
+        # MAC addresses learned on all VLANs.
+        self.mac_table = MACAddressTable()
+        # Heavy hitters among packet-ins, by in_port and by (vlan_id, source IP);
+        # tenants on different VLANs may use the same addresses.
+        self.port_talkers = HeavyHitterSketch()
+        self.source_talkers = HeavyHitterSketch()
 
         ofctl = OfCtl.factory(dp, logger)
+        self.ofctl = ofctl
         cookie = COOKIE_DEFAULT_ID
 
-        # Clear existing flows:
-        ofctl.clear_flows()
-        self.logger.info('Clearing pre-existing flows [cookie=0x%x]', cookie)
+        # Clear existing flows, unless they are to be adopted (see adopt_flows()).
+        if adopt:
+            ofctl.adopting = True
+            self.logger.info('Keeping pre-existing flows, for adoption.')
+        else:
+            ofctl.clear_flows()
+            self.logger.info('Clearing pre-existing flows [cookie=0x%x]', cookie)
 
         # Set flow: ARP handling (packet in)
         priority = get_priority(PRIORITY_ARP_HANDLING)
@@ -46,16 +64,27 @@ class Router(dict):
         vlan_router = VlanRouter(VLANID_NONE, self)
         self[VLANID_NONE] = vlan_router
 
-        # Start cyclic routing table check.
-        self.thread = hub.spawn(self._cyclic_update_routing_tbls)
+        # Discover how many flows the switch can hold, unless configured.
+        if not ofctl.occupancy.budget:
+            hub.spawn(self._discover_flow_budget)
+
+        # Start cyclic gateway reachability checks.
+        probe_scheduler.add(self)
         self.logger.info('Start cyclic routing table update.')
 
+        self.record(EVENT_ROUTER_JOIN)
+
     def delete(self):
-        hub.kill(self.thread)
-        self.thread.wait()
+        self.probe_scheduler.remove(self)
         self.logger.info('Stop cyclic routing table update.')
         for vlan_router in self.values():
             vlan_router.shutdown()
+        self.mac_table.shutdown()
+        self.record(EVENT_ROUTER_LEAVE)
+
+    def record(self, event, **details):
+        # Add an event to the change journal.
+        self.journal.append(event, switch_id=self.dpid_str, **details)
 
     def _get_vlan_router(self, vlan_id):
         vlan_routers = []
@@ -78,6 +107,7 @@ class Router(dict):
         if vlan_id not in self:
             vlan_router = VlanRouter(vlan_id, self, bare)
             self[vlan_id] = vlan_router
+            self.record(EVENT_VLAN_ADD, vlan_id=vlan_id, **{REST_BARE: bare})
         return self[vlan_id]
 
     def _del_vlan_router(self, vlan_id, waiters):
@@ -92,31 +122,54 @@ class Router(dict):
 
         if (len(vlan_router.address_data) == 0
                 and len(vlan_router.policy_routing_tbl) == 1
-                and len(vlan_router.policy_routing_tbl[INADDR_ANY]) == 0):
+                and len(vlan_router.policy_routing_tbl[INADDR_ANY_KEY]) == 0):
             vlan_router.delete(waiters)
             del self[vlan_id]
+            self.record(EVENT_VLAN_DELETE, vlan_id=vlan_id)
 
-    def get_data(self, vlan_id, dummy1, dummy2):
+    def get_data(self, vlan_id, query, dummy):
         vlan_routers = self._get_vlan_router(vlan_id)
         if vlan_routers:
-            msgs = [vlan_router.get_data() for vlan_router in vlan_routers]
+            msgs = [vlan_router.get_data(query) for vlan_router in vlan_routers]
         else:
             msgs = [{REST_VLANID: vlan_id}]
 
+        flows_saved = self.get_flows_saved()
+
         return {REST_SWITCHID: self.dpid_str,
+                REST_FLOWS_SAVED: flows_saved,
                 REST_NW: msgs}
 
+    def get_data_json(self, vlan_id):
+        # As get_data(), without a query, serialized; assembled from the
+        # fragments cached by each VlanRouter.
+        vlan_routers = self._get_vlan_router(vlan_id)
+        if vlan_routers:
+            msgs = [vlan_router.get_data_json() for vlan_router in vlan_routers]
+        else:
+            msgs = [json.dumps({REST_VLANID: vlan_id})]
+
+        return '{%s: %s, %s: %d, %s: [%s]}' % (json.dumps(REST_SWITCHID),
+                                                json.dumps(self.dpid_str),
+                                                json.dumps(REST_FLOWS_SAVED),
+                                                self.get_flows_saved(),
+                                                json.dumps(REST_NW),
+                                                ', '.join(msgs))
+
+    def get_flows_saved(self):
+        return sum(vlan_router.route_flows_saved
+                   for vlan_router in self.values())
+
+    def get_generation(self, vlan_id):
+        # Changes whenever get_data(vlan_id) would return something different.
+        generations = sorted((vlan_router.vlan_id, vlan_router.generation)
+                             for vlan_router in self._get_vlan_router(vlan_id))
+        return (self.dpid_str, self.get_flows_saved(), generations)
+
     def set_data(self, vlan_id, param, waiters):
         vlan_routers = self._get_vlan_router(vlan_id)
         if not vlan_routers:
-            bare = False
-            if REST_BARE in param:
-                bare = param[REST_BARE]
-                try:
-                    bare = bool(strtobool(bare))
-                except ValueError as e:
-                    err_msg = 'Invalid [%s] value. %s'
-                    raise ValueError(err_msg % (REST_BARE, e.message))
+            bare = param.get(REST_BARE, False)
             vlan_routers = [self._add_vlan_router(vlan_id, bare)]
 
         msgs = []
@@ -133,18 +186,63 @@ class Router(dict):
                     # Data setting is failure.
                     self._del_vlan_router(vlan_router.vlan_id, waiters)
                     raise err_msg
+                finally:
+                    vlan_router.mark_changed()
             else:
                 msgs.append({REST_RESULT: REST_OK, REST_VLANID: vlan_id})
 
         return {REST_SWITCHID: self.dpid_str,
                 REST_COMMAND_RESULT: msgs}
 
+    def set_bulk_data(self, vlan_id, param, waiters):
+        vlan_routers = self._get_vlan_router(vlan_id)
+        if not vlan_routers:
+            bare = param.get(REST_BARE, False)
+            vlan_routers = [self._add_vlan_router(vlan_id, bare)]
+
+        msgs = []
+        for vlan_router in vlan_routers:
+            if vlan_router.bare:
+                msgs.append({REST_RESULT: REST_NG,
+                             REST_VLANID: vlan_router.vlan_id,
+                             REST_DETAILS: 'Bare VLAN; nothing to set.'})
+                continue
+            try:
+                msg = vlan_router.set_bulk_data(param)
+                msgs.append(msg)
+                if msg[REST_RESULT] == REST_NG:
+                    # Batch was rejected.
+                    self._del_vlan_router(vlan_router.vlan_id, waiters)
+            except ValueError as err_msg:
+                # Batch was rejected.
+                self._del_vlan_router(vlan_router.vlan_id, waiters)
+                raise err_msg
+            finally:
+                vlan_router.mark_changed()
+
+        return {REST_SWITCHID: self.dpid_str,
+                REST_COMMAND_RESULT: msgs}
+
+    def restore_data(self, state):
+        # Re-creates VLANs from saved state (see plexus.state), keeping their ids.
+        for vlan_id, vlan_state in sorted(state.items()):
+            vlan_router = self._add_vlan_router(vlan_id, vlan_state[REST_BARE])
+            if vlan_router.bare:
+                continue
+            try:
+                vlan_router.restore_data(vlan_state)
+            finally:
+                vlan_router.mark_changed()
+
     def delete_data(self, vlan_id, param, waiters):
         msgs = []
         vlan_routers = self._get_vlan_router(vlan_id)
         if vlan_routers:
             for vlan_router in vlan_routers:
-                msg = vlan_router.delete_data(param, waiters)
+                try:
+                    msg = vlan_router.delete_data(param, waiters)
+                finally:
+                    vlan_router.mark_changed()
                 if msg:
                     msgs.append(msg)
                 # Check unnecessary VlanRouter.
@@ -156,14 +254,121 @@ class Router(dict):
         return {REST_SWITCHID: self.dpid_str,
                 REST_COMMAND_RESULT: msgs}
 
+    def get_flow_table(self, dummy1, dummy2, dummy3):
+        return {REST_SWITCHID: self.dpid_str,
+                REST_FLOW_TABLE: self.ofctl.occupancy.get_data()}
+
+    def get_top_talkers(self, dummy1, dummy2, dummy3):
+        now = time.time()
+        ports = [{REST_IN_PORT: in_port, REST_RATE: round(rate, 1)}
+                 for rate, in_port in self.port_talkers.get_top(now)]
+        sources = [{REST_VLANID: vlan_id, REST_SOURCE: src_ip, REST_RATE: round(rate, 1)}
+                   for rate, (vlan_id, src_ip) in self.source_talkers.get_top(now)]
+        return {REST_SWITCHID: self.dpid_str,
+                REST_TOP_TALKERS: {REST_IN_PORT: ports, REST_SOURCE: sources}}
+
+    def adopt_flows(self, waiters):
+        # Reconcile the flows left on the switch by a previous run with the
+        # restored state. Flows are owned by whatever their cookie names:
+        # flows of known VLANs, addresses and routes are kept (and replaced in
+        # place, as state is re-applied); all others are deleted. Routing
+        # flows are handed to their VLAN, to be checked against its routes.
+        owners = {}
+        for vlan_router in self.values():
+            route_ids = set(route.route_id
+                            for table in vlan_router.policy_routing_tbl.values()
+                            for route in table.values())
+            address_ids = set(vlan_router.address_data.get_ids())
+            owners[vlan_router.vlan_id] = (route_ids, address_ids)
+
+        try:
+            flows = self.ofctl.get_flows(waiters)
+        except:
+            self.logger.exception('Error in retrieving pre-existing flows!')
+            self.ofctl.adopting = False
+            return
+
+        adopted = []
+        orphans = []
+        route_flows = {}
+        for stats in flows:
+            vlan_id = VlanRouter._cookie_to_id(REST_VLANID, stats.cookie)
+            route_id = VlanRouter._cookie_to_id(REST_ROUTEID, stats.cookie)
+            address_id = VlanRouter._cookie_to_id(REST_ADDRESSID, stats.cookie)
+            if vlan_id not in owners:
+                orphans.append(stats)
+                continue
+            route_ids, address_ids = owners[vlan_id]
+            if ((route_id != COOKIE_DEFAULT_ID and route_id not in route_ids) or
+                    (address_id != COOKIE_DEFAULT_ID and address_id not in address_ids)):
+                orphans.append(stats)
+            elif route_id != COOKIE_DEFAULT_ID:
+                route_flows.setdefault(vlan_id, []).append(stats)
+            else:
+                adopted.append(stats)
+
+        for vlan_id, vlan_flows in route_flows.items():
+            vlan_router = self.get(vlan_id)
+            if vlan_router is None:
+                # Deleted while the flows were being retrieved.
+                orphans.extend(vlan_flows)
+            else:
+                adopted.extend(vlan_router.adopt_route_flows(vlan_flows))
+        self.ofctl.adopt_flows(adopted)
+        # Overlap is still not checked while adopted flows remain.
+        self.ofctl.adopting = False
+        for stats in orphans:
+            self.ofctl.delete_flow(stats)
+        self.logger.info('Adopted [%d] pre-existing flow(s); deleted [%d] orphaned flow(s).',
+                         len(flows) - len(orphans), len(orphans))
+
+    def _discover_flow_budget(self):
+        try:
+            budget = self.ofctl.get_table_capacity(self.waiters)
+        except:
+            self.logger.exception('Error in retrieving flow table capacity!')
+            return
+        if budget:
+            self.ofctl.occupancy.budget = budget
+            self.logger.info('Flow table budget set to [%d] flows.', budget)
+        else:
+            self.logger.info('Unable to discover flow table capacity; '
+                             'no flow budget enforced.')
+
     def port_update_handler(self, port):
-        # FIXME: Need to update more than just port data; might need to update routing tables.
         self.logger.info('Updating port data for port [%s].', port.port_no)
         self.port_data.update(port)
 
+        ofp = self.dp.ofproto
+        if (port.state & ofp.OFPPS_LINK_DOWN or
+                port.config & ofp.OFPPC_PORT_DOWN):
+            self.record(EVENT_PORT_DOWN, **{REST_PORT_NO: port.port_no})
+            for vlan_router in self.values():
+                vlan_router.port_down_handler(port.port_no)
+            # MAC addresses learned on this port are no longer valid.
+            self.mac_table.delete_port(port.port_no)
+        else:
+            self.record(EVENT_PORT_UP, **{REST_PORT_NO: port.port_no})
+            for vlan_router in self.values():
+                vlan_router.port_up_handler(port.port_no)
+
     def port_delete_handler(self, port):
         self.logger.info('Deleting port data for port [%s].', port.port_no)
         self.port_data.delete(port)
+        self.record(EVENT_PORT_DOWN, **{REST_PORT_NO: port.port_no})
+        for vlan_router in self.values():
+            vlan_router.port_down_handler(port.port_no)
+        self.mac_table.delete_port(port.port_no)
+
+    def flow_removed_handler(self, msg):
+        entry = self.ofctl.flow_removed(msg)
+        if entry is None:
+            # Removal of a flow we deleted ourselves, or never tracked.
+            return
+
+        vlan_id = VlanRouter._cookie_to_id(REST_VLANID, msg.cookie)
+        if vlan_id in self:
+            self[vlan_id].flow_removed_handler(msg, entry)
 
     def packet_in_handler(self, msg):
         pkt = None
@@ -184,6 +389,8 @@ class Router(dict):
 
                 # Event dispatch
                 if vlan_id in self:
+                    if self._check_heavy_hitters(msg, header_list, self[vlan_id]):
+                        return
                     self[vlan_id].packet_in_handler(msg, header_list)
                     # FIXME: Deal with updating any routing rules that route to this vlan_id from other routers here.
                 else:
@@ -196,17 +403,33 @@ class Router(dict):
                                   'causing internal state inconsistency. '
                                   'Internal state should regain consistency shortly.')
 
-    def _cyclic_update_routing_tbls(self):
-        while True:
-            # send ARP to all gateways.
-            for vlan_router in self.values():
-                vlan_router.send_arp_all_gw()
-                hub.sleep(1)
+    def _check_heavy_hitters(self, msg, header_list, vlan_router):
+        # Count packet-ins by port and by source, and block sources sending
+        # too many; returns True if the packet-in should be dropped.
+        now = time.time()
+        in_port = self.ofctl.get_packetin_inport(msg)
+        self.port_talkers.hit(in_port, now)
+        if IPV4 not in header_list:
+            return False
+        src_ip = header_list[IPV4].src
+        if src_ip == INADDR_ANY_BASE:
+            # DHCP clients, all alike.
+            return False
 
-            hub.sleep(CHK_ROUTING_TBL_INTERVAL)
+        limit = HEAVY_HITTER_SOURCE_MAXRATE * self.source_talkers.window
+        count = self.source_talkers.hit((vlan_router.vlan_id, src_ip), now)
+        if count <= limit:
+            return False
+        if count == limit + 1:
+            vlan_router.block_source(in_port, src_ip)
+        return True
 
 
 class VlanRouter(object):
+    # Generations are unique across all VlanRouters, so that a VLAN
+    # deleted and re-created never repeats one.
+    _GENERATIONS = itertools.count(1)
+
     def __init__(self, vlan_id, parent_router, bare=False):
         super(VlanRouter, self).__init__()
         self.vlan_id = vlan_id
@@ -217,12 +440,24 @@ class VlanRouter(object):
         self.bare = bare
 
         self.sw_id = {'sw_id': dpid_lib.dpid_to_str(self.dp.id)}
+        self.generation = next(VlanRouter._GENERATIONS)
+        # Serialized get_data() result; dropped by mark_changed().
+        self._data_json = None
         self.address_data = AddressData()
         self.policy_routing_tbl = PolicyRoutingTable()
-        self.packet_buffer = SuspendPacketList(self.send_icmp_unreach_error)
-        self.penalty_box = PenaltyBoxList()
-        self.mac_table = MACAddressTable()
-        self.ofctl = OfCtl.factory(self.dp, self.logger)
+        # Routing flows currently installed, keyed by match.
+        self.route_flows = {}
+        self.route_flows_saved = 0
+        # Implicit routing (host) flows currently installed, keyed by host IP.
+        self.host_flows = {}
+        # Most VLANs on a trunk see few packet-ins; these are created on
+        # first use, and released once empty (see packet_buffer, penalty_box).
+        self._packet_buffer = None
+        self._penalty_box = None
+        self.mac_table = parent_router.mac_table
+        self.gateway_states = GatewayStateTable()
+        self.negative_routes = NegativeRouteCache()
+        self.ofctl = parent_router.ofctl
 
         # Set default route flow:
         # 1) If bare VLAN, define packet in handler.
@@ -233,19 +468,40 @@ class VlanRouter(object):
             self._set_defaultroute_drop()
 
     def shutdown(self):
-        self.penalty_box.shutdown()
-        self.mac_table.shutdown()
+        if self._penalty_box is not None:
+            self._penalty_box.shutdown()
 
     def delete(self, waiters):
+        self.route_flows.clear()
+        self.host_flows.clear()
+        self.mac_table.delete_vlan(self.vlan_id)
+
         # Delete flow.
-        msgs = self.ofctl.get_all_flow(waiters)
-        for msg in msgs:
-            for stats in msg.body:
-                vlan_id = VlanRouter._cookie_to_id(REST_VLANID, stats.cookie)
-                if vlan_id == self.vlan_id:
-                    self.ofctl.delete_flow(stats)
+        for stats in self.ofctl.get_flows(waiters, vlan_id=self.vlan_id):
+            self.ofctl.delete_flow(stats)
+
+        assert not self._packet_buffer
+
+    @property
+    def packet_buffer(self):
+        if self._packet_buffer is None:
+            self._packet_buffer = SuspendPacketList(self.send_icmp_unreach_error,
+                                                    self._release_packet_buffer)
+        return self._packet_buffer
+
+    def _release_packet_buffer(self, packet_buffer):
+        if self._packet_buffer is packet_buffer:
+            self._packet_buffer = None
 
-        assert len(self.packet_buffer) == 0
+    @property
+    def penalty_box(self):
+        if self._penalty_box is None:
+            self._penalty_box = PenaltyBoxList(self._release_penalty_box)
+        return self._penalty_box
+
+    def _release_penalty_box(self, penalty_box):
+        if self._penalty_box is penalty_box:
+            self._penalty_box = None
 
     @staticmethod
     def _cookie_to_id(id_type, cookie):
@@ -279,14 +535,44 @@ class VlanRouter(object):
         msg.setdefault(REST_VLANID, self.vlan_id)
         return msg
 
-    def get_data(self):
+    def mark_changed(self):
+        # Anything that changes what get_data() returns must call this.
+        self.generation = next(VlanRouter._GENERATIONS)
+        self._data_json = None
+
+    def _record(self, event, **details):
+        self.parent_router.record(event, vlan_id=self.vlan_id, **details)
+
+    def _record_address(self, event, address):
+        self._record(event, **{REST_ADDRESSID: address.address_id,
+                               REST_ADDRESS: '%s/%d' % (address.default_gw,
+                                                        address.netmask)})
+
+    def _record_route(self, event, route):
+        destination = '%s/%d' % (route.dst_ip or INADDR_ANY_BASE, route.dst_netmask)
+        source = None
+        if route.src_ip:
+            source = '%s/%d' % (route.src_ip, route.src_netmask)
+        self._record(event, **{REST_ROUTEID: route.route_id,
+                               REST_DESTINATION: destination,
+                               REST_DESTINATION_VLAN: route.dst_vlan,
+                               REST_GATEWAY: route.gateway_ip,
+                               REST_SOURCE: source})
+
+    def get_data_json(self):
+        if self._data_json is None:
+            self._data_json = json.dumps(self.get_data())
+        return self._data_json
+
+    def get_data(self, query=None):
         data = {}
 
         if self.bare:
             data.update({REST_BARE: self.bare})
         else:
-            address_data = self._get_address_data()
-            routing_data = self._get_routing_data()
+            query = query or {}
+            address_data = self._get_address_data(query)
+            routing_data = self._get_routing_data(query)
 
             if address_data[REST_ADDRESS]:
                 data.update(address_data)
@@ -295,29 +581,76 @@ class VlanRouter(object):
 
         return self._response(data)
 
-    def _get_address_data(self):
+    @staticmethod
+    def _select_fields(data, fields, id_field):
+        if fields is None:
+            return data
+        return dict((key, value) for key, value in data.items()
+                    if key == id_field or key in fields)
+
+    @staticmethod
+    def _in_prefix(prefix, ip, netmask):
+        nw_int, prefix_netmask = prefix
+        return (netmask >= prefix_netmask and
+                ipv4_text_to_int(ip) & mask_ntob(prefix_netmask) == nw_int)
+
+    def _get_address_data(self, query=None):
+        query = query or {}
+        fields = query.get(REST_FIELDS)
         address_data = []
+        if fields is not None and not fields & REST_ADDRESS_FIELDS:
+            return {REST_ADDRESS: address_data}
+
         for value in self.address_data.values():
-            default_gw = ip_addr_ntoa(value.default_gw)
-            address = '%s/%d' % (default_gw, value.netmask)
+            address = '%s/%d' % (value.default_gw, value.netmask)
             data = {REST_ADDRESSID: value.address_id,
                     REST_ADDRESS: address}
-            address_data.append(data)
+            address_data.append(self._select_fields(data, fields, REST_ADDRESSID))
         return {REST_ADDRESS: address_data}
 
-    def _get_routing_data(self):
+    def _get_routing_data(self, query=None):
+        query = query or {}
+        fields = query.get(REST_FIELDS)
         routing_data = []
+        if fields is not None and not fields & REST_ROUTE_FIELDS:
+            return {REST_ROUTE: routing_data}
+
+        cursor = query.get(REST_CURSOR, 0)
+        limit = query.get(REST_LIMIT)
+        destination = query.get(REST_DESTINATION)
+        source = query.get(REST_SOURCE)
+
+        # Routes are listed in route_id order, from just after the cursor.
+        routes = []
         for table in self.policy_routing_tbl.values():
             for dst, route in table.items():
-                gateway = ip_addr_ntoa(route.gateway_ip)
-                source_addr = ip_addr_ntoa(route.src_ip)
-                source = '%s/%d' % (source_addr, route.src_netmask)
-                data = {REST_ROUTEID: route.route_id,
-                        REST_DESTINATION: dst,
-                        REST_GATEWAY: gateway,
-                        REST_GATEWAY_MAC: route.gateway_mac,
-                        REST_SOURCE: source}
-                routing_data.append(data)
+                if route.route_id <= cursor:
+                    continue
+                if (destination is not None and
+                        not self._in_prefix(destination, route.dst_ip, route.dst_netmask)):
+                    continue
+                if (source is not None and
+                        not self._in_prefix(source, route.src_ip, route.src_netmask)):
+                    continue
+                routes.append((route.route_id, dst, route))
+        routes.sort()
+
+        next_cursor = None
+        if limit is not None and len(routes) > limit:
+            routes = routes[:limit]
+            next_cursor = routes[-1][0]
+
+        for route_id, dst, route in routes:
+            source_addr = route.src_ip or INADDR_ANY_BASE
+            data = {REST_ROUTEID: route_id,
+                    REST_DESTINATION: prefix_key_to_text(dst),
+                    REST_GATEWAY: route.gateway_ip,
+                    REST_GATEWAY_MAC: route.gateway_mac,
+                    REST_SOURCE: '%s/%d' % (source_addr, route.src_netmask)}
+            routing_data.append(self._select_fields(data, fields, REST_ROUTEID))
+
+        if next_cursor is not None:
+            return {REST_ROUTE: routing_data, REST_NEXT_CURSOR: next_cursor}
         return {REST_ROUTE: routing_data}
 
     def set_data(self, data):
@@ -331,21 +664,7 @@ class VlanRouter(object):
                 details = 'Add address [address_id=%d]' % address_id
             # Set routing data
             elif REST_GATEWAY in data:
-                gateway = data[REST_GATEWAY]
-                destination = INADDR_ANY
-                dest_vlan = None
-                address_id = None
-
-                if REST_DESTINATION in data:
-                    destination = data[REST_DESTINATION]
-
-                if REST_DESTINATION_VLAN in data:
-                    dest_vlan = data[REST_DESTINATION_VLAN]
-
-                if REST_ADDRESSID in data:
-                    address_id = data[REST_ADDRESSID]
-
-                route_id = self._set_routing_data(destination, dest_vlan, gateway, address_id)
+                route_id = self._set_routing_data(*self._get_route_param(data))
                 details = 'Add route [route_id=%d]' % route_id
             elif REST_DHCP in data:
                 dhcp_servers = data[REST_DHCP]
@@ -362,9 +681,143 @@ class VlanRouter(object):
         else:
             raise ValueError('Invalid parameter.')
 
+    def set_bulk_data(self, data):
+        # Items are expected to have been validated (see plexus.schema).
+        address_list = data.get(REST_ADDRESS, [])
+        route_list = data.get(REST_ROUTE, [])
+        dhcp_servers = data.get(REST_DHCP)
+
+        # Stage every item in the tables before anything is sent to the switch,
+        # so that a rejected batch leaves no trace.
+        address_savepoint = self.address_data.savepoint()
+        routing_savepoint = self.policy_routing_tbl.savepoint()
+
+        address_results = []
+        for address in address_list:
+            try:
+                address_results.append(self.address_data.add(address))
+            except (CommandFailure, ValueError) as err_msg:
+                address_results.append(err_msg)
+
+        route_results = []
+        for route_data in route_list:
+            try:
+                route = self._add_routing_data(*self._get_route_param(route_data))
+                route_results.append(route)
+            except (CommandFailure, ValueError) as err_msg:
+                route_results.append(err_msg)
+
+        errors = [result for result in address_results + route_results
+                  if isinstance(result, Exception)]
+        item_count = len(address_list) + len(route_list) + int(dhcp_servers is not None)
+
+        if errors:
+            self.address_data.rollback(address_savepoint)
+            self.policy_routing_tbl.rollback(routing_savepoint)
+            details = 'Batch rejected; %d of %d item(s) invalid' % (len(errors), item_count)
+            msg = {REST_RESULT: REST_NG, REST_DETAILS: details}
+        else:
+            # Program the switch once, for the batch as a whole.
+            for address in address_results:
+                self._set_address_flows(address)
+                self._record_address(EVENT_ADDRESS_ADD, address)
+            for route in route_results:
+                self._record_route(EVENT_ROUTE_ADD, route)
+                self._invalidate_negative_routes(route.dst_ip, route.dst_netmask)
+            if dhcp_servers is not None:
+                self._set_dhcp_data(dhcp_servers, update_records=True)
+            # One ARP request per gateway, rather than one per route.
+            gateways = set(route.gateway_ip for route in route_results)
+            for gateway_ip in gateways:
+                address = self.address_data.get_data(ip=gateway_ip)
+                self.send_arp_request(address.default_gw, gateway_ip)
+            self._sync_routing_flows()
+            details = 'Batch applied; %d item(s)' % item_count
+            msg = {REST_RESULT: REST_OK, REST_DETAILS: details}
+
+        def _item_result(result, id_type, details):
+            if isinstance(result, Exception):
+                return {REST_RESULT: REST_NG, REST_DETAILS: str(result)}
+            elif errors:
+                return {REST_RESULT: REST_NG, REST_DETAILS: 'Not applied.'}
+            rest_id = getattr(result, id_type)
+            return {REST_RESULT: REST_OK, id_type: rest_id,
+                    REST_DETAILS: details % rest_id}
+
+        msg[REST_ADDRESS] = [_item_result(result, REST_ADDRESSID,
+                                          'Add address [address_id=%d]')
+                             for result in address_results]
+        msg[REST_ROUTE] = [_item_result(result, REST_ROUTEID,
+                                        'Add route [route_id=%d]')
+                           for result in route_results]
+        if dhcp_servers is not None:
+            if errors:
+                msg[REST_DHCP] = {REST_RESULT: REST_NG, REST_DETAILS: 'Not applied.'}
+            else:
+                details = 'DHCP server(s) set as %r' % dhcp_servers
+                msg[REST_DHCP] = {REST_RESULT: REST_OK, REST_DETAILS: details}
+
+        return self._response(msg)
+
+    def restore_data(self, state):
+        # Items are re-created with their saved ids, so that ids known to
+        # REST clients hold across restarts.
+        for address_id, address in sorted(state[REST_ADDRESS].items()):
+            try:
+                address = self.address_data.add(address, address_id)
+            except (CommandFailure, ValueError) as err_msg:
+                self.logger.warning('Unable to restore address [address_id=%d]: %s',
+                                    address_id, err_msg)
+                continue
+            self._set_address_flows(address)
+            self._record_address(EVENT_ADDRESS_ADD, address)
+
+        gateways = set()
+        for route_id, data in sorted(state[REST_ROUTE].items()):
+            src_address = None
+            if data[REST_SOURCE] is not None:
+                src_address = self.address_data.get(
+                    prefix_key(*nw_addr_aton(data[REST_SOURCE])[:2]))
+                if src_address is None:
+                    # Not into the default table, where it would apply to all sources.
+                    self.logger.warning('Unable to restore route [route_id=%d]: '
+                                        'source address [%s] is not registered.',
+                                        route_id, data[REST_SOURCE])
+                    continue
+            try:
+                route = self.policy_routing_tbl.add(data[REST_DESTINATION],
+                                                    data[REST_DESTINATION_VLAN],
+                                                    data[REST_GATEWAY],
+                                                    src_address, route_id)
+            except (CommandFailure, ValueError) as err_msg:
+                self.logger.warning('Unable to restore route [route_id=%d]: %s',
+                                    route_id, err_msg)
+                continue
+            self._record_route(EVENT_ROUTE_ADD, route)
+            self._invalidate_negative_routes(route.dst_ip, route.dst_netmask)
+            gateways.add(route.gateway_ip)
+
+        if state[REST_DHCP] is not None:
+            self._set_dhcp_data(state[REST_DHCP], update_records=True)
+
+        for gateway_ip in gateways:
+            address = self.address_data.get_data(ip=gateway_ip)
+            if address is not None:
+                self.send_arp_request(address.default_gw, gateway_ip)
+        self._sync_routing_flows()
+
     def _set_address_data(self, address):
         address = self.address_data.add(address)
+        self._set_address_flows(address)
+        self._record_address(EVENT_ADDRESS_ADD, address)
+
+        # The new address may limit how routes can be aggregated.
+        self._sync_routing_flows()
+
+        return address.address_id
 
+    def _set_address_flows(self, address):
+        self._invalidate_negative_routes(address.nw_addr, address.netmask)
         cookie = self._id_to_cookie(REST_ADDRESSID, address.address_id)
 
         # Set flow: host MAC learning (packet in)
@@ -388,9 +841,24 @@ class VlanRouter(object):
         # Send GARP
         self.send_arp_request(address.default_gw, address.default_gw)
 
-        return address.address_id
+    @staticmethod
+    def _get_route_param(data):
+        destination = data.get(REST_DESTINATION, INADDR_ANY)
+        dest_vlan = data.get(REST_DESTINATION_VLAN)
+        address_id = data.get(REST_ADDRESSID)
+        return destination, dest_vlan, data[REST_GATEWAY], address_id
 
     def _set_routing_data(self, destination, dest_vlan, gateway, address_id=None):
+        route = self._add_routing_data(destination, dest_vlan, gateway, address_id)
+        self._record_route(EVENT_ROUTE_ADD, route)
+        self._invalidate_negative_routes(route.dst_ip, route.dst_netmask)
+        # FIXME: Remove? Seems to be causing problems!
+        # self._set_route_packetin(route)
+        address = self.address_data.get_data(ip=route.gateway_ip)
+        self.send_arp_request(address.default_gw, route.gateway_ip)
+        return route.route_id
+
+    def _add_routing_data(self, destination, dest_vlan, gateway, address_id=None):
         err_msg = 'Invalid [%s] value.' % REST_GATEWAY
         dst_ip = ip_addr_aton(gateway, err_msg=err_msg)
         address = self.address_data.get_data(ip=dst_ip)
@@ -398,31 +866,12 @@ class VlanRouter(object):
 
         if address_id is not None:
             if address_id != REST_ALL:
-                try:
-                    address_id = int(address_id)
-                except ValueError as e:
-                    err_msg = 'Invalid [%s] value. %s'
-                    raise ValueError(err_msg % (REST_ADDRESSID, e.message))
-
                 requested_address = self.address_data.get_data(addr_id=address_id)
                 if requested_address is None:
                     msg = 'Requested address %s for route is not registered.' % address_id
                     raise CommandFailure(msg=msg)
 
         if dest_vlan is not None:
-            try:
-                dest_vlan = int(dest_vlan)
-            except ValueError as e:
-                err_msg = 'Invalid [%s] value. %s'
-                raise ValueError(err_msg % (REST_DESTINATION_VLAN, e.message))
-
-            if not (dest_vlan == VLANID_NONE or
-                    (dest_vlan >= VLANID_MIN and dest_vlan <= VLANID_MAX)):
-                err_msg = ('Value {%d} for [%s] out of permitted range. ' +
-                           'Please use any of [%d] or [%d-%d].')
-                raise ValueError(err_msg % (dest_vlan, REST_DESTINATION_VLAN,
-                                            VLANID_NONE, VLANID_MIN, VLANID_MAX))
-
             if (self.vlan_id == dest_vlan):
                 # It is not an invalid usage of the API to specify a destination VLAN
                 # that is the same as the VLAN of the router handling the packet...
@@ -437,12 +886,7 @@ class VlanRouter(object):
                 % (gateway, address.address_id)
             raise CommandFailure(msg=msg)
         else:
-            src_ip = address.default_gw
-            route = self.policy_routing_tbl.add(destination, dest_vlan, gateway, requested_address)
-            # FIXME: Remove? Seems to be causing problems!
-            # self._set_route_packetin(route)
-            self.send_arp_request(src_ip, dst_ip)
-            return route.route_id
+            return self.policy_routing_tbl.add(destination, dest_vlan, gateway, requested_address)
 
     def _set_dhcp_data(self, dhcp_server_list, update_records=False):
         # OK - we've received a list of DHCP servers here.
@@ -470,6 +914,7 @@ class VlanRouter(object):
 
         # OK - now that we're sure all of the servers in the list have valid IP addresses, set the records.
         self.policy_routing_tbl.dhcp_servers = dhcp_server_list
+        self._record(EVENT_DHCP_SET, **{REST_DHCP: list(dhcp_server_list)})
 
         # Next, loop over the list one more time; this time, check how best to ping each server in the list,
         # then do so.
@@ -548,6 +993,225 @@ class VlanRouter(object):
                                      src_mask=route.src_netmask)
         self.logger.info('Set %s (packet in) flow [cookie=0x%x]', log_msg, cookie)
 
+    def _get_negative_netmask(self, src_ip, dst_int):
+        # The shortest prefix of dst_int that overlaps no address, nor any
+        # route a packet from src_ip may take; None if dst_int is routable.
+        tables = [self.policy_routing_tbl[INADDR_ANY_KEY]]
+        for table in self.policy_routing_tbl.values():
+            if table.src_address is not None and src_ip in table.src_address:
+                tables.append(table)
+        prefixes = [(address.nw_addr, address.netmask)
+                    for address in self.address_data.values()]
+        prefixes.extend((route.dst_ip, route.dst_netmask)
+                        for table in tables for route in table.values())
+
+        netmask = NEGATIVE_ROUTE_MIN_NETMASK
+        for ip, mask in prefixes:
+            # Leading bits in common with dst_int.
+            common = 32 - (ipv4_text_to_int(ip) ^ dst_int).bit_length()
+            if mask <= common:
+                return None
+            netmask = max(netmask, common + 1)
+        return netmask
+
+    def _set_negative_route(self, header_list):
+        # Drop later packets to an unroutable destination on the switch,
+        # for a while, rather than have each sent to the controller.
+        src_ip = header_list[IPV4].src
+        dst_int = ipv4_text_to_int(header_list[IPV4].dst)
+        if DHCP in header_list or src_ip == INADDR_ANY_BASE or (dst_int >> 28) >= 0xe:
+            # Broadcast, multicast and DHCP traffic are not routed anyway.
+            return
+
+        now = time.time()
+        self.negative_routes.expire(now)
+        src_int = ipv4_text_to_int(src_ip)
+        if self.negative_routes.covers(src_int, dst_int):
+            return
+        dst_netmask = self._get_negative_netmask(src_ip, dst_int)
+        if dst_netmask is None:
+            return
+
+        # Sources in the same address share a routing table, and a drop flow.
+        src_netmask = 32
+        src_address = self.address_data.get_data(ip=src_ip)
+        if src_address is not None:
+            src_int = ipv4_text_to_int(src_address.nw_addr)
+            src_netmask = src_address.netmask
+        dst_int &= mask_ntob(dst_netmask)
+        if not self.negative_routes.add((src_int, src_netmask, dst_int, dst_netmask), now):
+            self.logger.debug('Negative route budget spent on VLAN [%d].', self.vlan_id)
+            return
+
+        src = ipv4_int_to_text(src_int)
+        dst = ipv4_int_to_text(dst_int)
+        cookie = self._id_to_cookie(REST_VLANID, self.vlan_id)
+        priority = self._get_priority(PRIORITY_IMPLICIT_ROUTING)
+        outport = None  # for drop
+        self.ofctl.set_routing_flow(cookie, priority, outport,
+                                    dl_vlan=self.vlan_id,
+                                    nw_src=src, src_mask=src_netmask,
+                                    nw_dst=dst, dst_mask=dst_netmask,
+                                    hard_timeout=NEGATIVE_ROUTE_HARD_TIMEOUT,
+                                    flow_class=FLOW_CLASS_NEGATIVE)
+        self.logger.info('Set negative route (drop) flow for [%s/%d]->[%s/%d] [cookie=0x%x]',
+                         src, src_netmask, dst, dst_netmask, cookie)
+
+    def _invalidate_negative_routes(self, ip, netmask):
+        # Drop flows overlapping a new address or route must go at once.
+        priority = self._get_priority(PRIORITY_IMPLICIT_ROUTING)
+        for src_int, src_netmask, dst_int, dst_netmask in \
+                self.negative_routes.invalidate(ipv4_text_to_int(ip), netmask):
+            self.ofctl.delete_routing_flow(priority, dl_vlan=self.vlan_id,
+                                           nw_src=ipv4_int_to_text(src_int),
+                                           src_mask=src_netmask,
+                                           nw_dst=ipv4_int_to_text(dst_int),
+                                           dst_mask=dst_netmask)
+
+    def _get_route_priority(self, route):
+        priority, log_msg = self._get_priority(PRIORITY_TYPE_ROUTE, route=route)
+        return priority
+
+    def _get_foreign_flows(self, routing_table):
+        # Flows on this VLAN that may overlap the routes in routing_table,
+        # but whose priority is not governed by routing_table.
+        foreign_flows = []
+        for table in self.policy_routing_tbl.values():
+            if table is routing_table:
+                continue
+            for route in table.values():
+                if route.gateway_mac is not None:
+                    foreign_flows.append((ipv4_text_to_int(route.dst_ip),
+                                          route.dst_netmask,
+                                          self._get_route_priority(route)))
+        priority = self._get_priority(PRIORITY_MAC_LEARNING)
+        for address in self.address_data.values():
+            foreign_flows.append((ipv4_text_to_int(address.nw_addr),
+                                  address.netmask, priority))
+        return foreign_flows
+
+    def _sync_routing_flows(self):
+        # Recompute the (aggregated) routing flows for this VLAN,
+        # and send the switch only what differs from what is installed.
+        desired_flows = {}
+        route_count = 0
+        for table in self.policy_routing_tbl.values():
+            routes = [route for route in table.values()
+                      if route.gateway_mac is not None and route.out_port is not None]
+            route_count += len(routes)
+            aggregates = aggregate_routes(routes, self._get_route_priority,
+                                          self._get_foreign_flows(table),
+                                          merge=CONF.plexus.route_aggregation)
+            for aggregate in aggregates:
+                desired_flows[aggregate.key] = aggregate
+
+        stale_flows = []
+        for key, installed in self.route_flows.items():
+            desired = desired_flows.get(key)
+            if (desired is None or desired.next_hop != installed.next_hop or
+                    desired.route_id != installed.route_id):
+                stale_flows.append(installed)
+                del self.route_flows[key]
+
+        # Flows being replaced in place must go first, or the add would overlap.
+        for installed in stale_flows:
+            if installed.key in desired_flows:
+                self._delete_aggregate_flow(installed)
+
+        for key, desired in desired_flows.items():
+            if key not in self.route_flows:
+                self._set_aggregate_flow(desired)
+                self.route_flows[key] = desired
+
+        for installed in stale_flows:
+            if installed.key not in desired_flows:
+                self._delete_aggregate_flow(installed)
+
+        flows_saved = route_count - len(self.route_flows)
+        if flows_saved != self.route_flows_saved:
+            self.logger.info('Route aggregation saves %d flow(s) on VLAN [%d]',
+                             flows_saved, self.vlan_id)
+        self.route_flows_saved = flows_saved
+
+    def _set_aggregate_flow(self, aggregate):
+        cookie = self._id_to_cookie(REST_ROUTEID, aggregate.route_id)
+        priority, log_msg = self._get_priority(PRIORITY_TYPE_ROUTE,
+                                               route=aggregate)
+        dst_port = self.port_data.get(aggregate.out_port)
+        src_mac = dst_port.hw_addr if dst_port else 0
+        self.ofctl.set_routing_flow(cookie, priority, aggregate.out_port,
+                                    dl_vlan=self.vlan_id,
+                                    src_mac=src_mac,
+                                    dst_mac=aggregate.gateway_mac,
+                                    nw_src=aggregate.src_ip,
+                                    src_mask=aggregate.src_netmask,
+                                    nw_dst=aggregate.dst_ip,
+                                    dst_mask=aggregate.dst_netmask)
+        if len(aggregate.route_ids) > 1:
+            self.logger.info('Set %s flow [cookie=0x%x] for routes [%s]', log_msg, cookie,
+                             ','.join(str(route_id) for route_id in aggregate.route_ids))
+        else:
+            self.logger.info('Set %s flow [cookie=0x%x]', log_msg, cookie)
+
+    def _delete_aggregate_flow(self, aggregate, priority=None):
+        if priority is None:
+            priority = self._get_route_priority(aggregate)
+        self.ofctl.delete_routing_flow(priority, dl_vlan=self.vlan_id,
+                                       nw_src=aggregate.src_ip,
+                                       src_mask=aggregate.src_netmask,
+                                       nw_dst=aggregate.dst_ip,
+                                       dst_mask=aggregate.dst_netmask)
+
+    def adopt_route_flows(self, flows):
+        # Take over the routing flows left by a previous run, for routes of
+        # the restored state (see Router.adopt_flows()). Each is tracked as
+        # installed, and lends its next hop to its route's gateway until ARP
+        # says otherwise; the routing flows are then synced, so that any
+        # adopted flow that differs from what the routes would install is
+        # deleted or replaced. Returns the flows that are not routing flows.
+        routes = dict((route.route_id, route)
+                      for table in self.policy_routing_tbl.values()
+                      for route in table.values())
+        next_hops = {}
+        others = []
+        for stats in flows:
+            flow = self.ofctl.adopt_routing_flow(stats, self.vlan_id)
+            if flow is None:
+                others.append(stats)
+                continue
+            route_id = VlanRouter._cookie_to_id(REST_ROUTEID, stats.cookie)
+            aggregate = AggregateRoute(ipv4_text_to_int(flow['nw_dst']), flow['dst_mask'],
+                                       flow['nw_src'], flow['src_mask'],
+                                       flow['dst_mac'], flow['outport'], [route_id])
+            priority = self._get_route_priority(aggregate)
+            installed = self.route_flows.get(aggregate.key)
+            if installed is not None:
+                # This run has set its own flow already, which replaced the
+                # adopted one if of the same priority; any other must go.
+                if (stats.priority != priority or installed.route_id != route_id or
+                        installed.next_hop != aggregate.next_hop):
+                    self._delete_aggregate_flow(aggregate, stats.priority)
+                    if stats.priority == priority:
+                        self._set_aggregate_flow(installed)
+                continue
+            if route_id not in routes or stats.priority != priority:
+                self._delete_aggregate_flow(aggregate, stats.priority)
+                continue
+            self.route_flows[aggregate.key] = aggregate
+            gateway_ip = routes[route_id].gateway_ip
+            if aggregate.out_port not in self.port_data:
+                next_hops[gateway_ip] = None
+            elif next_hops.setdefault(gateway_ip, aggregate.next_hop) != aggregate.next_hop:
+                # Flows disagree on where the gateway is; leave it to ARP.
+                next_hops[gateway_ip] = None
+
+        for route in routes.values():
+            if route.gateway_mac is None and next_hops.get(route.gateway_ip) is not None:
+                route.gateway_mac, route.out_port = next_hops[route.gateway_ip]
+        self._sync_routing_flows()
+        self.mark_changed()
+        return others
+
     def delete_data(self, data, waiters):
         if REST_ROUTEID in data:
             route_id = data[REST_ROUTEID]
@@ -556,13 +1220,7 @@ class VlanRouter(object):
             address_id = data[REST_ADDRESSID]
             msg = self._delete_address_data(address_id, waiters)
         elif REST_WIPE in data:
-            wipe = data[REST_WIPE]
-            try:
-                wipe = bool(strtobool(wipe))
-            except ValueError as e:
-                err_msg = 'Invalid [%s] value. %s'
-                raise ValueError(err_msg % (REST_WIPE, e.message))
-            if wipe:
+            if data[REST_WIPE]:
                 msg = self._wipe_all_data(waiters)
             else:
                 msg = {REST_RESULT: REST_OK}
@@ -572,34 +1230,25 @@ class VlanRouter(object):
         return self._response(msg)
 
     def _delete_address_data(self, address_id, waiters):
-        if address_id != REST_ALL:
-            try:
-                address_id = int(address_id)
-            except ValueError as e:
-                err_msg = 'Invalid [%s] value. %s'
-                raise ValueError(err_msg % (REST_ADDRESSID, e.message))
-
         skip_ids = self._chk_addr_relation_route(address_id)
 
-        # Get all flow.
+        # Get this VLAN's flows for the address(es).
         delete_list = []
-        msgs = self.ofctl.get_all_flow(waiters)
+        if address_id == REST_ALL:
+            flows = self.ofctl.get_flows(waiters, vlan_id=self.vlan_id)
+        else:
+            flows = self.ofctl.get_flows(waiters, vlan_id=self.vlan_id,
+                                         address_id=address_id)
         max_id = UINT16_MAX
-        for msg in msgs:
-            for stats in msg.body:
-                vlan_id = VlanRouter._cookie_to_id(REST_VLANID, stats.cookie)
-                if vlan_id != self.vlan_id:
-                    continue
-                addr_id = VlanRouter._cookie_to_id(REST_ADDRESSID,
-                                                   stats.cookie)
-                if addr_id in skip_ids:
+        for stats in flows:
+            addr_id = VlanRouter._cookie_to_id(REST_ADDRESSID,
+                                               stats.cookie)
+            if addr_id in skip_ids:
+                continue
+            elif address_id == REST_ALL:
+                if addr_id <= COOKIE_DEFAULT_ID or max_id < addr_id:
                     continue
-                elif address_id == REST_ALL:
-                    if addr_id <= COOKIE_DEFAULT_ID or max_id < addr_id:
-                        continue
-                elif address_id != addr_id:
-                    continue
-                delete_list.append(stats)
+            delete_list.append(stats)
 
         delete_ids = []
         for flow_stats in delete_list:
@@ -611,13 +1260,19 @@ class VlanRouter(object):
             del_address = self.address_data.get_data(addr_id=address_id)
             if del_address is not None:
                 # Clean up suspend packet threads.
-                self.packet_buffer.delete(del_addr=del_address)
+                if self._packet_buffer is not None:
+                    self._packet_buffer.delete(del_addr=del_address)
 
                 # Delete data.
                 self.address_data.delete(address_id)
+                self._record_address(EVENT_ADDRESS_DELETE, del_address)
                 if address_id not in delete_ids:
                     delete_ids.append(address_id)
 
+        if delete_ids:
+            # Routes may aggregate further, now that the address is gone.
+            self._sync_routing_flows()
+
         msg = {}
         if delete_ids:
             delete_ids = ','.join(str(addr_id) for addr_id in delete_ids)
@@ -636,46 +1291,45 @@ class VlanRouter(object):
         return msg
 
     def _delete_routing_data(self, route_id, waiters):
-        if route_id != REST_ALL:
-            try:
-                route_id = int(route_id)
-            except ValueError as e:
-                err_msg = 'Invalid [%s] value. %s'
-                raise ValueError(err_msg % (REST_ROUTEID, e.message))
-
-        # Get all flow.
-        msgs = self.ofctl.get_all_flow(waiters)
-
-        delete_list = []
-        for msg in msgs:
-            for stats in msg.body:
-                vlan_id = VlanRouter._cookie_to_id(REST_VLANID, stats.cookie)
-                if vlan_id != self.vlan_id:
-                    continue
-                rt_id = VlanRouter._cookie_to_id(REST_ROUTEID, stats.cookie)
-                if route_id == REST_ALL:
-                    if rt_id == COOKIE_DEFAULT_ID:
-                        continue
-                elif route_id != rt_id:
-                    continue
-                delete_list.append(stats)
+        # Routes are deleted from the tables, whether or not their
+        # gateways were ever resolved (and flows installed).
+        delete_routes = []
+        for table in self.policy_routing_tbl.values():
+            for route in table.values():
+                if route_id == REST_ALL or route_id == route.route_id:
+                    delete_routes.append(route)
+        delete_ids = [route.route_id for route in delete_routes]
+
+        # Get this VLAN's flows for the route(s).
+        if route_id == REST_ALL:
+            flows = self.ofctl.get_flows(waiters, vlan_id=self.vlan_id)
+        else:
+            flows = self.ofctl.get_flows(waiters, vlan_id=self.vlan_id,
+                                         route_id=route_id)
 
         # Delete flow.
-        delete_ids = []
-        for flow_stats in delete_list:
-            self.ofctl.delete_flow(flow_stats)
-            route_id = VlanRouter._cookie_to_id(REST_ROUTEID,
-                                                flow_stats.cookie)
-            self.policy_routing_tbl.delete(route_id)
-            if route_id not in delete_ids:
-                delete_ids.append(route_id)
+        # This also removes any aggregated flow whose cookie is owned by a
+        # deleted route; it will be replaced below, if still required.
+        for stats in flows:
+            rt_id = VlanRouter._cookie_to_id(REST_ROUTEID, stats.cookie)
+            if rt_id == COOKIE_DEFAULT_ID or rt_id not in delete_ids:
+                continue
+            self.ofctl.delete_flow(stats)
+
+        for key, installed in self.route_flows.items():
+            if installed.route_id in delete_ids:
+                del self.route_flows[key]
+
+        for route in delete_routes:
+            self.policy_routing_tbl.delete(route.route_id)
+            self._record_route(EVENT_ROUTE_DELETE, route)
 
             # case: Default route deleted. -> set flow (drop)
-            route_type = get_priority_type(flow_stats.priority,
-                                           vid=self.vlan_id)
-            if route_type == PRIORITY_DEFAULT_ROUTING:
+            if not route.dst_ip and not route.src_ip:
                 self._set_defaultroute_drop()
 
+        self._sync_routing_flows()
+
         msg = {}
         if delete_ids:
             delete_ids = ','.join(str(route_id) for route_id in delete_ids)
@@ -735,10 +1389,12 @@ class VlanRouter(object):
                                     in_port=in_port,
                                     dl_type=dl_type, dl_vlan=self.vlan_id,
                                     hard_timeout=PENALTY_BOX_ARP_HARD_TIMEOUT,
-                                    actions=actions)
+                                    actions=actions,
+                                    flow_class=FLOW_CLASS_PENALTY)
                 self.logger.info('Set penalty box flow '
                                  '[cookie=0x%x, hard_timeout=%d]',
                                  cookie, PENALTY_BOX_ARP_HARD_TIMEOUT)
+                self._record(EVENT_PENALTY_BOX, **{REST_IN_PORT: in_port})
                 return True
         else:
             penalty_entry = PenaltyBoxEntry(in_port=in_port,
@@ -784,11 +1440,15 @@ class VlanRouter(object):
                                     dl_type=dl_type, dl_vlan=self.vlan_id,
                                     nw_src=src_ip, nw_dst=dst_ip,
                                     hard_timeout=PENALTY_BOX_IPV4_HARD_TIMEOUT,
-                                    actions=actions)
+                                    actions=actions,
+                                    flow_class=FLOW_CLASS_PENALTY)
                 self.logger.info('Set penalty box flow '
                                  '[cookie=0x%x, hard_timeout=%d]',
                                  cookie,
                                  PENALTY_BOX_IPV4_HARD_TIMEOUT)
+                self._record(EVENT_PENALTY_BOX, **{REST_IN_PORT: in_port,
+                                                   REST_SOURCE: src_ip_str,
+                                                   REST_DESTINATION: dst_ip_str})
                 return True
         else:
             penalty_entry = PenaltyBoxEntry(in_port=in_port,
@@ -798,6 +1458,27 @@ class VlanRouter(object):
             self.penalty_box.append(penalty_entry)
         return False
 
+    def block_source(self, in_port, src_ip):
+        # Drop all IPv4 traffic from a heavy hitter, for a while. The drop
+        # flow is above the routing flows, so the source's routed traffic
+        # is dropped too, until the flow times out.
+        self.logger.info('IPv4 PacketIn events from [%s] inbound on port [%d] '
+                         'exceeded maximum allowed rate.', src_ip, in_port)
+        cookie = self._id_to_cookie(REST_VLANID, self.vlan_id)
+        priority = self._get_priority(PRIORITY_PENALTYBOX)
+        actions = []
+        self.ofctl.set_flow(cookie, priority,
+                            dl_type=ether.ETH_TYPE_IP, dl_vlan=self.vlan_id,
+                            nw_src=src_ip, src_mask=32,
+                            hard_timeout=HEAVY_HITTER_HARD_TIMEOUT,
+                            actions=actions,
+                            flow_class=FLOW_CLASS_PENALTY)
+        self.logger.info('Set penalty box flow '
+                         '[cookie=0x%x, hard_timeout=%d]',
+                         cookie, HEAVY_HITTER_HARD_TIMEOUT)
+        self._record(EVENT_PENALTY_BOX, **{REST_IN_PORT: in_port,
+                                           REST_SOURCE: src_ip})
+
     def _learn_src_mac(self, msg, header_list):
         in_port = self.ofctl.get_packetin_inport(msg)
         src_mac = header_list[ETHERNET].src
@@ -805,7 +1486,7 @@ class VlanRouter(object):
             (src_mac != mac_lib.DONTCARE_STR) and
             (src_mac != mac_lib.MULTICAST) and
             (src_mac != mac_lib.UNICAST)):
-            self.mac_table[src_mac] = MACAddressEntry(in_port)
+            self.mac_table.learn(self.vlan_id, src_mac, in_port)
 
     def packet_in_handler(self, msg, header_list):
         # Check invalid TTL (for OpenFlow V1.2/1.3)
@@ -892,7 +1573,7 @@ class VlanRouter(object):
                     src_addr.address_id == dst_addr.address_id) or self.bare:
                 # ARP from internal host -> ALL (in the same address range, which must be defined)
                 output = self.dp.ofproto.OFPP_ALL
-                mac_entry = self.mac_table.get(packet_dst_mac)
+                mac_entry = self.mac_table.lookup(self.vlan_id, packet_dst_mac)
                 if mac_entry:
                     output = mac_entry.port
                 self.ofctl.send_packet_out(in_port, output, msg.data)
@@ -932,11 +1613,12 @@ class VlanRouter(object):
                 log_msg = 'Received ARP reply from [%s] to router at [%s].'
                 self.logger.info(log_msg, src_ip_str, dst_ip_str)
 
-                packet_list = self.packet_buffer.get_data(src_ip)
+                packet_buffer = self._packet_buffer
+                packet_list = packet_buffer.get_data(src_ip) if packet_buffer else None
                 if packet_list:
                     # stop ARP reply wait thread.
                     for suspend_packet in packet_list:
-                        self.packet_buffer.delete(pkt=suspend_packet)
+                        packet_buffer.delete(pkt=suspend_packet)
 
                     # send suspend packet.
                     output = self.dp.ofproto.OFPP_TABLE
@@ -994,12 +1676,13 @@ class VlanRouter(object):
         self.logger.info('Handling incoming TCP/UDP: [%s]->[%s].', src_ip_str, dst_ip_str)
 
         # Check to see if we've exceeded limits for suspended packets.
-        suspended_packet_list_for_ip = self.packet_buffer.get_data(dst_ip_str)
+        packet_buffer = self._packet_buffer or []
+        suspended_packet_list_for_ip = packet_buffer and packet_buffer.get_data(dst_ip_str)
         drop_packet = False
         if (len(suspended_packet_list_for_ip) >= MAX_SUSPENDPACKETS_PER_IP):
             self.logger.info('Suspended packet maximum exceeded for IP [%s]', dst_ip_str)
             drop_packet = True
-        if (len(self.packet_buffer) >= MAX_SUSPENDPACKETS):
+        if (len(packet_buffer) >= MAX_SUSPENDPACKETS):
             self.logger.info('Suspended packet maximum exceeded for VLAN [%d]', self.vlan_id)
             drop_packet = True
         if drop_packet:
@@ -1039,7 +1722,7 @@ class VlanRouter(object):
             dst_mac = header_list[ETHERNET].dst
             out_port = self.dp.ofproto.OFPP_ALL
 
-            mac_entry = self.mac_table.get(dst_mac)
+            mac_entry = self.mac_table.lookup(self.vlan_id, dst_mac)
             if mac_entry:
                 out_port = mac_entry.port
 
@@ -1054,11 +1737,14 @@ class VlanRouter(object):
                                     dl_dst=mac_lib.haddr_to_bin(dst_mac),
                                     dl_vlan=self.vlan_id,
                                     idle_timeout=L2_IDLE_TIMEOUT,
-                                    actions=actions)
+                                    actions=actions,
+                                    flow_class=FLOW_CLASS_L2)
             self.ofctl.send_packet_out(in_port, out_port, msg.data)
         else:
             # Send ARP request to get node MAC address.
             arp_src_ip = None
+            gateway_ip = None
+            route = None
 
             address = self.address_data.get_data(ip=dst_ip)
             if address is not None:
@@ -1070,19 +1756,29 @@ class VlanRouter(object):
                 if route is not None:
                     log_msg = 'Received IP packet intended for routing: [%s]->[%s].'
                     self.logger.info(log_msg, src_ip_str, dst_ip_str)
+                    if (self.gateway_states.get_state(route.gateway_ip) ==
+                            GATEWAY_UNREACHABLE):
+                        # Fail at once, rather than waiting on the gateway.
+                        self._send_host_unreach(in_port, header_list, msg.data)
+                        return
                     gw_address = self.address_data.get_data(ip=route.gateway_ip)
                     if gw_address is not None:
                         arp_src_ip = gw_address.default_gw
                         dst_ip = route.gateway_ip
+                        gateway_ip = route.gateway_ip
 
             if arp_src_ip is not None:
                 self.packet_buffer.add(in_port, header_list, msg.data)
                 self.send_arp_request(arp_src_ip, dst_ip, in_port=in_port)
+                if gateway_ip is not None:
+                    self._gateway_probed(gateway_ip)
                 self.logger.info('Send ARP request (flood) on behalf of [%s] asking who-has [%s]',
                                  src_ip_str, dst_ip_str)
             else:
                 self.logger.info('Could not find a viable path to destination [%s] for source [%s]',
                                  dst_ip_str, src_ip_str)
+                if address is None and route is None:
+                    self._set_negative_route(header_list)
 
     def _packetin_invalid_ttl(self, msg, header_list):
         # Send ICMP TTL error.
@@ -1098,16 +1794,141 @@ class VlanRouter(object):
                                  msg_data=msg.data, src_ip=src_ip)
             self.logger.info('Send ICMP time exceeded to [%s].', src_ip_str)
 
-    def send_arp_all_gw(self):
-        gateways = self.policy_routing_tbl.get_all_gateway_info()
-        for gateway in gateways:
-            gateway_ip, gateway_mac = gateway
+    def flow_removed_handler(self, msg, entry):
+        ofp = self.dp.ofproto
+        match = entry.match
+
+        if entry.flow_class == FLOW_CLASS_HOST:
+            host = self.host_flows.pop(match['nw_dst'], None)
+            if host is not None and msg.reason == ofp.OFPRR_IDLE_TIMEOUT:
+                # The host has gone quiet; forget where it was learned.
+                host_mac, out_port = host
+                mac_entry = self.mac_table.lookup(self.vlan_id, host_mac)
+                if mac_entry is not None and mac_entry.port == out_port:
+                    del self.mac_table[(self.vlan_id, host_mac)]
+                self.logger.info('Implicit routing flow for [%s] timed out '
+                                 '[cookie=0x%x]', match['nw_dst'], msg.cookie)
+
+        elif entry.flow_class == FLOW_CLASS_ROUTE:
+            nw_dst = match['nw_dst']
+            key = (match['nw_src'], match['src_mask'],
+                   ipv4_text_to_int(nw_dst) if nw_dst else 0,
+                   match['dst_mask'])
+            if self.route_flows.pop(key, None) is not None:
+                # Removed behind our back; put it back.
+                self.logger.info('Routing flow removed by switch; '
+                                 'reinstalling [cookie=0x%x]', msg.cookie)
+                self._sync_routing_flows()
+
+    def port_down_handler(self, port_no):
+        # Withdraw routes whose gateway was learned on this port,
+        # and ask where those gateways have gone.
+        gateways = set()
+        for table in self.policy_routing_tbl.values():
+            for route in table.values():
+                if route.out_port == port_no:
+                    route.gateway_mac = None
+                    route.out_port = None
+                    gateways.add(route.gateway_ip)
+        if gateways:
+            self.logger.info('Port [%s] is down; withdrawing routes via %d gateway(s).',
+                             port_no, len(gateways))
+            self._sync_routing_flows()
+            self.mark_changed()
+            for gateway_ip in gateways:
+                self._record(EVENT_GATEWAY_LOST, **{REST_GATEWAY: gateway_ip,
+                                                    REST_PORT_NO: port_no})
+                address = self.address_data.get_data(ip=gateway_ip)
+                if address is not None:
+                    self.send_arp_request(address.default_gw, gateway_ip)
+
+        # Hosts behind this port must be re-learned.
+        priority = self._get_priority(PRIORITY_IMPLICIT_ROUTING)
+        for host_ip, (host_mac, out_port) in self.host_flows.items():
+            if out_port == port_no:
+                del self.host_flows[host_ip]
+                self.ofctl.delete_routing_flow(priority, dl_vlan=self.vlan_id,
+                                               nw_dst=host_ip)
+                self.logger.info('Deleted implicit routing flow for [%s].', host_ip)
+
+    def port_up_handler(self, port_no):
+        # Unresolved gateways may be reachable through this port now.
+        gateways = set(gateway_ip for gateway_ip, gateway_mac
+                       in self.policy_routing_tbl.get_all_gateway_info()
+                       if gateway_mac is None)
+        for gateway_ip in gateways:
             address = self.address_data.get_data(ip=gateway_ip)
-            self.send_arp_request(address.default_gw, gateway_ip)
+            if address is not None:
+                self.send_arp_request(address.default_gw, gateway_ip)
+
+    def get_gateways(self):
+        # Each gateway once, however many routes use it.
+        return set(gateway_ip for gateway_ip, gateway_mac
+                   in self.policy_routing_tbl.get_all_gateway_info())
+
+    def get_probe_gateways(self, now):
+        # Gateways due to be probed, given their probe backoff.
+        gateways = self.get_gateways()
+        self.gateway_states.prune(gateways)
+        return [gateway_ip for gateway_ip in gateways
+                if self.gateway_states.is_probe_due(gateway_ip, now)]
+
+    def send_arp_all_gw(self):
+        for gateway_ip in self.get_gateways():
+            self.probe_gateway(gateway_ip)
+
+    def probe_gateway(self, gateway_ip):
+        # Returns the number of ARP requests sent.
+        address = self.address_data.get_data(ip=gateway_ip)
+        if address is None:
+            return 0
+        sent = self.send_arp_request(address.default_gw, gateway_ip)
+        self._gateway_probed(gateway_ip)
+        return sent
+
+    def _gateway_probed(self, gateway_ip):
+        if self.gateway_states.probe_sent(gateway_ip, time.time()):
+            self._withdraw_gateway(gateway_ip)
+
+    def _withdraw_gateway(self, gateway_ip):
+        # Routes via an unreachable gateway go back to packet in, where
+        # their traffic is answered at once with ICMP unreachable.
+        routes = []
+        port_no = None
+        for table in self.policy_routing_tbl.values():
+            for route in table.values():
+                if route.gateway_ip == gateway_ip:
+                    if route.out_port is not None:
+                        port_no = route.out_port
+                    route.gateway_mac = None
+                    route.out_port = None
+                    routes.append(route)
+        self.logger.info('Gateway [%s] is unreachable; withdrawing %d route(s).',
+                         gateway_ip, len(routes))
+        self._sync_routing_flows()
+        for route in routes:
+            self._set_route_packetin(route)
+        self.mark_changed()
+        self._record(EVENT_GATEWAY_LOST, **{REST_GATEWAY: gateway_ip,
+                                            REST_PORT_NO: port_no})
+
+    def _restore_gateway(self, gateway_ip):
+        # Remove the packet in flows set by _withdraw_gateway(), before
+        # routing flows (which may be aggregated differently) replace them.
+        for table in self.policy_routing_tbl.values():
+            for route in table.values():
+                if route.gateway_ip == gateway_ip:
+                    priority = self._get_route_priority(route)
+                    self.ofctl.delete_routing_flow(priority, dl_vlan=self.vlan_id,
+                                                   nw_src=route.src_ip,
+                                                   src_mask=route.src_netmask,
+                                                   nw_dst=route.dst_ip,
+                                                   dst_mask=route.dst_netmask)
 
     def send_arp_request(self, src_ip, dst_ip, in_port=None):
-        # Send ARP request from all ports.
+        # Send ARP request from all ports; returns the number sent.
         self.logger.info('Sending ARP request from [%s] asking who-has [%s].', src_ip, dst_ip)
+        sent = 0
         for send_port in self.port_data.values():
             if in_port is None or in_port != send_port.port_no:
                 src_mac = send_port.hw_addr
@@ -1118,22 +1939,27 @@ class VlanRouter(object):
                 self.ofctl.send_arp(arp.ARP_REQUEST, self.vlan_id,
                                     src_mac, dst_mac, src_ip, dst_ip,
                                     arp_target_mac, inport, output)
+                sent += 1
+        return sent
 
     def send_icmp_unreach_error(self, packet_buffer):
         # Send ICMP host unreach error.
         self.logger.info('ARP reply wait timer was timed out.')
+        self._send_host_unreach(packet_buffer.in_port, packet_buffer.header_list,
+                                packet_buffer.data)
 
-        src_ip = self._get_send_port_ip(packet_buffer.header_list)
+    def _send_host_unreach(self, in_port, header_list, data):
+        src_ip = self._get_send_port_ip(header_list)
         if src_ip is not None:
-            self.ofctl.send_icmp(packet_buffer.in_port,
-                                 packet_buffer.header_list,
+            self.ofctl.send_icmp(in_port,
+                                 header_list,
                                  self.vlan_id,
                                  icmp.ICMP_DEST_UNREACH,
                                  icmp.ICMP_HOST_UNREACH_CODE,
-                                 msg_data=packet_buffer.data,
+                                 msg_data=data,
                                  src_ip=src_ip)
 
-            dst_ip = ip_addr_ntoa(packet_buffer.dst_ip)
+            dst_ip = ip_addr_ntoa(header_list[IPV4].dst)
             self.logger.info('Sent ICMP destination unreachable to [%s] regarding [%s].', src_ip, dst_ip)
 
     def _update_routing_tbls(self, msg, header_list):
@@ -1148,30 +1974,27 @@ class VlanRouter(object):
         dst_port = self.port_data.get(out_port)
         if not dst_port:
             return
-        dst_mac = dst_port.hw_addr
 
         default_route = self.policy_routing_tbl.get_data(dst_ip=INADDR_ANY_BASE, src_ip=src_ip)
         gateway_flg = False
+        routes_updated = False
         for table in self.policy_routing_tbl.values():
             for key, value in table.items():
                 if value.gateway_ip == src_ip:
-                    gateway_flg = True
-                    if value.gateway_mac == src_mac:
+                    if not gateway_flg:
+                        gateway_flg = True
+                        if self.gateway_states.reply(src_ip) == GATEWAY_UNREACHABLE:
+                            self.logger.info('Gateway [%s] is reachable again.', src_ip)
+                            self._restore_gateway(src_ip)
+                    if value.gateway_mac == src_mac and value.out_port == out_port:
                         continue
                     table[key].gateway_mac = src_mac
+                    table[key].out_port = out_port
+                    routes_updated = True
 
                     cookie = self._id_to_cookie(REST_ROUTEID, value.route_id)
                     priority, log_msg = self._get_priority(PRIORITY_TYPE_ROUTE,
                                                            route=value)
-                    self.ofctl.set_routing_flow(cookie, priority, out_port,
-                                                dl_vlan=self.vlan_id,
-                                                src_mac=dst_mac,
-                                                dst_mac=src_mac,
-                                                nw_src=value.src_ip,
-                                                src_mask=value.src_netmask,
-                                                nw_dst=value.dst_ip,
-                                                dst_mask=value.dst_netmask)
-                    self.logger.info('Set %s flow [cookie=0x%x]', log_msg, cookie)
                     if default_route is not None:
                         if default_route.gateway_ip == value.gateway_ip:
                             self.ofctl.set_routing_flow(cookie, priority, out_port,
@@ -1183,6 +2006,14 @@ class VlanRouter(object):
                                                         dst_port=DHCP_SERVER_PORT)
                             self.logger.info('Set DHCP egress flow...')
 
+        if routes_updated:
+            # Routing flows are installed through the aggregation stage.
+            self._sync_routing_flows()
+            self.mark_changed()
+            self._record(EVENT_GATEWAY_RESOLVED, **{REST_GATEWAY: src_ip,
+                                                    REST_GATEWAY_MAC: src_mac,
+                                                    REST_PORT_NO: out_port})
+
         return gateway_flg
 
     def _learning_host_mac(self, msg, header_list):
@@ -1209,7 +2040,9 @@ class VlanRouter(object):
                                         out_port, dl_vlan=self.vlan_id,
                                         src_mac=dst_mac, dst_mac=src_mac,
                                         nw_dst=src_ip,
-                                        idle_timeout=L3_IDLE_TIMEOUT)
+                                        idle_timeout=L3_IDLE_TIMEOUT,
+                                        flow_class=FLOW_CLASS_HOST)
+            self.host_flows[src_ip] = (src_mac, out_port)
             self.logger.info('Set implicit routing flow [cookie=0x%x]', cookie)
             # FIXME: 
             # Move this to a background thread; don't want to hold up the handler.
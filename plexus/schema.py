@@ -0,0 +1,225 @@
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# REST request body decoding and validation.
+#
+# Each REST operation has a schema, compiled once (at import) into a
+# validator that checks and normalizes a decoded request body, before
+# any router state is touched.
+
+import json
+from distutils.util import strtobool
+
+from plexus import *
+from plexus.util import *
+
+
+def _invalid(name, detail=None):
+    err_msg = 'Invalid [%s] value.' % name
+    if detail:
+        err_msg = '%s %s' % (err_msg, detail)
+    return ValueError(err_msg)
+
+# Field validators; each returns the normalized value, or raises ValueError.
+def _ipv4(name):
+    err_msg = 'Invalid [%s] value.' % name
+    def _check(value):
+        if not isinstance(value, basestring):
+            raise _invalid(name)
+        ip_addr_aton(value, err_msg=err_msg)
+        return value
+    return _check
+
+def _ipv4_prefix(name):
+    err_msg = 'Invalid [%s] value.' % name
+    def _check(value):
+        if not isinstance(value, basestring):
+            raise _invalid(name)
+        nw_addr, netmask, dummy = nw_addr_aton(value, err_msg=err_msg)
+        if netmask > 32:
+            raise _invalid(name, 'illegal netmask')
+        return value
+    return _check
+
+def _ipv4_network(name):
+    # Returns (network as int, netmask).
+    err_msg = 'Invalid [%s] value.' % name
+    def _check(value):
+        nw_addr, netmask, dummy = nw_addr_aton(value, err_msg=err_msg)
+        if netmask > 32:
+            raise _invalid(name, 'illegal netmask')
+        return ipv4_text_to_int(nw_addr), netmask
+    return _check
+
+def _integer(name, minimum=None, maximum=None):
+    def _check(value):
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            raise _invalid(name)
+        if ((minimum is not None and number < minimum) or
+                (maximum is not None and number > maximum)):
+            raise _invalid(name)
+        return number
+    return _check
+
+def _field_names(name, allowed):
+    def _check(value):
+        names = frozenset(field for field in value.split(',') if field)
+        unknown = names - allowed
+        if not names or unknown:
+            raise _invalid(name, 'Use any of [%s].' % ','.join(sorted(allowed)))
+        return names
+    return _check
+
+def _rest_id(name):
+    def _check(value):
+        if value == REST_ALL:
+            return REST_ALL
+        try:
+            rest_id = int(value)
+        except (TypeError, ValueError):
+            raise _invalid(name)
+        if isinstance(value, float) or not (0 <= rest_id <= UINT16_MAX):
+            raise _invalid(name)
+        return rest_id
+    return _check
+
+def _vlan_id(name):
+    def _check(value):
+        try:
+            vlan_id = int(value)
+        except (TypeError, ValueError):
+            raise _invalid(name)
+        if not (vlan_id == VLANID_NONE or VLANID_MIN <= vlan_id <= VLANID_MAX):
+            err_msg = ('Value {%d} for [%s] out of permitted range. ' +
+                       'Please use any of [%d] or [%d-%d].')
+            raise ValueError(err_msg % (vlan_id, name, VLANID_NONE,
+                                        VLANID_MIN, VLANID_MAX))
+        return vlan_id
+    return _check
+
+def _boolean(name):
+    def _check(value):
+        if isinstance(value, bool):
+            return value
+        try:
+            return bool(strtobool(value))
+        except (AttributeError, ValueError):
+            raise _invalid(name)
+    return _check
+
+def _list_of(name, check):
+    def _check(value):
+        if not isinstance(value, list):
+            raise _invalid(name, 'A list is required.')
+        return [check(item) for item in value]
+    return _check
+
+def _object(name, fields, required=()):
+    # Unknown keys are dropped, as they always have been ignored.
+    fields = fields.items()
+    def _check(value):
+        if not isinstance(value, dict):
+            raise _invalid(name)
+        for key in required:
+            if key not in value:
+                raise ValueError('Missing [%s] value.' % key)
+        checked = {}
+        for key, check in fields:
+            if key in value:
+                checked[key] = check(value[key])
+        return checked
+    return _check
+
+def _operation(operations, common=None):
+    # Pick the operation by the first of its keys found in the body.
+    def _check(value):
+        if not isinstance(value, dict):
+            raise ValueError('Invalid parameter.')
+        checked = common(value) if common else {}
+        for key, check in operations:
+            if key in value:
+                checked.update(check(value))
+                return checked
+        if not checked:
+            raise ValueError('Invalid parameter.')
+        return checked
+    return _check
+
+
+_ROUTE_FIELDS = {REST_GATEWAY: _ipv4(REST_GATEWAY),
+                 REST_DESTINATION: _ipv4_prefix(REST_DESTINATION),
+                 REST_DESTINATION_VLAN: _vlan_id(REST_DESTINATION_VLAN),
+                 REST_ADDRESSID: _rest_id(REST_ADDRESSID)}
+
+_ADDRESS = _object(REST_ADDRESS, {REST_ADDRESS: _ipv4_prefix(REST_ADDRESS)})
+_ROUTE = _object(REST_ROUTE, _ROUTE_FIELDS, required=(REST_GATEWAY,))
+_DHCP = _object(REST_DHCP, {REST_DHCP: _list_of(REST_DHCP, _ipv4(REST_DHCP))})
+
+_SET_DATA = _operation(((REST_ADDRESS, _ADDRESS),
+                        (REST_GATEWAY, _ROUTE),
+                        (REST_DHCP, _DHCP)),
+                       common=_object(REST_BARE, {REST_BARE: _boolean(REST_BARE)}))
+
+_DELETE_DATA = _operation(((REST_ROUTEID, _object(REST_ROUTEID,
+                                                  {REST_ROUTEID: _rest_id(REST_ROUTEID)})),
+                           (REST_ADDRESSID, _object(REST_ADDRESSID,
+                                                    {REST_ADDRESSID: _rest_id(REST_ADDRESSID)})),
+                           (REST_WIPE, _object(REST_WIPE,
+                                               {REST_WIPE: _boolean(REST_WIPE)}))))
+
+_SET_BULK_DATA = _object('parameter',
+                         {REST_BARE: _boolean(REST_BARE),
+                          REST_ADDRESS: _list_of(REST_ADDRESS, _ipv4_prefix(REST_ADDRESS)),
+                          REST_ROUTE: _list_of(REST_ROUTE, _ROUTE),
+                          REST_DHCP: _list_of(REST_DHCP, _ipv4(REST_DHCP))})
+
+_GET_DATA = _object('query',
+                    {REST_LIMIT: _integer(REST_LIMIT, minimum=1),
+                     REST_CURSOR: _rest_id(REST_CURSOR),
+                     REST_FIELDS: _field_names(REST_FIELDS,
+                                               REST_ADDRESS_FIELDS | REST_ROUTE_FIELDS),
+                     REST_DESTINATION: _ipv4_network(REST_DESTINATION),
+                     REST_SOURCE: _ipv4_network(REST_SOURCE)})
+
+_GET_EVENTS = _object('query',
+                      {REST_SINCE: _integer(REST_SINCE, minimum=0),
+                       REST_TIMEOUT: _integer(REST_TIMEOUT, minimum=0,
+                                              maximum=CHANGE_FEED_MAX_TIMEOUT)})
+
+# Validators, by the Router method that handles the request.
+REQUEST_VALIDATORS = {'set_data': _SET_DATA,
+                      'delete_data': _DELETE_DATA,
+                      'set_bulk_data': _SET_BULK_DATA}
+# Validators for query strings, by the Router method that handles the request.
+QUERY_VALIDATORS = {'get_data': _GET_DATA,
+                    'get_events': _GET_EVENTS}
+
+
+def decode_request(body):
+    if not body:
+        return {}
+    param = json.loads(body)
+    if not isinstance(param, dict):
+        raise ValueError('Invalid parameter.')
+    return param
+
+def validate_request(func, body, query=None):
+    # Returns the decoded and validated parameters for a request
+    # to be handled by Router method func.
+    validator = QUERY_VALIDATORS.get(func)
+    if validator is not None:
+        return validator(dict(query or {}))
+    return validate_param(func, decode_request(body))
+
+def validate_param(func, param):
+    # As validate_request(), for parameters already decoded.
+    validator = REQUEST_VALIDATORS.get(func)
+    if validator is None:
+        return {}
+    if not isinstance(param, dict):
+        raise ValueError('Invalid parameter.')
+    return validator(param)
@@ -0,0 +1,397 @@
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Persistence of routing state, for warm restart, and for sharing among
+# worker processes.
+#
+# StateStore keeps the state set over REST, as fed to it by the change
+# journal, and hands changes in batches, off the request path, to one of
+# the backends below:
+# - FileStateBackend keeps a snapshot, plus a journal of the changes made
+#   since; both are JSON, the journal holding one change journal event per
+#   line. Once the journal grows past STATE_SNAPSHOT_THRESHOLD records, it
+#   is folded into a new snapshot and truncated. Private to one process.
+# - SqliteStateBackend keeps one row per VLAN, in a database that worker
+#   processes may share.
+# - MemoryStateBackend keeps nothing; for tests and benchmarks.
+
+import errno
+import fcntl
+import json
+import os
+import sqlite3
+import time
+
+from eventlet import tpool
+
+from plexus import *
+from plexus.util import *
+
+
+def _write_file(path, data, mode='w'):
+    with open(path, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _decode_vlan(vlan):
+    # JSON object keys are strings; ids are not.
+    vlan[REST_ADDRESS] = dict((int(address_id), address) for
+                              address_id, address in vlan[REST_ADDRESS].items())
+    vlan[REST_ROUTE] = dict((int(route_id), route) for
+                            route_id, route in vlan[REST_ROUTE].items())
+    return vlan
+
+def _copy_switches(switches):
+    # Addresses, routes and DHCP server lists are only ever replaced, never
+    # changed in place, so copying the dicts holding them is enough.
+    copy = {}
+    for dpid_str, vlans in switches.items():
+        copy[dpid_str] = {}
+        for vlan_id, vlan in vlans.items():
+            vlan = dict(vlan)
+            vlan[REST_ADDRESS] = dict(vlan[REST_ADDRESS])
+            vlan[REST_ROUTE] = dict(vlan[REST_ROUTE])
+            copy[dpid_str][vlan_id] = vlan
+    return copy
+
+def _encode_pieces(obj, depth):
+    # Yields obj as JSON, in pieces. Dicts down to depth levels are taken
+    # apart, and those below are encoded STATE_SNAPSHOT_ENCODE_CHUNK items at a
+    # time: one call to the C encoder for the whole would hold the GIL,
+    # and so stall the hub, until done, even in a native thread.
+    if not isinstance(obj, dict):
+        yield json.dumps(obj)
+        return
+    yield '{'
+    if depth:
+        for index, (key, value) in enumerate(obj.items()):
+            yield '%s%s: ' % (', ' if index else '', json.dumps(str(key)))
+            for piece in _encode_pieces(value, depth - 1):
+                yield piece
+    else:
+        items = list(obj.items())
+        for start in range(0, len(items), STATE_SNAPSHOT_ENCODE_CHUNK):
+            chunk = dict(items[start:start + STATE_SNAPSHOT_ENCODE_CHUNK])
+            yield '%s%s' % (', ' if start else '', json.dumps(chunk)[1:-1])
+    yield '}'
+
+def next_role_generation_id(directory):
+    # Generation ids for role requests, from a counter in directory that
+    # all workers share. Each id is above both the last one issued and
+    # the time in milliseconds, so ids keep increasing though the clock
+    # be set back, or the counter lost.
+    fd = os.open(os.path.join(directory, STATE_ROLE_GENERATION_FILE),
+                 os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        last = os.read(fd, 32).strip()
+        generation_id = max(int(last or 0) + 1, int(time.time() * 1000))
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, str(generation_id).encode())
+        os.fsync(fd)
+    finally:
+        # Which releases the lock.
+        os.close(fd)
+    return generation_id
+
+def make_state_backend(logger):
+    # Returns the backend configured by state_backend.
+    backend = CONF.plexus.state_backend
+    directory = CONF.plexus.state_directory
+    if backend == STATE_BACKEND_FILE:
+        # Each worker keeps files of its own.
+        suffix = ''
+        if CONF.plexus.worker_count > 1:
+            suffix = '-%d' % CONF.plexus.worker_index
+        return FileStateBackend(directory, logger, suffix)
+    elif backend == STATE_BACKEND_SQLITE:
+        return SqliteStateBackend(os.path.join(directory, STATE_DATABASE_FILE), logger)
+    elif backend == STATE_BACKEND_MEMORY:
+        return MemoryStateBackend()
+    raise ValueError('Invalid [state_backend] value %r.' % backend)
+
+
+class StateStore(object):
+    # Holds {dpid: {vlan_id: VLAN state}}, where VLAN state is:
+    # {"bare": bool, "address": {address_id: address},
+    #  "route": {route_id: route}, "dhcp_servers": [...] or None}
+    def __init__(self, backend, logger):
+        super(StateStore, self).__init__()
+        self.backend = backend
+        self.logger = logger
+        self.switches = {}
+        # Changes not yet saved.
+        self._pending = []
+
+        self.load()
+        self.thread = hub.spawn(self._flush_loop)
+
+    @staticmethod
+    def _new_vlan(bare=False):
+        return {REST_BARE: bare,
+                REST_ADDRESS: {},
+                REST_ROUTE: {},
+                REST_DHCP: None}
+
+    def load(self):
+        start = time.time()
+        self.switches, entries = self.backend.load()
+        for entry in entries:
+            self._apply(entry)
+        self.logger.info('Loaded saved state for [%d] switch(es) in %.3fs.',
+                         len(self.switches), time.time() - start)
+
+    def _apply(self, entry):
+        # Applies a change journal event; returns whether the state changed.
+        event = entry[REST_EVENT]
+        switch = self.switches.setdefault(entry[REST_SWITCHID], {})
+        vlan_id = entry[REST_VLANID]
+        vlan = switch.get(vlan_id)
+
+        if event == EVENT_VLAN_DELETE:
+            return switch.pop(vlan_id, None) is not None
+        elif event == EVENT_VLAN_ADD:
+            if vlan is not None and vlan[REST_BARE] == entry[REST_BARE]:
+                return False
+            switch[vlan_id] = self._new_vlan(entry[REST_BARE])
+            return True
+
+        if vlan is None:
+            # The default VLAN is never announced; it always exists.
+            vlan = switch[vlan_id] = self._new_vlan()
+
+        if event == EVENT_ADDRESS_ADD:
+            table, key, value = vlan[REST_ADDRESS], entry[REST_ADDRESSID], entry[REST_ADDRESS]
+        elif event == EVENT_ROUTE_ADD:
+            table, key = vlan[REST_ROUTE], entry[REST_ROUTEID]
+            value = {REST_DESTINATION: entry[REST_DESTINATION],
+                     REST_DESTINATION_VLAN: entry[REST_DESTINATION_VLAN],
+                     REST_GATEWAY: entry[REST_GATEWAY],
+                     REST_SOURCE: entry[REST_SOURCE]}
+        elif event == EVENT_DHCP_SET:
+            table, key, value = vlan, REST_DHCP, entry[REST_DHCP]
+        elif event == EVENT_ADDRESS_DELETE:
+            return vlan[REST_ADDRESS].pop(entry[REST_ADDRESSID], None) is not None
+        else:
+            assert event == EVENT_ROUTE_DELETE
+            return vlan[REST_ROUTE].pop(entry[REST_ROUTEID], None) is not None
+
+        if table.get(key) == value:
+            return False
+        table[key] = value
+        return True
+
+    def journal_listener(self, entry):
+        # Change journal listener; queues changes to be saved.
+        # Events that change nothing (e.g. those of a restore) are not saved.
+        if entry[REST_EVENT] in EVENTS_PERSISTED and self._apply(entry):
+            self._pending.append(entry)
+
+    def refresh_switch(self, dpid_str):
+        # Pick up state saved for the switch by other workers, where the
+        # backend is shared; changes of our own are saved first.
+        if not self.backend.shared:
+            return
+        try:
+            self.flush()
+            self.switches[dpid_str] = self.backend.load_switch(dpid_str)
+        except Exception:
+            # The switch joins on the state already held. Had the flush
+            # failed, loading would also drop the changes still queued.
+            self.logger.exception('Unable to refresh saved state for switch [%s]!',
+                                  dpid_str)
+
+    def has_switch(self, dpid_str):
+        return bool(self.switches.get(dpid_str))
+
+    def restore_router(self, router):
+        start = time.time()
+        try:
+            router.restore_data(self.switches[router.dpid_str])
+        except Exception:
+            router.logger.exception('Unable to restore saved state!')
+            return
+        router.logger.info('Restored saved state for [%d] VLAN(s) in %.3fs.',
+                           len(self.switches[router.dpid_str]), time.time() - start)
+
+    def _flush_loop(self):
+        while True:
+            hub.sleep(STATE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception('Unable to save state!')
+
+    def flush(self):
+        if not self._pending:
+            return
+        entries, self._pending = self._pending, []
+        try:
+            self.backend.save(entries, self.switches)
+        except Exception:
+            # Try again, with the next batch.
+            self._pending[:0] = entries
+            raise
+
+    def close(self):
+        stop_thread(self.thread)
+        self.flush()
+        self.backend.close()
+
+
+class FileStateBackend(object):
+    shared = False
+
+    def __init__(self, directory, logger, suffix=''):
+        super(FileStateBackend, self).__init__()
+        self.logger = logger
+        name, ext = os.path.splitext(STATE_SNAPSHOT_FILE)
+        self.snapshot_path = os.path.join(directory, name + suffix + ext)
+        name, ext = os.path.splitext(STATE_JOURNAL_FILE)
+        self.journal_path = os.path.join(directory, name + suffix + ext)
+        # Journal records written since the last snapshot.
+        self._journal_records = 0
+
+    def load(self):
+        # Returns (snapshot, journal entries to apply to it).
+        switches = {}
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            for dpid_str, vlans in snapshot[REST_SWITCHES].items():
+                switches[dpid_str] = dict((int(vlan_id), _decode_vlan(vlan))
+                                          for vlan_id, vlan in vlans.items())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                self.logger.exception('Unable to read saved state snapshot!')
+        except (KeyError, TypeError, ValueError, AttributeError):
+            self.logger.exception('Ignoring malformed saved state snapshot!')
+            switches = {}
+
+        entries = []
+        try:
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # Only a write cut short by a crash leaves a partial line.
+                        self.logger.warning('Ignoring incomplete saved state record.')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                self.logger.exception('Unable to read saved state journal!')
+        self._journal_records = len(entries)
+
+        return switches, entries
+
+    def save(self, entries, switches):
+        data = ''.join(json.dumps(entry) + '\n' for entry in entries)
+        # File I/O is done in a native thread, so as not to stall the hub.
+        tpool.execute(_write_file, self.journal_path, data, 'a')
+        self._journal_records += len(entries)
+
+        if self._journal_records >= STATE_SNAPSHOT_THRESHOLD:
+            self.snapshot(switches)
+
+    def snapshot(self, switches):
+        # Serialized and written in a native thread, from a copy, as the
+        # state may change meanwhile. Changes made while the snapshot is
+        # written are queued as usual; replaying them over it is harmless.
+        size = tpool.execute(self._write_snapshot, _copy_switches(switches))
+        self._journal_records = 0
+        self.logger.info('Saved state snapshot [%d bytes].', size)
+
+    def _write_snapshot(self, switches):
+        tmp_path = self.snapshot_path + '.tmp'
+        size = 0
+        with open(tmp_path, 'w') as f:
+            for piece in _encode_pieces({REST_SWITCHES: switches}, STATE_SNAPSHOT_ENCODE_DEPTH):
+                f.write(piece)
+                size += len(piece)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.snapshot_path)
+        _write_file(self.journal_path, '')
+        return size
+
+    def close(self):
+        pass
+
+
+class SqliteStateBackend(object):
+    shared = True
+
+    def __init__(self, path, logger):
+        super(SqliteStateBackend, self).__init__()
+        self.logger = logger
+        self.path = path
+        # Used by one native thread at a time, though not always the same one.
+        self._lock = hub.Semaphore()
+        self.db = sqlite3.connect(path, timeout=STATE_DATABASE_TIMEOUT,
+                                  check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS vlan_state ('
+                        'switch_id TEXT NOT NULL, vlan_id INTEGER NOT NULL, '
+                        'state TEXT NOT NULL, PRIMARY KEY (switch_id, vlan_id))')
+        self.db.commit()
+
+    def _select(self, where='', params=()):
+        switches = {}
+        with self._lock:
+            rows = self.db.execute('SELECT switch_id, vlan_id, state FROM vlan_state' + where,
+                                   params).fetchall()
+        for dpid_str, vlan_id, state in rows:
+            try:
+                vlan = _decode_vlan(json.loads(state))
+            except (KeyError, TypeError, ValueError, AttributeError):
+                self.logger.exception('Ignoring malformed saved state for VLAN [%s]!',
+                                      vlan_id)
+                continue
+            switches.setdefault(dpid_str, {})[vlan_id] = vlan
+        return switches
+
+    def load(self):
+        return self._select(), []
+
+    def load_switch(self, dpid_str):
+        return self._select(' WHERE switch_id = ?', (dpid_str,)).get(dpid_str, {})
+
+    def save(self, entries, switches):
+        # Each VLAN changed is rewritten as a whole.
+        changed = set((entry[REST_SWITCHID], entry[REST_VLANID]) for entry in entries)
+        updates = []
+        deletes = []
+        for dpid_str, vlan_id in changed:
+            vlan = switches.get(dpid_str, {}).get(vlan_id)
+            if vlan is None:
+                deletes.append((dpid_str, vlan_id))
+            else:
+                updates.append((dpid_str, vlan_id, json.dumps(vlan)))
+        with self._lock:
+            tpool.execute(self._write, updates, deletes)
+
+    def _write(self, updates, deletes):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO vlan_state '
+                                '(switch_id, vlan_id, state) VALUES (?, ?, ?)', updates)
+            self.db.executemany('DELETE FROM vlan_state '
+                                'WHERE switch_id = ? AND vlan_id = ?', deletes)
+
+    def close(self):
+        self.db.close()
+
+
+class MemoryStateBackend(object):
+    shared = False
+
+    def load(self):
+        return {}, []
+
+    def save(self, entries, switches):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,84 @@
+# Copyright (c) 2015 Duke University.
+# This software is distributed under the terms of the MIT License,
+# the text of which is included in this distribution within the file
+# named LICENSE.
+
+# Retrieval of saved routing state from Switchboard.
+
+import time
+
+from plexus import *
+
+
+class SwitchboardClient(object):
+    # Fetches Switchboard's saved state over one pooled, keep-alive session.
+    # Requests made while a fetch is running share its result, and a result
+    # is reused for SWITCHBOARD_STATE_TTL seconds; so a whole fabric joining
+    # at once costs one fetch, rather than one per switch.
+    def __init__(self, logger):
+        super(SwitchboardClient, self).__init__()
+        self.logger = logger
+        self._session = None
+        self._state = None
+        self._state_time = 0
+        self._fetch_thread = None
+
+    def _get_session(self):
+        if self._session is None:
+            # Imported on first use; they are slow to load, and unused
+            # unless there is state to fetch.
+            import requests
+            import requests.adapters
+            import urllib3.contrib.pyopenssl
+
+            urllib3.contrib.pyopenssl.inject_into_urllib3()
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=SWITCHBOARD_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    def get_state(self):
+        # Returns the decoded state, or None if it could not be retrieved.
+        if (self._state is not None and
+                time.time() - self._state_time < SWITCHBOARD_STATE_TTL):
+            return self._state
+
+        if self._fetch_thread is None:
+            self._fetch_thread = hub.spawn(self._fetch)
+        fetch_thread = self._fetch_thread
+        return fetch_thread.wait()
+
+    def _fetch(self):
+        try:
+            payload = {'rest_caller_id': CONF.switchboard.username,
+                       'rest_caller_pw': CONF.switchboard.password}
+            r = self._get_session().get(CONF.switchboard.state_url, params=payload,
+                                        timeout=SWITCHBOARD_REPLY_TIMEOUT)
+            r.raise_for_status()
+            state = r.json()
+            if not isinstance(state, dict):
+                raise ValueError('Unexpected Switchboard state format.')
+        except:
+            self.logger.exception('Error in retrieving Switchboard configuration!')
+            return None
+        finally:
+            self._fetch_thread = None
+
+        self._state = state
+        self._state_time = time.time()
+        return state
+
+    @staticmethod
+    def get_switch_state(state, dpid_str):
+        # Returns {vlan_id: bulk parameters} for the switch, from state of the form
+        # {"switches": {"<dpid>" or "all": {"<vlan_id>": bulk parameters}}}.
+        switches = state.get(REST_SWITCHES, {})
+        switch_state = {}
+        for key in (REST_ALL, dpid_str):
+            vlans = switches.get(key)
+            if isinstance(vlans, dict):
+                switch_state.update(vlans)
+        return switch_state
@@ -11,6 +11,11 @@
 # following authors:
 # Author: Victor J. Orlikowski <vjo@duke.edu>
 
+import collections
+import heapq
+import itertools
+import os
+import random
 import time
 
 from plexus import *
@@ -34,30 +39,58 @@ class AddressData(dict):
     def __init__(self):
         super(AddressData, self).__init__()
         self.address_id = 1
+        # Number of addresses with each netmask; see get_data().
+        self.netmasks = {}
 
-    def add(self, address):
+    def __setitem__(self, key, address):
+        if key not in self:
+            netmask = key & PREFIX_KEY_MASK
+            self.netmasks[netmask] = self.netmasks.get(netmask, 0) + 1
+        super(AddressData, self).__setitem__(key, address)
+
+    def __delitem__(self, key):
+        super(AddressData, self).__delitem__(key)
+        netmask = key & PREFIX_KEY_MASK
+        self.netmasks[netmask] -= 1
+        if not self.netmasks[netmask]:
+            del self.netmasks[netmask]
+
+    def clear(self):
+        super(AddressData, self).clear()
+        self.netmasks.clear()
+
+    def update(self, addresses):
+        for key, address in addresses.items():
+            self[key] = address
+
+    def add(self, address, address_id=None):
+        # address_id is given only when restoring saved state.
         err_msg = 'Invalid [%s] value.' % REST_ADDRESS
         nw_addr, mask, default_gw = nw_addr_aton(address, err_msg=err_msg)
 
-        # Check overlaps
-        for other in self.values():
-            other_mask = mask_ntob(other.netmask)
-            add_mask = mask_ntob(mask, err_msg=err_msg)
-            if (other.nw_addr == ipv4_apply_mask(default_gw, other.netmask) or
-                    nw_addr == ipv4_apply_mask(other.default_gw, mask,
-                                               err_msg)):
+        # Check overlaps, on the integer keys: neither may the new default
+        # gateway be within another address, nor another address within
+        # the new one.
+        default_gw_int = ipv4_text_to_int(default_gw)
+        nw_addr_int = ipv4_text_to_int(nw_addr)
+        add_mask = mask_ntob(mask, err_msg=err_msg)
+        for key, other in self.items():
+            other_nw_addr = key >> PREFIX_KEY_SHIFT
+            if ((default_gw_int & mask_ntob(key & PREFIX_KEY_MASK)) == other_nw_addr or
+                    (other_nw_addr & add_mask) == nw_addr_int):
                 msg = 'Address overlaps [address_id=%d]' % other.address_id
                 raise CommandFailure(msg=msg)
 
-        address = Address(self.address_id, nw_addr, mask, default_gw)
-        ip_str = ip_addr_ntoa(nw_addr)
-        key = '%s/%d' % (ip_str, mask)
-        self[key] = address
+        if address_id is None:
+            address_id = self.address_id
+        address = Address(address_id, nw_addr, mask, default_gw)
+        self[prefix_key(nw_addr, mask)] = address
 
-        self.address_id += 1
-        self.address_id &= UINT16_MAX
-        if self.address_id == COOKIE_DEFAULT_ID:
-            self.address_id = 1
+        if address_id >= self.address_id:
+            self.address_id = address_id + 1
+            self.address_id &= UINT16_MAX
+            if self.address_id == COOKIE_DEFAULT_ID:
+                self.address_id = 1
 
         return address
 
@@ -67,24 +100,43 @@ class AddressData(dict):
                 del self[key]
                 return
 
+    def savepoint(self):
+        return (dict(self), self.address_id)
+
+    def rollback(self, savepoint):
+        addresses, address_id = savepoint
+        self.clear()
+        self.update(addresses)
+        self.address_id = address_id
+
     def get_default_gw(self):
         return [address.default_gw for address in self.values()]
 
+    def get_ids(self):
+        return [address.address_id for address in self.values()]
+
     def get_data(self, addr_id=None, ip=None):
-        for address in self.values():
-            if addr_id is not None:
+        if addr_id is not None:
+            for address in self.values():
                 if addr_id == address.address_id:
                     return address
-            else:
-                assert ip is not None
-                if ipv4_apply_mask(ip, address.netmask) == address.nw_addr:
-                    return address
+            return None
+
+        # Addresses do not overlap, so look for ip under each netmask in
+        # use, rather than testing every address.
+        assert ip is not None
+        ip_int = ipv4_text_to_int(ip)
+        for netmask in self.netmasks:
+            address = self.get(((ip_int & mask_ntob(netmask)) << PREFIX_KEY_SHIFT) | netmask)
+            if address is not None:
+                return address
         return None
 
 
 class Address(object):
+    __slots__ = ('address_id', 'nw_addr', 'netmask', 'default_gw')
+
     def __init__(self, address_id, nw_addr, netmask, default_gw):
-        super(Address, self).__init__()
         self.address_id = address_id
         self.nw_addr = nw_addr
         self.netmask = netmask
@@ -97,27 +149,30 @@ class Address(object):
 class PolicyRoutingTable(dict):
     def __init__(self):
         super(PolicyRoutingTable, self).__init__()
-        self[INADDR_ANY] = RoutingTable()
+        self[INADDR_ANY_KEY] = RoutingTable()
         self.route_id = 1
         self.dhcp_servers = []
 
-    def add(self, dst_nw_addr, dst_vlan, gateway_ip, src_address=None):
+    def add(self, dst_nw_addr, dst_vlan, gateway_ip, src_address=None, route_id=None):
+        # route_id is given only when restoring saved state.
         err_msg = 'Invalid [%s] value.'
         added_route = None
-        key = INADDR_ANY
+        key = INADDR_ANY_KEY
 
         if src_address is not None:
-            ip_str = ip_addr_ntoa(src_address.nw_addr)
-            key = '%s/%d' % (ip_str, src_address.netmask)
+            key = prefix_key(src_address.nw_addr, src_address.netmask)
 
         if key not in self:
             self.add_table(key, src_address)
 
+        if route_id is None:
+            route_id = self.route_id
+
         table = self[key]
-        added_route = table.add(dst_nw_addr, dst_vlan, gateway_ip, self.route_id)
+        added_route = table.add(dst_nw_addr, dst_vlan, gateway_ip, route_id)
 
-        if added_route is not None:
-            self.route_id += 1
+        if added_route is not None and route_id >= self.route_id:
+            self.route_id = route_id + 1
             self.route_id &= UINT16_MAX
             if self.route_id == COOKIE_DEFAULT_ID:
                 self.route_id = 1
@@ -129,13 +184,27 @@ class PolicyRoutingTable(dict):
             table.delete(route_id)
         return
 
+    def savepoint(self):
+        tables = dict((key, (table, dict(table))) for key, table in self.items())
+        return (tables, self.route_id, list(self.dhcp_servers))
+
+    def rollback(self, savepoint):
+        tables, route_id, dhcp_servers = savepoint
+        self.clear()
+        for key, (table, routes) in tables.items():
+            table.clear()
+            table.update(routes)
+            self[key] = table
+        self.route_id = route_id
+        self.dhcp_servers = dhcp_servers
+
     def add_table(self, key, address):
         self[key] = RoutingTable(address)
         return self[key]
 
     def gc_subnet_tables(self):
         for key, value in self.items():
-            if key != INADDR_ANY:
+            if key != INADDR_ANY_KEY:
                 if (len(value) == 0):
                     del self[key]
         return
@@ -147,7 +216,7 @@ class PolicyRoutingTable(dict):
         return all_gateway_info
 
     def get_data(self, gw_mac=None, dst_ip=None, src_ip=None):
-        desired_table = self[INADDR_ANY]
+        desired_table = self[INADDR_ANY_KEY]
 
         if src_ip is not None:
             for table in self.values():
@@ -158,8 +227,8 @@ class PolicyRoutingTable(dict):
 
         route = desired_table.get_data(gw_mac, dst_ip)
 
-        if ((route is None) and (desired_table != self[INADDR_ANY])):
-            route = self[INADDR_ANY].get_data(gw_mac, dst_ip)
+        if ((route is None) and (desired_table is not self[INADDR_ANY_KEY])):
+            route = self[INADDR_ANY_KEY].get_data(gw_mac, dst_ip)
 
         return route
 
@@ -181,8 +250,7 @@ class RoutingTable(dict):
 
         gateway_ip = ip_addr_aton(gateway_ip, err_msg=err_msg % REST_GATEWAY)
 
-        dst_ip_str = ip_addr_ntoa(dst_ip)
-        key = '%s/%d' % (dst_ip_str, dst_netmask)
+        key = prefix_key(dst_ip, dst_netmask)
 
         # Check overlaps
         overlap_route = None
@@ -229,21 +297,24 @@ class RoutingTable(dict):
                         mask = route.dst_netmask
 
             if get_route is None:
-                get_route = self.get(INADDR_ANY, None)
+                get_route = self.get(INADDR_ANY_KEY, None)
             return get_route
         else:
             return None
 
 
 class Route(object):
+    __slots__ = ('route_id', 'dst_ip', 'dst_netmask', 'dst_vlan', 'gateway_ip',
+                 'gateway_mac', 'out_port', 'src_ip', 'src_netmask')
+
     def __init__(self, route_id, dst_ip, dst_netmask, dst_vlan, gateway_ip, src_address=None):
-        super(Route, self).__init__()
         self.route_id = route_id
         self.dst_ip = dst_ip
         self.dst_netmask = dst_netmask
         self.dst_vlan = dst_vlan
         self.gateway_ip = gateway_ip
         self.gateway_mac = None
+        self.out_port = None
         if src_address is None:
             self.src_ip = 0
             self.src_netmask = 0
@@ -252,10 +323,144 @@ class Route(object):
             self.src_netmask = src_address.netmask
 
 
+class AggregateRoute(object):
+    # A routing flow, as installed on the switch.
+    # May stand in for several Routes that share the same next hop.
+    def __init__(self, dst_int, dst_netmask, src_ip, src_netmask,
+                 gateway_mac, out_port, route_ids, max_priority=None):
+        super(AggregateRoute, self).__init__()
+        self.dst_int = dst_int
+        self.dst_netmask = dst_netmask
+        if dst_netmask == 0:
+            self.dst_ip = 0
+        else:
+            self.dst_ip = ipv4_int_to_text(dst_int)
+        self.src_ip = src_ip
+        self.src_netmask = src_netmask
+        self.gateway_mac = gateway_mac
+        self.out_port = out_port
+        self.route_ids = route_ids
+        # Highest priority held by any of the member routes.
+        self.max_priority = max_priority
+
+    @property
+    def key(self):
+        return (self.src_ip, self.src_netmask, self.dst_int, self.dst_netmask)
+
+    @property
+    def next_hop(self):
+        return (self.gateway_mac, self.out_port)
+
+    @property
+    def route_id(self):
+        # The lowest member route ID is used to build the flow cookie.
+        return min(self.route_ids)
+
+
+def _prefixes_overlap(ip_a, mask_a, ip_b, mask_b):
+    common_mask = mask_ntob(min(mask_a, mask_b))
+    return (ip_a & common_mask) == (ip_b & common_mask)
+
+
+def _priority_window_clear(dst_int, dst_netmask, low, high, foreign_flows):
+    # Moving a prefix from priority high down to priority low must not
+    # reorder it against any overlapping flow that we do not control.
+    for f_int, f_netmask, f_priority in foreign_flows:
+        if (low <= f_priority <= high and
+                _prefixes_overlap(dst_int, dst_netmask, f_int, f_netmask)):
+            return False
+    return True
+
+
+def aggregate_routes(routes, priority_func, foreign_flows=None, merge=True):
+    # Compute the set of flows needed to implement a list of resolved
+    # routes, all taken from the same source routing table.
+    #
+    # Sibling prefixes with the same next hop are merged into their covering
+    # prefix, and prefixes shadowed by a less specific prefix with the same
+    # next hop are dropped. More specific routes with a different next hop
+    # keep their own (higher priority) flows, and so remain exceptions.
+    # foreign_flows is a list of (dst_int, dst_netmask, priority) tuples,
+    # describing other flows on this VLAN; no change is made that would alter
+    # the relative priority of an overlapping foreign flow.
+    foreign_flows = foreign_flows or []
+    entries = {}
+    for route in routes:
+        aggregate = AggregateRoute(ipv4_text_to_int(route.dst_ip),
+                                   route.dst_netmask,
+                                   route.src_ip, route.src_netmask,
+                                   route.gateway_mac, route.out_port,
+                                   [route.route_id])
+        aggregate.max_priority = priority_func(aggregate)
+        entries[(aggregate.dst_int, aggregate.dst_netmask)] = aggregate
+
+    if not merge:
+        return entries.values()
+
+    # Pass 1: merge siblings, from the longest prefixes upward.
+    for netmask in range(32, 0, -1):
+        for key in [k for k in entries if k[1] == netmask]:
+            entry = entries.get(key)
+            if entry is None:
+                # Already merged, as the sibling of another entry.
+                continue
+            sibling = entries.get((entry.dst_int ^ (1 << (32 - netmask)), netmask))
+            if sibling is None or sibling.next_hop != entry.next_hop:
+                continue
+
+            parent_int = entry.dst_int & mask_ntob(netmask - 1)
+            parent = entries.get((parent_int, netmask - 1))
+            if parent is not None and parent.next_hop != entry.next_hop:
+                continue
+
+            merged = AggregateRoute(parent_int, netmask - 1,
+                                    entry.src_ip, entry.src_netmask,
+                                    entry.gateway_mac, entry.out_port,
+                                    entry.route_ids + sibling.route_ids)
+            priority = priority_func(merged)
+            max_priority = max(entry.max_priority, sibling.max_priority)
+            if not _priority_window_clear(parent_int, netmask - 1,
+                                          priority, max_priority,
+                                          foreign_flows):
+                continue
+
+            if parent is not None:
+                merged.route_ids += parent.route_ids
+                max_priority = max(max_priority, parent.max_priority)
+            merged.max_priority = max_priority
+            del entries[(entry.dst_int, netmask)]
+            del entries[(sibling.dst_int, netmask)]
+            entries[(parent_int, netmask - 1)] = merged
+
+    # Pass 2: drop prefixes that are shadowed by the nearest covering
+    # prefix with the same next hop, from the shortest prefixes downward.
+    for key in sorted(entries.keys(), key=lambda k: k[1]):
+        entry = entries[key]
+        ancestor = None
+        for netmask in range(entry.dst_netmask - 1, -1, -1):
+            ancestor = entries.get((entry.dst_int & mask_ntob(netmask), netmask))
+            if ancestor is not None:
+                break
+        if ancestor is None or ancestor.next_hop != entry.next_hop:
+            continue
+        if not _priority_window_clear(entry.dst_int, entry.dst_netmask,
+                                      priority_func(ancestor),
+                                      entry.max_priority,
+                                      foreign_flows):
+            continue
+        ancestor.route_ids += entry.route_ids
+        ancestor.max_priority = max(ancestor.max_priority, entry.max_priority)
+        del entries[key]
+
+    return entries.values()
+
+
 class SuspendPacketList(list):
-    def __init__(self, timeout_function):
+    def __init__(self, timeout_function, on_empty=None):
         super(SuspendPacketList, self).__init__()
         self.timeout_function = timeout_function
+        # Called with this list, once its last packet is gone.
+        self.on_empty = on_empty
 
     def add(self, in_port, header_list, data):
         suspend_pkt = SuspendPacket(in_port, header_list, data,
@@ -271,8 +476,10 @@ class SuspendPacketList(list):
 
         for pkt in del_list:
             self.remove(pkt)
-            hub.kill(pkt.wait_thread)
-            pkt.wait_thread.wait()
+            stop_thread(pkt.wait_thread)
+
+        if not self and self.on_empty is not None:
+            self.on_empty(self)
 
     def get_data(self, dst_ip):
         return [pkt for pkt in self if pkt.dst_ip == dst_ip]
@@ -285,8 +492,9 @@ class SuspendPacketList(list):
 
 
 class SuspendPacket(object):
+    __slots__ = ('in_port', 'dst_ip', 'header_list', 'data', 'wait_thread')
+
     def __init__(self, in_port, header_list, data, timer):
-        super(SuspendPacket, self).__init__()
         self.in_port = in_port
         self.dst_ip = header_list[IPV4].dst
         self.header_list = header_list
@@ -296,27 +504,40 @@ class SuspendPacket(object):
 
 
 class PenaltyBoxList(list):
-    def __init__(self):
+    def __init__(self, on_empty=None):
         super(PenaltyBoxList, self).__init__()
-        self._expiry_thread = hub.spawn(self._expire_loop)
+        # Called with this list, once its last entry has drained.
+        self.on_empty = on_empty
+        # Runs only while there are entries to drain.
+        self._expiry_thread = None
+
+    def append(self, entry):
+        super(PenaltyBoxList, self).append(entry)
+        if self._expiry_thread is None:
+            self._expiry_thread = hub.spawn(self._expire_loop)
 
     def shutdown(self):
-        hub.kill(self._expiry_thread)
-        self._expiry_thread.wait()
+        if self._expiry_thread is not None:
+            thread, self._expiry_thread = self._expiry_thread, None
+            stop_thread(thread)
 
     def _expire_loop(self):
-        while True:
-            for entry in self:
+        while self:
+            hub.sleep(PENALTY_BOX_CHECK_INTERVAL)
+            for entry in list(self):
                 entry.count -= PENALTY_BOX_DRAIN_AMOUNT
                 if (entry.count <= 0):
                     self.remove(entry)
                 hub.sleep(0)
-            hub.sleep(PENALTY_BOX_CHECK_INTERVAL)
+        self._expiry_thread = None
+        if self.on_empty is not None:
+            self.on_empty(self)
 
 
 class PenaltyBoxEntry(object):
+    __slots__ = ('in_port', 'dl_type', 'src_ip', 'dst_ip', 'count', 'priority')
+
     def __init__(self, in_port=None, dl_type=None, src_ip=None, dst_ip=None):
-        super(PenaltyBoxEntry, self).__init__()
         self.in_port = in_port
         self.dl_type = dl_type
         self.src_ip = src_ip
@@ -325,27 +546,527 @@ class PenaltyBoxEntry(object):
         self.priority = None # Unset, until a rule is inserted.
 
 
+class HeavyHitterSketch(dict):
+    # Space-saving top-k count of packet-ins by key, in constant memory.
+    # Holds {key: [count, error]}; count overestimates a key's packet-ins in
+    # the current window by at most error. When full, a new key takes the
+    # place (and count) of the least counted. Rates of the last complete
+    # window are kept, for reporting.
+    def __init__(self, capacity=HEAVY_HITTER_CAPACITY, window=HEAVY_HITTER_WINDOW):
+        super(HeavyHitterSketch, self).__init__()
+        self.capacity = capacity
+        self.window = window
+        self.window_start = time.time()
+        # [(rate, key)] of the last window, highest first.
+        self.rates = []
+
+    def _roll(self, now):
+        elapsed = now - self.window_start
+        if elapsed < self.window:
+            return
+        self.rates = sorted((((count - error) / float(elapsed), key)
+                             for key, (count, error) in self.items()), reverse=True)
+        self.clear()
+        self.window_start = now
+
+    def hit(self, key, now):
+        # Counts a packet-in; returns the key's guaranteed count in this window.
+        self._roll(now)
+        entry = self.get(key)
+        if entry is None:
+            if len(self) < self.capacity:
+                entry = self[key] = [0, 0]
+            else:
+                victim = min(self, key=lambda k: self[k][0])
+                count = self.pop(victim)[0]
+                entry = self[key] = [count, count]
+        entry[0] += 1
+        return entry[0] - entry[1]
+
+    def get_top(self, now, count=HEAVY_HITTER_REPORT_COUNT):
+        self._roll(now)
+        return self.rates[:count]
+
+
 class MACAddressTable(dict):
+    # MAC addresses learned on a datapath, keyed by (vlan_id, mac).
+    # Entries are only touched when their port changes, or once they are
+    # half way to expiry. Expiry is lazy on lookup, and otherwise by timing
+    # wheel: each key is noted in the slot (of MAC_ADDRESS_GC_INTERVAL
+    # seconds) in which its entry was last seen, and slots older than
+    # MAC_ADDRESS_TTL are swept. Time is kept to the slot, too.
     def __init__(self):
         super(MACAddressTable, self).__init__()
+        self.now = time.time()
+        # [(slot, [keys])], oldest first.
+        self._wheel = collections.deque()
         self._expiry_thread = hub.spawn(self._expire_loop)
 
     def shutdown(self):
-        hub.kill(self._expiry_thread)
-        self._expiry_thread.wait()
+        stop_thread(self._expiry_thread)
+
+    def learn(self, vlan_id, mac, port):
+        key = (vlan_id, mac)
+        entry = self.get(key)
+        if entry is None:
+            self[key] = MACAddressEntry(port, self.now)
+        elif entry.port != port or self.now - entry.seen >= MAC_ADDRESS_TTL / 2:
+            seen = entry.seen
+            entry.port = port
+            entry.seen = self.now
+            if self._get_slot(seen) == self._get_slot(self.now):
+                return
+        else:
+            return
+        self._note(key)
+
+    def lookup(self, vlan_id, mac):
+        entry = self.get((vlan_id, mac))
+        if entry is not None and self.now - entry.seen >= MAC_ADDRESS_TTL:
+            # Expired; left for the sweep.
+            return None
+        return entry
+
+    def delete_vlan(self, vlan_id):
+        for key in [key for key in self if key[0] == vlan_id]:
+            del self[key]
+
+    def delete_port(self, port):
+        for key in [key for key, entry in self.items() if entry.port == port]:
+            del self[key]
+
+    @staticmethod
+    def _get_slot(now):
+        return int(now // MAC_ADDRESS_GC_INTERVAL)
+
+    def _note(self, key):
+        slot = self._get_slot(self.now)
+        if not self._wheel or self._wheel[-1][0] != slot:
+            self._wheel.append((slot, []))
+        self._wheel[-1][1].append(key)
+
+    def expire(self, now):
+        self.now = now
+        oldest_slot = self._get_slot(now - MAC_ADDRESS_TTL)
+        while self._wheel and self._wheel[0][0] < oldest_slot:
+            slot, keys = self._wheel.popleft()
+            for key in keys:
+                # Keys seen since were noted again, in a later slot.
+                entry = self.get(key)
+                if entry is not None and now - entry.seen >= MAC_ADDRESS_TTL:
+                    del self[key]
+            hub.sleep(0)
 
     def _expire_loop(self):
         while True:
-            current_time = time.time()
-            for mac, entry in self.items():
-                if (entry.expire_time < current_time):
-                    del self[mac]
-                hub.sleep(0)
             hub.sleep(MAC_ADDRESS_GC_INTERVAL)
+            self.expire(time.time())
 
 
 class MACAddressEntry(object):
-    def __init__(self, port):
-        super(MACAddressEntry, self).__init__()
+    __slots__ = ('port', 'seen')
+
+    def __init__(self, port, seen):
         self.port = port
-        self.expire_time = (time.time() + MAC_ADDRESS_TTL)
+        self.seen = seen
+
+
+class NegativeRouteCache(dict):
+    # Drop flows installed for unroutable destinations, keyed by
+    # (src_int, src_netmask, dst_int, dst_netmask); values are expiry times.
+    def __init__(self, budget=NEGATIVE_ROUTE_BUDGET):
+        super(NegativeRouteCache, self).__init__()
+        self.budget = budget
+        # Keys by dst_netmask, then by dst_int; see covers() and invalidate().
+        self._dst_index = {}
+        # Earliest expiry time of any entry; see expire().
+        self._next_expiry = None
+
+    def __setitem__(self, key, expire_time):
+        if key not in self:
+            src_int, src_netmask, dst_int, dst_netmask = key
+            self._dst_index.setdefault(dst_netmask, {}).setdefault(dst_int, set()).add(key)
+        super(NegativeRouteCache, self).__setitem__(key, expire_time)
+
+    def __delitem__(self, key):
+        super(NegativeRouteCache, self).__delitem__(key)
+        src_int, src_netmask, dst_int, dst_netmask = key
+        prefixes = self._dst_index[dst_netmask]
+        prefixes[dst_int].discard(key)
+        if not prefixes[dst_int]:
+            del prefixes[dst_int]
+            if not prefixes:
+                del self._dst_index[dst_netmask]
+
+    def expire(self, now):
+        # Called for every packet in; only scans once an entry is due.
+        if self._next_expiry is None or self._next_expiry >= now:
+            return
+        for key, expire_time in list(self.items()):
+            if expire_time < now:
+                del self[key]
+        self._next_expiry = min(self.values()) if self else None
+
+    def covers(self, src_int, dst_int):
+        # Look for dst_int under each dst_netmask in use, rather than
+        # testing every entry.
+        for dst_netmask, prefixes in self._dst_index.items():
+            for src, src_netmask, dst, dummy in prefixes.get(dst_int & mask_ntob(dst_netmask), ()):
+                if _prefixes_overlap(src_int, 32, src, src_netmask):
+                    return True
+        return False
+
+    def add(self, key, now):
+        # Returns False if the budget is spent.
+        if key not in self and len(self) >= self.budget:
+            return False
+        expire_time = now + NEGATIVE_ROUTE_HARD_TIMEOUT
+        self[key] = expire_time
+        if self._next_expiry is None or expire_time < self._next_expiry:
+            self._next_expiry = expire_time
+        return True
+
+    def invalidate(self, dst_int, dst_netmask):
+        # Returns the keys of entries overlapping a newly routable prefix.
+        keys = []
+        for netmask, prefixes in self._dst_index.items():
+            if netmask <= dst_netmask:
+                # At most one prefix of this length covers the new one.
+                keys.extend(prefixes.get(dst_int & mask_ntob(netmask), ()))
+                continue
+            for dst, dst_keys in prefixes.items():
+                if _prefixes_overlap(dst_int, dst_netmask, dst, netmask):
+                    keys.extend(dst_keys)
+        for key in keys:
+            del self[key]
+        return keys
+
+
+class GatewayStateTable(dict):
+    # Liveness of each gateway, keyed by gateway IP. A gateway is reachable
+    # once it answers, stale while a probe of it awaits an answer, and
+    # unreachable after GATEWAY_PROBE_FAILURES probes go unanswered; probes
+    # of unreachable gateways back off exponentially.
+    def get_state(self, gateway_ip):
+        entry = self.get(gateway_ip)
+        return entry.state if entry is not None else GATEWAY_UNKNOWN
+
+    def is_probe_due(self, gateway_ip, now):
+        entry = self.get(gateway_ip)
+        return entry is None or entry.next_probe <= now
+
+    def probe_sent(self, gateway_ip, now):
+        # Returns whether the gateway has just become unreachable.
+        entry = self.setdefault(gateway_ip, GatewayState())
+        if entry.unanswered and now - entry.probed_at < ARP_REPLY_TIMER:
+            # The last probe may yet be answered.
+            return False
+
+        became_unreachable = False
+        if entry.unanswered >= GATEWAY_PROBE_FAILURES:
+            became_unreachable = entry.state != GATEWAY_UNREACHABLE
+            entry.state = GATEWAY_UNREACHABLE
+            retries = min(entry.unanswered - GATEWAY_PROBE_FAILURES, 16)
+            entry.next_probe = now + min(CHK_ROUTING_TBL_INTERVAL * 2 ** retries,
+                                         GATEWAY_PROBE_BACKOFF_MAX)
+        elif entry.state == GATEWAY_REACHABLE:
+            entry.state = GATEWAY_STALE
+        entry.unanswered += 1
+        entry.probed_at = now
+        return became_unreachable
+
+    def reply(self, gateway_ip):
+        # Returns the state before the reply.
+        entry = self.setdefault(gateway_ip, GatewayState())
+        state = entry.state
+        entry.state = GATEWAY_REACHABLE
+        entry.unanswered = 0
+        entry.next_probe = 0
+        return state
+
+    def prune(self, gateway_ips):
+        # Forget gateways no longer used by any route.
+        for gateway_ip in self.keys():
+            if gateway_ip not in gateway_ips:
+                del self[gateway_ip]
+
+
+class GatewayState(object):
+    def __init__(self):
+        super(GatewayState, self).__init__()
+        self.state = GATEWAY_UNKNOWN
+        # Probes sent since the last answer.
+        self.unanswered = 0
+        self.probed_at = 0
+        self.next_probe = 0
+
+
+class GatewayProbeScheduler(dict):
+    # Gateway reachability probes for all routers, keyed by DPID.
+    # Each (VLAN, gateway) pair is probed once per interval, unless backing
+    # off (see GatewayStateTable). Probes are
+    # spread evenly over the interval, in random order and with jitter, so
+    # that switches joining together do not probe together; and no more
+    # than rate ARP requests per second are sent, in all.
+    def __init__(self, interval=CHK_ROUTING_TBL_INTERVAL, rate=GATEWAY_PROBE_RATE):
+        super(GatewayProbeScheduler, self).__init__()
+        self.interval = interval
+        self.rate = rate
+        self._thread = None
+        # Earliest time at which the next probe fits within the rate.
+        self._next_send = 0
+
+    def add(self, router):
+        self[router.dpid_str] = router
+        if self._thread is None:
+            self._thread = hub.spawn(self._probe_loop)
+
+    def remove(self, router):
+        if self.get(router.dpid_str) is router:
+            del self[router.dpid_str]
+        if not self and self._thread is not None:
+            thread, self._thread = self._thread, None
+            stop_thread(thread)
+
+    def get_probes(self, now):
+        probes = [(vlan_router, gateway_ip)
+                  for router in self.values()
+                  for vlan_router in router.values()
+                  for gateway_ip in vlan_router.get_probe_gateways(now)]
+        random.shuffle(probes)
+        return probes
+
+    def _is_current(self, vlan_router):
+        # The VLAN, or its switch, may have gone since the probes were listed.
+        router = vlan_router.parent_router
+        return (self.get(router.dpid_str) is router and
+                router.get(vlan_router.vlan_id) is vlan_router)
+
+    def _probe_loop(self):
+        while True:
+            start = time.time()
+            probes = self.get_probes(start)
+            slot = self.interval / float(max(len(probes), 1))
+            for n, (vlan_router, gateway_ip) in enumerate(probes):
+                due = max(start + slot * (n + random.random()), self._next_send)
+                hub.sleep(max(due - time.time(), 0))
+                if not self._is_current(vlan_router):
+                    continue
+                try:
+                    sent = vlan_router.probe_gateway(gateway_ip)
+                except Exception:
+                    vlan_router.logger.exception('Unable to probe gateway [%s]!', gateway_ip)
+                    continue
+                self._next_send = max(time.time(), self._next_send) + sent / float(self.rate)
+            hub.sleep(max(start + self.interval - time.time(), 0))
+
+
+class FlowTableOccupancy(dict):
+    # Shadow of the flows installed on one datapath, keyed by (priority, match).
+    def __init__(self, budget=0, high_water=1.0):
+        super(FlowTableOccupancy, self).__init__()
+        self.budget = budget
+        self.high_water = high_water
+        self.evictions = 0
+        # Number of entries for flows adopted from a previous run.
+        self.adopted = 0
+        # Keys of installed flows, indexed by (cookie, priority).
+        self._cookie_index = {}
+        # Keys of installed (not adopted) flows, per flow class, least
+        # recently used first; see get_lru().
+        self._lru = {}
+        # Heap of (expire_time, tiebreak, key), for flows that time out
+        # unreported; see expire(). Entries are checked as they are popped,
+        # as a flow may have been removed, or re-added with a later time.
+        self._expiry = []
+        self._expiry_tiebreak = itertools.count()
+
+    def add(self, key, flow_class, cookie, priority, match,
+            idle_timeout=0, hard_timeout=0, notify_removal=False):
+        entry = self.get(key)
+        if entry is not None and entry.cookie != cookie:
+            self.remove(key)
+            entry = None
+        if entry is None:
+            entry = FlowTableEntry(flow_class, cookie, priority, match)
+            self[key] = entry
+            self._cookie_index.setdefault((cookie, priority), set()).add(key)
+        entry.notify_removal = notify_removal
+        entry.touch(idle_timeout, hard_timeout)
+
+        lru = self._lru.setdefault(entry.flow_class, collections.OrderedDict())
+        lru.pop(key, None)
+        lru[key] = None
+        if entry.expire_time is not None:
+            if len(self._expiry) > 2 * len(self):
+                # Mostly stale; keep only the current expiry of each flow.
+                self._expiry = [item for item in self._expiry
+                                if self._is_expiry_current(item)]
+                heapq.heapify(self._expiry)
+            heapq.heappush(self._expiry, (entry.expire_time, next(self._expiry_tiebreak), key))
+        return entry
+
+    def adopt(self, flow_class, cookie, priority, fields):
+        # Track a flow found on the datapath, rather than installed by us.
+        # Its match is only known in the form of OfCtl.get_match_fields().
+        key = self.get_adopted_key(cookie, priority, fields)
+        if key in self:
+            return self[key]
+        entry = FlowTableEntry(flow_class, cookie, priority, fields)
+        entry.adopted = True
+        entry.notify_removal = flow_class in FLOW_CLASSES_NOTIFY_REMOVAL
+        self[key] = entry
+        self._cookie_index.setdefault((cookie, priority), set()).add(key)
+        self.adopted += 1
+        return entry
+
+    @staticmethod
+    def get_adopted_key(cookie, priority, fields):
+        return ('adopted', cookie, priority, tuple(sorted(fields.items())))
+
+    def remove(self, key):
+        entry = self.pop(key, None)
+        if entry is not None:
+            if entry.adopted:
+                self.adopted -= 1
+            else:
+                self._lru[entry.flow_class].pop(key, None)
+            index_key = (entry.cookie, entry.priority)
+            keys = self._cookie_index.get(index_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._cookie_index[index_key]
+        return entry
+
+    def clear(self):
+        super(FlowTableOccupancy, self).clear()
+        self._cookie_index.clear()
+        self._lru.clear()
+        self._expiry = []
+        self.adopted = 0
+
+    def get_keys(self, cookie, priority):
+        return list(self._cookie_index.get((cookie, priority), ()))
+
+    def delete_cookie(self, cookie, priority=None):
+        if priority is not None:
+            index_keys = [(cookie, priority)]
+        else:
+            index_keys = [index_key for index_key in self._cookie_index
+                          if index_key[0] == cookie]
+        for index_key in index_keys:
+            for key in list(self._cookie_index.get(index_key, ())):
+                self.remove(key)
+
+    def expire(self):
+        # Flows with timeouts, whose removal the switch will not report,
+        # are dropped here once they would have timed out on the switch.
+        current_time = time.time()
+        while self._expiry and self._expiry[0][0] < current_time:
+            item = heapq.heappop(self._expiry)
+            if self._is_expiry_current(item):
+                self.remove(item[2])
+
+    def _is_expiry_current(self, item):
+        expire_time, tiebreak, key = item
+        entry = self.get(key)
+        return entry is not None and entry.expire_time == expire_time
+
+    def near_capacity(self):
+        if not self.budget:
+            return False
+        if len(self) < (self.budget * self.high_water):
+            return False
+        self.expire()
+        return len(self) >= (self.budget * self.high_water)
+
+    def get_lru(self, flow_classes, count):
+        # Adopted flows cannot be deleted exactly, so are never evicted.
+        # Only the count least recently used of each class can be among
+        # the count least recently used overall.
+        candidates = [(key, self[key])
+                      for flow_class in flow_classes
+                      for key in itertools.islice(self._lru.get(flow_class, ()), count)]
+        candidates.sort(key=lambda candidate: candidate[1].last_used)
+        return candidates[:count]
+
+    def get_occupancy(self):
+        occupancy = {}
+        for entry in self.values():
+            occupancy[entry.flow_class] = occupancy.get(entry.flow_class, 0) + 1
+        return occupancy
+
+    def get_data(self):
+        self.expire()
+        return {REST_BUDGET: self.budget,
+                REST_OCCUPANCY: self.get_occupancy(),
+                REST_EVICTIONS: self.evictions}
+
+
+class FlowTableEntry(object):
+    def __init__(self, flow_class, cookie, priority, match):
+        super(FlowTableEntry, self).__init__()
+        self.flow_class = flow_class
+        self.cookie = cookie
+        self.priority = priority
+        self.match = match
+        self.install_time = time.time()
+        self.last_used = None
+        self.expire_time = None
+        self.notify_removal = False
+        # Adopted from a previous run; if so, match is in get_match_fields() form.
+        self.adopted = False
+
+    def touch(self, idle_timeout=0, hard_timeout=0):
+        # Re-adding an identical flow resets its timeouts on the switch.
+        self.last_used = time.time()
+        timeouts = [timeout for timeout in (idle_timeout, hard_timeout) if timeout]
+        if timeouts and not self.notify_removal:
+            self.expire_time = self.last_used + min(timeouts)
+        else:
+            self.expire_time = None
+
+
+class ChangeJournal(object):
+    # Bounded log of routing state changes, numbered in order.
+    def __init__(self, size=CHANGE_JOURNAL_SIZE):
+        super(ChangeJournal, self).__init__()
+        # Sequence numbers restart with the controller; so does this.
+        self.journal_id = os.urandom(8).encode('hex')
+        self.seq = 0
+        self.events = collections.deque(maxlen=size)
+        self._new_event = hub.Event()
+        # Called with each event appended.
+        self.listeners = []
+
+    def append(self, event, **details):
+        self.seq += 1
+        entry = dict(details)
+        entry.update({REST_SEQ: self.seq,
+                      REST_TIME: time.time(),
+                      REST_EVENT: event})
+        self.events.append(entry)
+        for listener in self.listeners:
+            listener(entry)
+
+        # Wake up everything waiting on the previous event.
+        new_event, self._new_event = self._new_event, hub.Event()
+        new_event.set()
+
+    def get_since(self, since):
+        # Returns (events after since, whether the client must resync).
+        first_seq = self.events[0][REST_SEQ] if self.events else self.seq + 1
+        if since > self.seq or since < first_seq - 1:
+            return [], True
+        return list(itertools.islice(self.events, since - first_seq + 1, None)), False
+
+    def wait_since(self, since, timeout):
+        events, resync = self.get_since(since)
+        if not events and not resync and timeout:
+            self._new_event.wait(timeout)
+            events, resync = self.get_since(since)
+        return {REST_JOURNAL_ID: self.journal_id,
+                REST_SEQ: self.seq,
+                REST_RESYNC: resync,
+                REST_EVENTS: events}
@@ -14,6 +14,7 @@
 import logging
 import json
 import socket
+import zlib
 
 from webob import Response
 
@@ -65,6 +66,8 @@ def rest_command(func):
     def _rest_command(*args, **kwargs):
         try:
             msg = func(*args, **kwargs)
+            if isinstance(msg, Response):
+                return msg
             return Response(content_type='application/json',
                             body=json.dumps(msg))
 
@@ -141,6 +144,25 @@ def nw_addr_aton(nw_addr, err_msg=None):
     nw_addr = ipv4_apply_mask(default_route, netmask, err_msg)
     return nw_addr, netmask, default_route
 
+def prefix_key(ip, netmask):
+    # A prefix as one small integer, for use as a table key.
+    return (ipv4_text_to_int(ip) << PREFIX_KEY_SHIFT) | netmask
+
+def prefix_key_to_text(key):
+    return '%s/%d' % (ipv4_int_to_text(key >> PREFIX_KEY_SHIFT), key & PREFIX_KEY_MASK)
+
+def stop_thread(thread):
+    # Kills a green thread and waits for it to exit. joinall() is used,
+    # as wait() raises GreenletExit if the thread was killed before it
+    # ever ran.
+    hub.kill(thread)
+    hub.joinall([thread])
+
+
+def get_dpid_worker(dpid_str, worker_count):
+    # Index of the worker owning a switch; the same in every process.
+    return (zlib.crc32(dpid_str) & UINT32_MAX) % worker_count
+
 
 class RouterLoggerAdapter(logging.LoggerAdapter):
     def process(self, msg, kwargs):